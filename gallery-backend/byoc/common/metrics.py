@@ -0,0 +1,227 @@
+# Shared by the model containers (byoc/facechain, byoc/gfpgan); each Dockerfile copies it next to
+# its predictor.py.
+#
+# Per-phase request timings for the gallery pipeline, in the same embedded metric format (EMF)
+# log line the Lambda functions emit (lambda/layers/gallery-runtime), keyed on the job id.
+#
+# Endpoint logs are not parsed into metrics automatically the way Lambda logs are; the lines are
+# still JSON for Logs Insights, metric filters and tools/pipeline_waterfall.py.
+#
+# The same timings feed per-phase histograms for the /metrics endpoint. Every gunicorn worker writes
+# its histograms to a snapshot file after each request, and /metrics (answered by any one worker)
+# merges the snapshots of all workers.
+#
+# Sampled requests can be profiled with cProfile; a profile is kept (and its top functions logged)
+# when the request was slower than PROFILE_SLOW_MS.
+#
+# Parameter                Environment Variable              Default Value
+# ---------                --------------------              -------------
+# metrics namespace        METRICS_NAMESPACE                 AmazonBedrockGallery
+# snapshot directory       MODEL_SERVER_METRICS_DIR          /tmp/model-server-metrics
+# profiled share           PROFILE_SAMPLE_RATE               0 (disabled)
+# slow request threshold   PROFILE_SLOW_MS                   0 (every profiled request)
+# profile directory        PROFILE_DIR                       /tmp/profiles
+# profiles kept            PROFILE_MAX_FILES                 20
+
+import cProfile
+import io
+import json
+import os
+import pstats
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'AmazonBedrockGallery')
+MODEL_SERVER_METRICS_DIR = os.environ.get('MODEL_SERVER_METRICS_DIR', '/tmp/model-server-metrics')
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+PROFILE_SLOW_MS = float(os.environ.get('PROFILE_SLOW_MS', 0))
+PROFILE_DIR = os.environ.get('PROFILE_DIR', '/tmp/profiles')
+PROFILE_MAX_FILES = int(os.environ.get('PROFILE_MAX_FILES', 20))
+
+# Histogram bucket upper bounds in seconds
+HISTOGRAM_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+
+def job_id_from_key(object_key):
+    return os.path.splitext(os.path.basename(object_key))[0]
+
+
+class Histograms:
+    """Phase duration histograms and request counts of this worker, saved as {pid}.json snapshots."""
+
+    def __init__(self, directory=MODEL_SERVER_METRICS_DIR):
+        self.directory = directory
+        # "stage|phase" -> {'buckets': [...], 'sum': seconds, 'count': n}
+        self.histograms = {}
+        # "stage|status" -> n
+        self.requests = {}
+        self.lock = threading.Lock()
+
+    def observe(self, stage, phase, seconds):
+        with self.lock:
+            histogram = self.histograms.setdefault(f'{stage}|{phase}', {'buckets': [0] * len(HISTOGRAM_BUCKETS), 'sum': 0.0, 'count': 0})
+            for index, upper_bound in enumerate(HISTOGRAM_BUCKETS):
+                if seconds <= upper_bound:
+                    histogram['buckets'][index] += 1
+            histogram['sum'] += seconds
+            histogram['count'] += 1
+
+    def count_request(self, stage, status):
+        with self.lock:
+            self.requests[f'{stage}|{status}'] = self.requests.get(f'{stage}|{status}', 0) + 1
+
+    def save(self):
+        with self.lock:
+            snapshot = json.dumps({'histograms': self.histograms, 'requests': self.requests})
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f'{os.getpid()}.json')
+        with open(f'{path}.tmp', 'w') as file:
+            file.write(snapshot)
+        os.replace(f'{path}.tmp', path)
+
+
+histograms = Histograms()
+
+
+def merged_snapshots(directory=MODEL_SERVER_METRICS_DIR):
+    # Counts of exited workers are kept, so the counters only go back to zero on a container restart
+    merged = {'histograms': {}, 'requests': {}}
+    if not os.path.isdir(directory):
+        return merged
+
+    for name in os.listdir(directory):
+        if not name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(directory, name)) as file:
+                snapshot = json.load(file)
+        except (OSError, ValueError):
+            continue
+        for key, histogram in snapshot['histograms'].items():
+            total = merged['histograms'].setdefault(key, {'buckets': [0] * len(HISTOGRAM_BUCKETS), 'sum': 0.0, 'count': 0})
+            total['buckets'] = [a + b for a, b in zip(total['buckets'], histogram['buckets'])]
+            total['sum'] += histogram['sum']
+            total['count'] += histogram['count']
+        for key, count in snapshot['requests'].items():
+            merged['requests'][key] = merged['requests'].get(key, 0) + count
+    return merged
+
+
+def render_metrics(gauges):
+    """Prometheus text format: phase histograms, request counts and the given gauges."""
+    merged = merged_snapshots()
+    lines = [
+        '# HELP model_server_phase_seconds Time spent in each request phase.',
+        '# TYPE model_server_phase_seconds histogram'
+    ]
+    for key in sorted(merged['histograms']):
+        stage, phase = key.split('|')
+        histogram = merged['histograms'][key]
+        labels = f'stage="{stage}",phase="{phase}"'
+        for upper_bound, count in zip(HISTOGRAM_BUCKETS, histogram['buckets']):
+            lines.append(f'model_server_phase_seconds_bucket{{{labels},le="{upper_bound}"}} {count}')
+        lines.append(f'model_server_phase_seconds_bucket{{{labels},le="+Inf"}} {histogram["count"]}')
+        lines.append(f'model_server_phase_seconds_sum{{{labels}}} {histogram["sum"]:.6f}')
+        lines.append(f'model_server_phase_seconds_count{{{labels}}} {histogram["count"]}')
+
+    lines += ['# HELP model_server_requests_total Requests by outcome.', '# TYPE model_server_requests_total counter']
+    for key in sorted(merged['requests']):
+        stage, status = key.split('|')
+        lines.append(f'model_server_requests_total{{stage="{stage}",status="{status}"}} {merged["requests"][key]}')
+
+    for name, (help_text, value) in gauges.items():
+        lines += [f'# HELP model_server_{name} {help_text}', f'# TYPE model_server_{name} gauge', f'model_server_{name} {float(value)}']
+    return '\n'.join(lines) + '\n'
+
+
+class JobTimer:
+    def __init__(self, stage, job_id, **properties):
+        self.stage = stage
+        self.job_id = job_id
+        self.properties = properties
+        self.status = 'ok'
+        self.started_at = time.time()
+        self.phases = []
+
+    @contextmanager
+    def phase(self, name):
+        started_at = time.time()
+        try:
+            yield
+        finally:
+            self.phases.append((name, started_at, time.time()))
+
+    def record(self):
+        finished_at = time.time()
+        metrics = {}
+        for name, started_at, phase_finished_at in self.phases:
+            metrics[f'{name}_ms'] = metrics.get(f'{name}_ms', 0) + round((phase_finished_at - started_at) * 1000, 1)
+        metrics['total_ms'] = round((finished_at - self.started_at) * 1000, 1)
+
+        return {
+            '_aws': {
+                'Timestamp': int(self.started_at * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': METRICS_NAMESPACE,
+                    'Dimensions': [['Stage']],
+                    'Metrics': [{'Name': name, 'Unit': 'Milliseconds'} for name in metrics]
+                }]
+            },
+            'Stage': self.stage,
+            'job_id': self.job_id,
+            'status': self.status,
+            'started_at_ms': int(self.started_at * 1000),
+            'phases': [
+                [name, round((started_at - self.started_at) * 1000, 1), round((phase_finished_at - started_at) * 1000, 1)]
+                for name, started_at, phase_finished_at in self.phases
+            ],
+            **metrics,
+            **self.properties
+        }
+
+
+def save_profile(profiler, record):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = os.path.join(PROFILE_DIR, f"{record['Stage']}-{record['job_id']}-{int(record['total_ms'])}ms.prof")
+    profiler.dump_stats(path)
+
+    profiles = sorted((os.path.join(PROFILE_DIR, name) for name in os.listdir(PROFILE_DIR) if name.endswith('.prof')), key=os.path.getmtime)
+    for old_path in profiles[:-PROFILE_MAX_FILES]:
+        os.remove(old_path)
+
+    # The container filesystem goes away with the instance, so the summary goes to the log as well
+    summary = io.StringIO()
+    pstats.Stats(profiler, stream=summary).sort_stats('cumulative').print_stats(15)
+    print(f"Profile of slow request saved to {path}\n{summary.getvalue()}", flush=True)
+
+
+@contextmanager
+def job_timer(stage, job_id, **properties):
+    """Time one request, print its timing line and update the /metrics histograms on exit."""
+    timer = JobTimer(stage, job_id, **properties)
+    profiler = None
+    if PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        yield timer
+    except Exception as e:
+        timer.status = 'error'
+        timer.properties['error'] = str(e)
+        raise
+    finally:
+        if profiler:
+            profiler.disable()
+        record = timer.record()
+        print(json.dumps(record), flush=True)
+
+        for name, _, duration_ms in record['phases']:
+            histograms.observe(stage, name, duration_ms / 1000)
+        histograms.observe(stage, 'total', record['total_ms'] / 1000)
+        histograms.count_request(stage, timer.status)
+        histograms.save()
+
+        if profiler and record['total_ms'] >= PROFILE_SLOW_MS:
+            save_profile(profiler, record)
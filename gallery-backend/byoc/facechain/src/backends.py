@@ -0,0 +1,138 @@
+# This file implements the inference backends for the FaceChain face fusion pipeline.
+#
+# The stock modelscope pipeline runs everything in eager torch. For cheaper CPU instances the
+# generator network, which dominates the fusion latency, can be swapped for an exported TorchScript
+# or ONNX Runtime module while face detection, alignment and blending stay in the reference pipeline.
+# Artifacts are produced ahead of time with `optimize.py export`; the Dockerfile exports both during the image build.
+#
+# Parameter                Environment Variable              Default Value
+# ---------                --------------------              -------------
+# backend                  FACECHAIN_BACKEND                 torch (torch | torchscript | onnx)
+# cpu threads              FACECHAIN_NUM_THREADS             0 (library default)
+# generator module         FACECHAIN_GENERATOR_MODULE        netG
+# artifact directory       FACECHAIN_ARTIFACT_DIR            /opt/program/artifacts
+
+import os
+import torch
+
+FACECHAIN_BACKEND = os.environ.get('FACECHAIN_BACKEND', 'torch')
+FACECHAIN_NUM_THREADS = int(os.environ.get('FACECHAIN_NUM_THREADS', 0))
+FACECHAIN_GENERATOR_MODULE = os.environ.get('FACECHAIN_GENERATOR_MODULE', 'netG')
+FACECHAIN_ARTIFACT_DIR = os.environ.get('FACECHAIN_ARTIFACT_DIR', '/opt/program/artifacts')
+
+BACKENDS = ('torch', 'torchscript', 'onnx')
+ARTIFACT_FILENAMES = {
+    'torchscript': 'generator.torchscript.pt',
+    'onnx': 'generator.onnx',
+}
+
+
+def create_pipeline(backend=FACECHAIN_BACKEND, device=None):
+    """Build the face fusion pipeline, replacing its generator for the exported backends."""
+    if backend not in BACKENDS:
+        raise ValueError(f"Unsupported backend: {backend} (expected one of {', '.join(BACKENDS)})")
+
+    from modelscope.pipelines import pipeline
+
+    if backend != 'torch':
+        # Exported backends are meant for CPU instances
+        device = 'cpu'
+    if FACECHAIN_NUM_THREADS > 0:
+        torch.set_num_threads(FACECHAIN_NUM_THREADS)
+
+    kwargs = {'device': device} if device else {}
+    face_fusion = pipeline('face_fusion_torch',
+                           model='damo/cv_unet_face_fusion_torch',
+                           model_revision='v1.0.3',
+                           **kwargs)
+
+    if backend != 'torch':
+        set_generator(face_fusion, load_generator(backend, artifact_path(backend)))
+    print(f"Face fusion pipeline created with {backend} backend")
+    return face_fusion
+
+
+def artifact_path(backend, artifact_dir=FACECHAIN_ARTIFACT_DIR):
+    return os.path.join(artifact_dir, ARTIFACT_FILENAMES[backend])
+
+
+def get_generator(face_fusion):
+    model = face_fusion.model
+    if not hasattr(model, FACECHAIN_GENERATOR_MODULE):
+        children = ', '.join(name for name, _ in model.named_children())
+        raise AttributeError(f"Model has no generator module '{FACECHAIN_GENERATOR_MODULE}' (children: {children})")
+    return getattr(model, FACECHAIN_GENERATOR_MODULE)
+
+
+def set_generator(face_fusion, generator):
+    setattr(face_fusion.model, FACECHAIN_GENERATOR_MODULE, generator)
+
+
+def capture_generator_inputs(face_fusion, template_img, user_img):
+    """Run the pipeline once and record the tensors passed to the generator."""
+    captured = []
+
+    def hook(module, args):
+        if not captured:
+            captured.append(tuple(arg.detach().clone() for arg in args))
+
+    handle = get_generator(face_fusion).register_forward_pre_hook(hook)
+    try:
+        face_fusion(dict(template=template_img, user=user_img))
+    finally:
+        handle.remove()
+
+    if not captured:
+        raise RuntimeError("The generator was not called while running the pipeline")
+    return captured[0]
+
+
+def export_generator(face_fusion, backend, example_inputs, artifact_dir=FACECHAIN_ARTIFACT_DIR):
+    generator = get_generator(face_fusion).eval()
+    path = artifact_path(backend, artifact_dir)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    with torch.no_grad():
+        if backend == 'torchscript':
+            traced = torch.jit.freeze(torch.jit.trace(generator, example_inputs))
+            traced.save(path)
+        elif backend == 'onnx':
+            input_names = [f'input_{i}' for i in range(len(example_inputs))]
+            torch.onnx.export(generator, example_inputs, path,
+                              input_names=input_names,
+                              dynamic_axes={name: {0: 'batch'} for name in input_names},
+                              opset_version=14)
+        else:
+            raise ValueError(f"Backend {backend} has no exportable artifact")
+
+    print(f"Exported {backend} generator to {path}")
+    return path
+
+
+def load_generator(backend, path):
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"{backend} artifact not found at {path}; run `optimize.py export` first")
+
+    if backend == 'torchscript':
+        return torch.jit.load(path, map_location='cpu')
+    return OnnxGenerator(path)
+
+
+class OnnxGenerator(torch.nn.Module):
+    """Drop-in torch module that runs the exported generator with ONNX Runtime."""
+
+    def __init__(self, path):
+        super().__init__()
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if FACECHAIN_NUM_THREADS > 0:
+            options.intra_op_num_threads = FACECHAIN_NUM_THREADS
+        self.session = ort.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self.input_names = [i.name for i in self.session.get_inputs()]
+
+    def forward(self, *args):
+        feeds = {name: arg.detach().cpu().numpy() for name, arg in zip(self.input_names, args)}
+        outputs = [torch.from_numpy(output) for output in self.session.run(None, feeds)]
+        return outputs[0] if len(outputs) == 1 else tuple(outputs)
@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+
+# This file implements the FaceChain inference process. The face fusion model is loaded exactly once
+# in this process and the gunicorn workers talk to it over a local unix socket, so fetching, decoding
+# and encoding images can run in parallel across all workers while inference itself is serialized.
+#
+# We set the following parameters:
+#
+# Parameter                Environment Variable              Default Value
+# ---------                --------------------              -------------
+# socket path              INFERENCE_SOCKET                  /tmp/facechain-inference.sock
+# connect timeout          INFERENCE_CONNECT_TIMEOUT         300 seconds
+# warm-up template image   WARMUP_TEMPLATE_PATH              /opt/program/samples/template.jpg
+# warm-up user image       WARMUP_USER_PATH                  /opt/program/samples/user.jpg
+
+import os
+import threading
+import time
+import traceback
+from multiprocessing.connection import Client, Listener
+
+INFERENCE_SOCKET = os.environ.get('INFERENCE_SOCKET', '/tmp/facechain-inference.sock')
+INFERENCE_CONNECT_TIMEOUT = int(os.environ.get('INFERENCE_CONNECT_TIMEOUT', 300))
+INFERENCE_AUTHKEY = b'facechain-inference'
+# Sample images downloaded by the Dockerfile; the warm-up needs a real face for the fusion to complete
+WARMUP_TEMPLATE_PATH = os.environ.get('WARMUP_TEMPLATE_PATH', '/opt/program/samples/template.jpg')
+WARMUP_USER_PATH = os.environ.get('WARMUP_USER_PATH', '/opt/program/samples/user.jpg')
+
+
+class FaceFusionModel:
+    """Owns the face fusion pipeline and serializes every call into it."""
+
+    def __init__(self):
+        self.pipeline = None
+        self.restorer = None
+        self.lock = threading.Lock()
+        self.stats_lock = threading.Lock()
+        self.loaded = threading.Event()
+        self.warm = threading.Event()
+        # Set once the model is loaded or its load failed, so callers stop waiting in either case
+        self.load_finished = threading.Event()
+        self.load_error = None
+        self.in_flight = 0
+
+    def load(self):
+        """Load the models and run a warm-up inference; meant to run on a background thread."""
+        from backends import create_pipeline
+        from restore import GFPGAN_PRELOAD
+
+        try:
+            self.pipeline = create_pipeline()
+            if GFPGAN_PRELOAD:
+                self.get_restorer()
+            self.loaded.set()
+            self.load_finished.set()
+
+            # /ping only reports warm once a real fusion has completed
+            self.warm_up()
+            self.warm.set()
+            print("Face fusion model is warm")
+        except Exception as e:
+            self.load_error = e
+            self.load_finished.set()
+            traceback.print_exc()
+
+    def start_background_load(self):
+        threading.Thread(target=self.load, daemon=True).start()
+
+    def warm_up(self):
+        # Runs the whole pipeline once (CUDA context, kernels, face detector); raises when it does not complete
+        import cv2
+
+        template_img = cv2.imread(WARMUP_TEMPLATE_PATH, cv2.IMREAD_COLOR)
+        user_img = cv2.imread(WARMUP_USER_PATH, cv2.IMREAD_COLOR)
+        if template_img is None or user_img is None:
+            raise FileNotFoundError(f"Could not read the warm-up images {WARMUP_TEMPLATE_PATH} and {WARMUP_USER_PATH}")
+
+        start = time.time()
+        self.fuse(template_img, user_img, restore=self.restorer is not None)
+        print(f"Warm-up took {time.time() - start:.2f}s")
+
+    def status(self):
+        with self.stats_lock:
+            in_flight = self.in_flight
+        return {
+            'loaded': self.loaded.is_set(),
+            'warm': self.warm.is_set(),
+            'error': str(self.load_error) if self.load_error else None,
+            'in_flight': in_flight,
+            # Everything beyond the request being inferred is waiting for the model
+            'queue_depth': max(0, in_flight - 1),
+        }
+
+    def call(self, op, **kwargs):
+        if op == 'status':
+            return self.status()
+        if op in ('fuse', 'fuse_many'):
+            # A failed load raises right away instead of holding the request until the timeout
+            self.load_finished.wait(INFERENCE_CONNECT_TIMEOUT)
+            if not self.loaded.is_set():
+                raise RuntimeError(f"Face fusion model is not loaded: {self.load_error}")
+            with self.stats_lock:
+                self.in_flight += 1
+            try:
+                if op == 'fuse_many':
+                    return self.fuse_many(kwargs['templates'], kwargs['user'],
+                                          restore=kwargs.get('restore', False),
+                                          restore_weight=kwargs.get('restore_weight', 0.5))
+                return self.fuse(kwargs['template'], kwargs['user'],
+                                 restore=kwargs.get('restore', False),
+                                 restore_weight=kwargs.get('restore_weight', 0.5))
+            finally:
+                with self.stats_lock:
+                    self.in_flight -= 1
+        raise ValueError(f"Unsupported op: {op}")
+
+    def fuse(self, template_img, user_img, restore=False, restore_weight=0.5):
+        # template_img and user_img are BGR ndarrays, the same layout cv2.imread returns
+        from modelscope.outputs import OutputKeys
+
+        with self.lock:
+            output_img = self.pipeline(dict(template=template_img, user=user_img))[OutputKeys.OUTPUT_IMG]
+            if restore:
+                output_img = self.get_restorer().restore(output_img, weight=restore_weight)
+        return output_img
+
+    def fuse_many(self, template_imgs, user_img, restore=False, restore_weight=0.5):
+        # One user face fused into several templates; the user image crosses the socket once. The model
+        # lock is taken per fusion, so requests queued behind this one are not held for the whole set.
+        return [self.fuse(template_img, user_img, restore=restore, restore_weight=restore_weight) for template_img in template_imgs]
+
+    def get_restorer(self):
+        if self.restorer is None:
+            from restore import FaceRestorer
+            self.restorer = FaceRestorer()
+        return self.restorer
+
+
+class InferenceServer:
+    """Exposes a FaceFusionModel to the gunicorn workers over a unix socket."""
+
+    def __init__(self, model, address=INFERENCE_SOCKET):
+        self.model = model
+        self.address = address
+
+    def serve_forever(self):
+        # Listen right away so the workers can report loading progress from /ping
+        self.model.start_background_load()
+
+        if os.path.exists(self.address):
+            os.remove(self.address)
+
+        with Listener(self.address, family='AF_UNIX', authkey=INFERENCE_AUTHKEY) as listener:
+            print(f"Inference server listening on {self.address}")
+            while True:
+                conn = listener.accept()
+                threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+
+    def handle(self, conn):
+        with conn:
+            while True:
+                try:
+                    request = conn.recv()
+                except (EOFError, OSError):
+                    break
+
+                try:
+                    response = {'result': self.model.call(request.pop('op'), **request)}
+                except Exception as e:
+                    traceback.print_exc()
+                    response = {'error': str(e)}
+                conn.send(response)
+
+
+class InferenceClient:
+    """Same call interface as FaceFusionModel, backed by the shared inference process."""
+
+    def __init__(self, address=INFERENCE_SOCKET):
+        self.address = address
+        self.conn = None
+        self.lock = threading.Lock()
+
+    def call(self, op, connect_timeout=INFERENCE_CONNECT_TIMEOUT, **kwargs):
+        with self.lock:
+            if self.conn is None:
+                self.conn = self.connect(connect_timeout)
+            try:
+                self.conn.send(dict(op=op, **kwargs))
+                response = self.conn.recv()
+            except (EOFError, OSError):
+                # The inference process went away; reconnect on the next call
+                self.conn = None
+                raise
+
+        if 'error' in response:
+            raise RuntimeError(f"Inference failed: {response['error']}")
+        return response['result']
+
+    def connect(self, timeout=INFERENCE_CONNECT_TIMEOUT):
+        # The inference process may still be starting, so wait for its socket
+        deadline = time.time() + timeout
+        while True:
+            try:
+                return Client(self.address, family='AF_UNIX', authkey=INFERENCE_AUTHKEY)
+            except (FileNotFoundError, ConnectionRefusedError):
+                if time.time() > deadline:
+                    raise
+                time.sleep(1)
+
+
+if __name__ == '__main__':
+    InferenceServer(FaceFusionModel()).serve_forever()
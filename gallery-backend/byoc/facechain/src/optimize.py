@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+# This file exports, verifies and benchmarks the CPU backends defined in backends.py.
+#
+#   python optimize.py export --backend onnx --template template.png --user user.png
+#   python optimize.py verify --backend onnx --template template.png --user user.png
+#   python optimize.py benchmark --backends torch,torchscript,onnx --template template.png --user user.png
+#
+# export    traces the generator on a reference run and writes the artifact to FACECHAIN_ARTIFACT_DIR
+# verify    compares the backend output with the reference CPU pipeline and fails below --min-psnr
+# benchmark reports CPU latency percentiles of the full fusion call for each backend
+
+import argparse
+import sys
+import time
+
+import cv2
+import numpy as np
+
+import backends
+
+
+def load_images(args):
+    template_img = cv2.imread(args.template, cv2.IMREAD_COLOR)
+    user_img = cv2.imread(args.user, cv2.IMREAD_COLOR)
+    if template_img is None or user_img is None:
+        raise FileNotFoundError("Could not read the template or user image")
+    return template_img, user_img
+
+
+def run_fusion(face_fusion, template_img, user_img):
+    from modelscope.outputs import OutputKeys
+
+    return face_fusion(dict(template=template_img, user=user_img))[OutputKeys.OUTPUT_IMG]
+
+
+def psnr(reference, candidate):
+    mse = np.mean((reference.astype(np.float64) - candidate.astype(np.float64)) ** 2)
+    if mse == 0:
+        return float('inf')
+    return 10 * np.log10(255.0 ** 2 / mse)
+
+
+def export(args):
+    template_img, user_img = load_images(args)
+    reference = backends.create_pipeline('torch', device='cpu')
+    example_inputs = backends.capture_generator_inputs(reference, template_img, user_img)
+    print(f"Captured generator inputs: {[tuple(t.shape) for t in example_inputs]}")
+    backends.export_generator(reference, args.backend, example_inputs, args.artifact_dir)
+
+
+def verify(args):
+    template_img, user_img = load_images(args)
+    expected = run_fusion(backends.create_pipeline('torch', device='cpu'), template_img, user_img)
+    actual = run_fusion(backends.create_pipeline(args.backend), template_img, user_img)
+
+    if expected.shape != actual.shape:
+        print(f"Shape mismatch: reference {expected.shape}, {args.backend} {actual.shape}")
+        return 1
+
+    diff = np.abs(expected.astype(np.int16) - actual.astype(np.int16))
+    score = psnr(expected, actual)
+    print(f"{args.backend}: max abs diff {diff.max()}, mean abs diff {diff.mean():.4f}, psnr {score:.2f} dB")
+
+    if score < args.min_psnr:
+        print(f"FAILED: psnr below {args.min_psnr} dB")
+        return 1
+    print("OK")
+    return 0
+
+
+def benchmark(args):
+    template_img, user_img = load_images(args)
+
+    print(f"{'backend':<12} {'mean':>8} {'p50':>8} {'p90':>8} {'p99':>8}  (ms, {args.iterations} iterations)")
+    for backend in args.backends.split(','):
+        face_fusion = backends.create_pipeline(backend, device='cpu')
+        for _ in range(args.warmup):
+            run_fusion(face_fusion, template_img, user_img)
+
+        latencies = []
+        for _ in range(args.iterations):
+            start = time.perf_counter()
+            run_fusion(face_fusion, template_img, user_img)
+            latencies.append((time.perf_counter() - start) * 1000)
+
+        p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+        print(f"{backend:<12} {np.mean(latencies):>8.1f} {p50:>8.1f} {p90:>8.1f} {p99:>8.1f}")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export, verify and benchmark FaceChain CPU backends")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    for name in ('export', 'verify', 'benchmark'):
+        subparser = subparsers.add_parser(name)
+        subparser.add_argument('--template', required=True, help="template (target) image path")
+        subparser.add_argument('--user', required=True, help="user (source) face image path")
+
+    subparsers.choices['export'].add_argument('--backend', choices=['torchscript', 'onnx'], required=True)
+    subparsers.choices['export'].add_argument('--artifact-dir', default=backends.FACECHAIN_ARTIFACT_DIR)
+    subparsers.choices['verify'].add_argument('--backend', choices=['torchscript', 'onnx'], required=True)
+    subparsers.choices['verify'].add_argument('--min-psnr', type=float, default=40.0)
+    subparsers.choices['benchmark'].add_argument('--backends', default='torch,torchscript,onnx')
+    subparsers.choices['benchmark'].add_argument('--iterations', type=int, default=20)
+    subparsers.choices['benchmark'].add_argument('--warmup', type=int, default=3)
+
+    args = parser.parse_args()
+    if args.command == 'export':
+        export(args)
+        return 0
+    if args.command == 'verify':
+        return verify(args)
+    return benchmark(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
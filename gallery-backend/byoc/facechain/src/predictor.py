@@ -1,114 +1,149 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 import boto3
-import subprocess
 import os
 import cv2
-import argparse
-from modelscope.outputs import OutputKeys
-from modelscope.pipelines import pipeline
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from inference import FaceFusionModel, InferenceClient
+from metrics import job_id_from_key, job_timer, render_metrics
 
 app = Flask(__name__)
 s3_client = boto3.client('s3')
 
-IMAGE_FACE_FUSION = pipeline('face_fusion_torch',
-                                model='damo/cv_unet_face_fusion_torch', 
-                                model_revision='v1.0.3')
-
-def face_fusion(user_path, template_path, output_path):               
-    result = IMAGE_FACE_FUSION(dict(template=template_path, user=user_path))
-    print(f"face_fusion result: {result}")
-    
-    # 출력 디렉토리 생성
-    os.makedirs(os.path.dirname(output_path), exist_ok=True)
-    
-    # 디버깅을 위한 추가 정보 출력
-    output_img = result[OutputKeys.OUTPUT_IMG]
-    print(f"Output image shape: {output_img.shape}")
-    print(f"Output image dtype: {output_img.dtype}")
-    print(f"Output path permissions: {oct(os.stat(os.path.dirname(output_path)).st_mode)[-3:]}")
-    
-    # 이미지 저장 시도 및 결과 확인
-    success = cv2.imwrite(output_path, output_img)
-    print(f"cv2.imwrite success: {success}")
-    
-    # 파일이 실제로 생성되었는지 확인
-    if not os.path.exists(output_path):
-        raise RuntimeError(f"Image file was not created at {output_path}")
-    print(f"output_path size: {os.path.getsize(output_path)}")
+# shared: the model lives in the inference process and is shared by all gunicorn workers
+# single: the model is loaded inside this (single) worker
+MODEL_SERVER_MODE = os.environ.get('MODEL_SERVER_MODE', 'shared')
+# Report unhealthy from /ping while this many requests wait for the model (0 disables the check)
+MODEL_SERVER_MAX_QUEUE_DEPTH = int(os.environ.get('MODEL_SERVER_MAX_QUEUE_DEPTH', 0))
 
-@app.route('/ping', methods=['GET'])
-def ping():
-    health = True  # You can implement health check logic here
-    status = 200 if health else 404
-    return '', status
-
-
-@app.route('/invocations', methods=['POST'])
-def invocations():
-    input_data = request.get_json(force=True)
-
-    uuid = input_data['uuid']
-    bucket = input_data['bucket']
-    source_object_key = input_data['source']
-    target_object_key = input_data['target']
-    output_object_key = input_data['output']
-    source_path = f"/opt/program/workspace/source/{uuid}.png"
-    target_path = f"/opt/program/workspace/target/{uuid}.png"
-    output_path = f"/opt/program/workspace/output/{uuid}.png"
-
-    fetch_images(bucket, source_object_key, source_path, target_object_key, target_path)
-
-    process_images(source_path, target_path, output_path)
-    print("process_images finished")
+if MODEL_SERVER_MODE == 'shared':
+    face_fusion_model = InferenceClient()
+else:
+    face_fusion_model = FaceFusionModel()
+    face_fusion_model.start_background_load()
 
-    s3_client.upload_file(output_path, bucket, output_object_key)
-    print("upload_file finished")
+# Downloads, encodes and uploads of one request run concurrently
+io_executor = ThreadPoolExecutor(max_workers=int(os.environ.get('MODEL_SERVER_IO_THREADS', 8)))
 
-    remove_all_files(source_path, target_path, output_path)
-    print("remove_all_files finished")
 
-    return jsonify(input_data)
+def face_fusion(user_img, template_img, restore=False, restore_weight=0.5):
+    return face_fusion_model.call('fuse', template=template_img, user=user_img,
+                                  restore=restore, restore_weight=restore_weight)
 
+def face_fusion_many(user_img, template_imgs, restore=False, restore_weight=0.5):
+    return face_fusion_model.call('fuse_many', templates=template_imgs, user=user_img,
+                                  restore=restore, restore_weight=restore_weight)
 
-def fetch_images(bucket, source_object_key, source_path, target_object_key, target_path):
-    print(f"fetch_images called")
+def model_status():
+    try:
+        if MODEL_SERVER_MODE == 'shared':
+            return face_fusion_model.call('status', connect_timeout=1)
+        return face_fusion_model.call('status')
+    except Exception as e:
+        # The inference process is not accepting connections yet
+        return {'loaded': False, 'warm': False, 'error': str(e), 'in_flight': 0, 'queue_depth': 0}
 
-    source_image = get_s3_image(bucket, source_object_key)
-    target_image = get_s3_image(bucket, target_object_key)
-
-    os.makedirs(os.path.dirname(source_path), exist_ok=True)
-    with open(source_path, "wb") as file:
-        file.write(source_image)
-
-    # if file is exists in source_path, then print file size
-    if os.path.exists(source_path):
-        print(f"source_path size: {os.path.getsize(source_path)}")
-
-    os.makedirs(os.path.dirname(target_path), exist_ok=True)
-    with open(target_path, "wb") as file:
-        file.write(target_image)
-
-    # if file is exists in target_path, then print file size
-    if os.path.exists(target_path):
-        print(f"target_path size: {os.path.getsize(target_path)}")
 
+@app.route('/ping', methods=['GET'])
+def ping():
+    model = model_status()
+    health = model['loaded'] and model['warm']
+    if MODEL_SERVER_MAX_QUEUE_DEPTH > 0 and model['queue_depth'] >= MODEL_SERVER_MAX_QUEUE_DEPTH:
+        health = False
+    status = 200 if health else 503
+    return jsonify(model), status
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    # Not routed by SageMaker; scraped inside the container (e.g. by a sidecar agent or when run locally)
+    model = model_status()
+    return Response(render_metrics({
+        'in_flight': ('Requests inside the model server.', model.get('in_flight', 0)),
+        'queue_depth': ('Requests waiting for the model.', model.get('queue_depth', 0)),
+        'model_loaded': ('1 once the model is loaded.', model.get('loaded', False)),
+        'model_warm': ('1 once a warm-up inference completed.', model.get('warm', False))
+    }), mimetype='text/plain; version=0.0.4')
 
-def process_images(source_path, target_path, output_path):
-    print(f"process_images called")
-    print(f"source_path: {source_path}")
-    print(f"target_path: {target_path}")
-    print(f"output_path: {output_path}")
-    face_fusion(source_path, target_path, output_path)
 
+@app.route('/invocations', methods=['POST'])
+def invocations():
+    input_data = request.get_json(force=True)
 
-def remove_all_files(source_path, target_path, output_path):
-    os.remove(source_path)
-    os.remove(target_path)
-    os.remove(output_path)
+    bucket = input_data['bucket']
+    source_object_key = input_data['source']
+    # One source face fused into several templates: targets is a list of {uuid, target, output, metadata};
+    # the single-target form has the same fields at the top level. face-swap caps the targets of a
+    # real-time request so the fusions fit the invocation timeout.
+    targets = input_data.get('targets') or [{
+        'uuid': input_data.get('uuid'),
+        'target': input_data['target'],
+        'output': input_data['output'],
+        # Process-record fields carried forward to the result object for face-swap-completion
+        'metadata': input_data.get('metadata', {})
+    }]
+    # Optional GFPGAN post-processing on the fusion output
+    restore = str(input_data.get('restore', False)).lower() == 'true'
+    restore_weight = float(input_data.get('restore_weight', 0.5))
+
+    # face-swap sends the job ids; they are also the object names
+    job_ids = [target.get('uuid') or job_id_from_key(target['output']) for target in targets]
+    properties = {'jobs': job_ids} if len(targets) > 1 else {}
+    with job_timer('facechain', job_ids[0], restore=restore, **properties) as timer:
+        with timer.phase('fetch'):
+            source_image, target_images = fetch_images(bucket, source_object_key, [target['target'] for target in targets])
+
+        with timer.phase('decode'):
+            source_img = decode_image(source_image)
+            target_imgs = list(io_executor.map(decode_image, target_images))
+
+        # In shared mode this includes the wait for the inference process
+        with timer.phase('inference'):
+            if len(targets) == 1:
+                output_imgs = [face_fusion(source_img, target_imgs[0], restore, restore_weight)]
+            else:
+                output_imgs = face_fusion_many(source_img, target_imgs, restore, restore_weight)
+
+        with timer.phase('encode'):
+            output_images = list(io_executor.map(encode_image, output_imgs))
+
+        with timer.phase('upload'):
+            uploads = [
+                io_executor.submit(s3_client.put_object, Bucket=bucket, Key=target['output'], Body=output_image,
+                                   ContentType='image/png', Metadata=target.get('metadata', {}))
+                for target, output_image in zip(targets, output_images)
+            ]
+            for upload in uploads:
+                upload.result()
+
+    # face-swap spills over to the overflow variant when the requests waiting behind this one pile up
+    model = model_status()
+    return jsonify(dict(input_data, model_status={'in_flight': model.get('in_flight', 0), 'queue_depth': model.get('queue_depth', 0)}))
+
+
+def fetch_images(bucket, source_object_key, target_object_keys):
+    # Download the source and every target concurrently into memory
+    source_future = io_executor.submit(get_s3_image, bucket, source_object_key)
+    target_futures = [io_executor.submit(get_s3_image, bucket, key) for key in target_object_keys]
+
+    return source_future.result(), [future.result() for future in target_futures]
+
+
+def decode_image(image_bytes):
+    image = cv2.imdecode(np.frombuffer(image_bytes, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError("Could not decode image")
+    return image
+
+
+def encode_image(image):
+    success, buffer = cv2.imencode('.png', image)
+    if not success:
+        raise RuntimeError("Could not encode output image")
+    return buffer.tobytes()
 
 
 def get_s3_image(s3_bucket, object_key):
     # Retrieve the image from S3 into memory
-    print(f"get_s3_image: {s3_bucket}/{object_key}")
     response = s3_client.get_object(Bucket=s3_bucket, Key=object_key)
     return response['Body'].read()
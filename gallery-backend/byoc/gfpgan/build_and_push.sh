@@ -26,7 +26,8 @@ fi
 # Get the login command from ECR and execute it directly (for AWS ML images)
 aws ecr get-login-password --region ${region} | docker login --username AWS --password-stdin 763104351884.dkr.ecr.${region}.amazonaws.com
 
-docker build  -t ${ecr_repo_name} .
+# The build context is byoc/ so the Dockerfile can copy the shared modules in byoc/common
+docker build  -t ${ecr_repo_name} -f Dockerfile ..
 
 # Get the login command from ECR and execute it directly (for Account's images)
 aws ecr get-login-password --region ${region} | docker login --username AWS --password-stdin ${fullname}
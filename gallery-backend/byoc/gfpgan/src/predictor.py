@@ -1,70 +1,136 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 import boto3
+import cv2
+import numpy as np
 import os
-from restore import restore_face
+from metrics import job_id_from_key, job_timer, render_metrics
+from restore import encode, restore_array, restore_region, start_background_load, status as restorer_status
 
 app = Flask(__name__)
 s3_client = boto3.client('s3')
 
+# Each gunicorn worker publishes its in-flight count here so /ping can report the whole server
+INFLIGHT_DIR = os.environ.get('MODEL_SERVER_INFLIGHT_DIR', '/tmp/gfpgan-inflight')
+# Report unhealthy from /ping at this many in-flight requests (0 disables the check)
+MODEL_SERVER_MAX_IN_FLIGHT = int(os.environ.get('MODEL_SERVER_MAX_IN_FLIGHT', 0))
+in_flight = 0
 
-@app.route('/ping', methods=['GET'])
-def ping():
-    health = True  # You can implement health check logic here
-    status = 200 if health else 404
-    return '', status
+# Load the model in the background so the server starts immediately and /ping reports warm-up
+start_background_load()
 
 
-@app.route('/invocations', methods=['POST'])
-def invocations():
-    input_data = request.get_json(force=True)
+def update_in_flight(delta):
+    global in_flight
+    in_flight += delta
 
-    uuid = input_data['uuid']
-    bucket = input_data['bucket']
-    source_object_key = input_data['source']
-    output_object_key = input_data['output']
-    source_path = f"/opt/workspace/source/{uuid}.png"
-    output_path = f"/opt/workspace/output"
-    output_file_path = f"/opt/workspace/output/restored_imgs/{uuid}.png"
+    os.makedirs(INFLIGHT_DIR, exist_ok=True)
+    path = os.path.join(INFLIGHT_DIR, str(os.getpid()))
+    with open(f"{path}.tmp", 'w') as file:
+        file.write(str(in_flight))
+    os.replace(f"{path}.tmp", path)
 
-    fetch_images(bucket, source_object_key, source_path)
 
-    process_images(source_path, output_path)
+def total_in_flight():
+    total = 0
+    if not os.path.isdir(INFLIGHT_DIR):
+        return total
 
-    s3_client.upload_file(output_file_path, bucket, output_object_key)
+    for name in os.listdir(INFLIGHT_DIR):
+        if not name.isdigit():
+            continue
+        try:
+            # Skip counts left behind by workers that have exited
+            os.kill(int(name), 0)
+            with open(os.path.join(INFLIGHT_DIR, name)) as file:
+                total += int(file.read() or 0)
+        except (OSError, ValueError):
+            continue
+    return total
 
-    remove_all_files(source_path, output_file_path)
 
-    return jsonify(input_data)
+@app.route('/ping', methods=['GET'])
+def ping():
+    model = restorer_status()
+    model['in_flight'] = total_in_flight()
+
+    health = model['loaded'] and model['warm']
+    if MODEL_SERVER_MAX_IN_FLIGHT > 0 and model['in_flight'] >= MODEL_SERVER_MAX_IN_FLIGHT:
+        health = False
+    status = 200 if health else 503
+    return jsonify(model), status
+
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    # Not routed by SageMaker; scraped inside the container (e.g. by a sidecar agent or when run locally).
+    # Each worker restores on its own, so there is no model queue to report beyond the in-flight count.
+    model = restorer_status()
+    return Response(render_metrics({
+        'in_flight': ('Requests inside the model server.', total_in_flight()),
+        'model_loaded': ('1 once the model is loaded.', model['loaded']),
+        'model_warm': ('1 once the warm-up inference ran.', model['warm'])
+    }), mimetype='text/plain; version=0.0.4')
 
-def fetch_images(bucket, source_object_key, source_path):
-    print(f"fetch_images called")
 
-    source_image = get_s3_image(bucket, source_object_key)
+@app.route('/invocations', methods=['POST'])
+def invocations():
+    input_data = request.get_json(force=True)
 
-    os.makedirs(os.path.dirname(source_path), exist_ok=True)
-    with open(source_path, "wb") as file:
-        file.write(source_image)
+    bucket = input_data['bucket']
+    source_object_key = input_data['source']
+    output_object_key = input_data['output']
+    weight = float(input_data.get('weight', 0.5))
+    upscale = int(input_data.get('upscale', 2))
+    # full: restore the whole frame at `upscale`
+    # face: restore only the (padded) face region and paste it back at the original resolution
+    mode = input_data.get('mode', 'full')
+    face_box = input_data.get('face_box')  # [left, top, width, height] in source pixels
+    max_side = input_data.get('max_side')
+
+    update_in_flight(1)
+    try:
+        with job_timer('gfpgan', input_data.get('uuid') or job_id_from_key(output_object_key), mode=mode) as timer:
+            with timer.phase('fetch'):
+                source_image = get_s3_image(bucket, source_object_key)
+
+            with timer.phase('decode'):
+                source_img = decode_image(source_image, source_object_key)
+
+            with timer.phase('inference'):
+                restored_img = process_image(source_img, weight, upscale, mode, face_box, max_side)
+
+            with timer.phase('encode'):
+                restored_image = encode(restored_img)
+
+            with timer.phase('upload'):
+                s3_client.put_object(Bucket=bucket, Key=output_object_key, Body=restored_image, ContentType='image/png')
+    finally:
+        update_in_flight(-1)
 
-    # if file is exists in source_path, then print file size
-    if os.path.exists(source_path):
-        print(f"source_path size: {os.path.getsize(source_path)}")
+    return jsonify(input_data)
 
 
-def process_images(source_path, output_path):
-    os.makedirs(os.path.dirname(output_path), exist_ok=True)
-    restore_face(source_path, output_path)
-    print(f"process_images success")
+def decode_image(source_image, source_object_key):
+    image = cv2.imdecode(np.frombuffer(source_image, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError(f"Could not decode image: {source_object_key}")
+    return image
 
 
-def remove_all_files(source_path, output_path):
-    os.remove(source_path)
-    os.remove(output_path)
-    print(f"remove_all_files success")
+def process_image(source_img, weight, upscale, mode='full', face_box=None, max_side=None):
+    max_side = int(max_side) if max_side else None
+    if mode == 'face':
+        restored_image = restore_region(source_img, weight=weight, face_box=face_box, ext=None, max_side=max_side)
+    elif mode == 'full':
+        restored_image = restore_array(source_img, weight=weight, upscale=upscale, ext=None, max_side=max_side)
+    else:
+        raise ValueError(f"Unsupported restore mode: {mode}")
+    if restored_image is None:
+        raise RuntimeError("No face could be restored in the source image")
+    return restored_image
 
 
 def get_s3_image(s3_bucket, object_key):
     # Retrieve the image from S3 into memory
-    print(f"get_s3_image: {s3_bucket}/{object_key}")
     response = s3_client.get_object(Bucket=s3_bucket, Key=object_key)
     return response['Body'].read()
@@ -1,26 +1,247 @@
 import cv2
+import hashlib
+import numpy as np
 import os
-import torch
-from basicsr.utils import imwrite
+import threading
+import time
+import traceback
+import urllib.request
 from gfpgan import GFPGANer
 
-# 전역 변수로 GFPGAN 모델 설정
-MODEL_PATH = 'https://github.com/TencentARC/GFPGAN/releases/download/v1.3.0/GFPGANv1.3.pth'
-restorer = GFPGANer(
-    model_path=MODEL_PATH,
-    upscale=2,
-    arch='clean',
-    channel_multiplier=2,
-    bg_upsampler=None)
+# 모델 가중치는 이미지에 포함되거나 로컬 경로에 캐시됩니다
+#
+# Parameter                Environment Variable              Default Value
+# ---------                --------------------              -------------
+# local weights path       GFPGAN_MODEL_PATH                 /opt/program/weights/GFPGANv1.3.pth
+# download url             GFPGAN_MODEL_URL                  GFPGAN v1.3.0 GitHub release
+# expected sha256          GFPGAN_MODEL_SHA256               contents of {GFPGAN_MODEL_PATH}.sha256
+# load timeout             GFPGAN_LOAD_TIMEOUT               300 seconds
+MODEL_URL = os.environ.get('GFPGAN_MODEL_URL', 'https://github.com/TencentARC/GFPGAN/releases/download/v1.3.0/GFPGANv1.3.pth')
+MODEL_PATH = os.environ.get('GFPGAN_MODEL_PATH', '/opt/program/weights/GFPGANv1.3.pth')
+MODEL_SHA256 = os.environ.get('GFPGAN_MODEL_SHA256', '')
+LOAD_TIMEOUT = int(os.environ.get('GFPGAN_LOAD_TIMEOUT', 300))
+
+# 전역 변수로 GFPGAN 모델 설정 (load_restorer가 백그라운드에서 채움)
+restorer = None
+restorer_loaded = threading.Event()
+restorer_ready = threading.Event()
+restorer_error = None
+# Set once the model is loaded or its load failed, so callers stop waiting in either case
+restorer_load_finished = threading.Event()
+
+# GFPGANer keeps per-call state in its face helper, so calls into it must not overlap
+restorer_lock = threading.Lock()
+
+def sha256sum(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def expected_sha256(model_path):
+    if MODEL_SHA256:
+        return MODEL_SHA256
+    checksum_path = f"{model_path}.sha256"
+    if os.path.exists(checksum_path):
+        with open(checksum_path) as file:
+            return file.read().split()[0]
+    return None
+
+def ensure_model_weights(model_path=MODEL_PATH, model_url=MODEL_URL):
+    """
+    로컬 가중치 파일을 검증하고, 없거나 손상된 경우에만 다운로드하는 함수
+
+    Returns:
+        str: 검증된 가중치 파일 경로
+    """
+    checksum = expected_sha256(model_path)
+
+    if os.path.exists(model_path):
+        if checksum is None or sha256sum(model_path) == checksum:
+            print(f"Using cached GFPGAN weights: {model_path}")
+            return model_path
+        print(f"Checksum mismatch for {model_path}, downloading again")
+
+    print(f"Downloading GFPGAN weights from {model_url}")
+    os.makedirs(os.path.dirname(model_path), exist_ok=True)
+    download_path = f"{model_path}.download"
+    urllib.request.urlretrieve(model_url, download_path)
+
+    actual = sha256sum(download_path)
+    if checksum is not None and actual != checksum:
+        os.remove(download_path)
+        raise RuntimeError(f"Checksum mismatch for downloaded GFPGAN weights: {actual}")
+
+    os.replace(download_path, model_path)
+    with open(f"{model_path}.sha256", 'w') as file:
+        file.write(actual)
+    return model_path
+
+def load_restorer():
+    global restorer, restorer_error
+    try:
+        restorer = GFPGANer(
+            model_path=ensure_model_weights(),
+            upscale=2,
+            arch='clean',
+            channel_multiplier=2,
+            bg_upsampler=None)
+        restorer_loaded.set()
+        restorer_load_finished.set()
+
+        warm_up()
+        restorer_ready.set()
+        print("GFPGAN restorer loaded and warm")
+    except Exception as e:
+        restorer_error = e
+        restorer_load_finished.set()
+        traceback.print_exc()
+
+def wait_for_restorer():
+    # A failed load raises right away instead of holding the request until LOAD_TIMEOUT
+    restorer_load_finished.wait(LOAD_TIMEOUT)
+    if not restorer_loaded.is_set():
+        raise RuntimeError(f"GFPGAN restorer is not loaded: {restorer_error}")
+
+def warm_up():
+    # 정렬된 얼굴 입력으로 GFPGAN 네트워크를, 빈 프레임으로 얼굴 검출기를 한 번씩 실행
+    start = time.time()
+    with restorer_lock:
+        restorer.enhance(np.zeros((512, 512, 3), dtype=np.uint8), has_aligned=True, paste_back=False)
+        restorer.enhance(np.zeros((512, 512, 3), dtype=np.uint8), has_aligned=False, paste_back=True)
+    print(f"Warm-up took {time.time() - start:.2f}s")
+
+def start_background_load():
+    threading.Thread(target=load_restorer, daemon=True).start()
+
+def is_ready():
+    return restorer_ready.is_set()
+
+def status():
+    return {
+        'loaded': restorer_loaded.is_set(),
+        'warm': restorer_ready.is_set(),
+        'error': str(restorer_error) if restorer_error else None,
+    }
+
+def enhance(input_img, weight, upscale):
+    """Run GFPGANer.enhance under the shared lock and return the restored ndarray (or None)."""
+    wait_for_restorer()
+
+    with restorer_lock:
+        restorer.face_helper.upscale_factor = upscale
+        _, _, restored_img = restorer.enhance(
+            input_img,
+            has_aligned=False,
+            only_center_face=False,
+            paste_back=True,
+            weight=weight)
+    return restored_img
+
+def encode(img, ext='.png'):
+    success, buffer = cv2.imencode(ext, img)
+    if not success:
+        raise RuntimeError("Could not encode restored image")
+    return buffer.tobytes()
+
+def cap_size(img, max_side):
+    height, width = img.shape[:2]
+    if not max_side or max(height, width) <= max_side:
+        return img
+    scale = max_side / max(height, width)
+    return cv2.resize(img, (round(width * scale), round(height * scale)), interpolation=cv2.INTER_AREA)
+
+def restore_array(input_img, weight=0.5, upscale=2, ext='.png', max_side=None):
+    """
+    GFPGAN을 사용하여 메모리 상의 얼굴 이미지를 복원하는 함수
+
+    Args:
+        input_img (np.ndarray): BGR 입력 이미지
+        weight (float): 복원 가중치
+        upscale (int): 출력 이미지 배율
+        ext (str): 인코딩 포맷 확장자 (None이면 인코딩하지 않은 ndarray 반환)
+        max_side (int): 출력 이미지의 최대 변 길이 (None이면 제한 없음)
+
+    Returns:
+        bytes: 인코딩된 복원 이미지 (ext가 None이면 ndarray), 얼굴을 찾지 못한 경우 None
+    """
+    restored_img = enhance(input_img, weight, upscale)
+    if restored_img is None:
+        return None
+    output_img = cap_size(restored_img, max_side)
+    return encode(output_img, ext) if ext else output_img
+
+def detect_face_box(input_img, detect_side=640):
+    """
+    축소된 이미지에서 얼굴을 검출하여 모든 얼굴을 포함하는 영역을 반환하는 함수
+
+    Returns:
+        tuple: 원본 해상도 기준 (left, top, width, height), 얼굴이 없으면 None
+    """
+    height, width = input_img.shape[:2]
+    scale = min(1.0, detect_side / max(height, width))
+    small_img = cv2.resize(input_img, (round(width * scale), round(height * scale)), interpolation=cv2.INTER_AREA) if scale < 1.0 else input_img
+
+    with restorer_lock:
+        bboxes = restorer.face_helper.face_det.detect_faces(small_img, 0.97)
+    if bboxes is None or len(bboxes) == 0:
+        return None
+
+    left, top = min(b[0] for b in bboxes) / scale, min(b[1] for b in bboxes) / scale
+    right, bottom = max(b[2] for b in bboxes) / scale, max(b[3] for b in bboxes) / scale
+    return left, top, right - left, bottom - top
+
+def restore_region(input_img, weight=0.5, face_box=None, padding_ratio=0.5, ext='.png', max_side=None):
+    """
+    얼굴 영역만 잘라서 복원한 뒤 원본 해상도의 이미지에 다시 붙여넣는 함수
+
+    Args:
+        input_img (np.ndarray): BGR 입력 이미지
+        weight (float): 복원 가중치
+        face_box (tuple): 원본 기준 (left, top, width, height), None이면 축소 이미지에서 검출
+        padding_ratio (float): 얼굴 영역 주변 여백 비율
+        ext (str): 인코딩 포맷 확장자 (None이면 인코딩하지 않은 ndarray 반환)
+        max_side (int): 출력 이미지의 최대 변 길이 (None이면 제한 없음)
+
+    Returns:
+        bytes: 인코딩된 복원 이미지 (ext가 None이면 ndarray), 얼굴을 찾지 못한 경우 None
+    """
+    wait_for_restorer()
+
+    if face_box is None:
+        face_box = detect_face_box(input_img)
+        if face_box is None:
+            return None
+
+    height, width = input_img.shape[:2]
+    left, top, box_width, box_height = face_box
+    region_left = int(max(0, left - box_width * padding_ratio))
+    region_top = int(max(0, top - box_height * padding_ratio))
+    region_right = int(min(width, left + box_width * (1 + padding_ratio)))
+    region_bottom = int(min(height, top + box_height * (1 + padding_ratio)))
+    if region_right <= region_left or region_bottom <= region_top:
+        return None
+
+    # 얼굴 영역만 원본 배율(upscale=1)로 복원
+    region = np.ascontiguousarray(input_img[region_top:region_bottom, region_left:region_right])
+    restored_region = enhance(region, weight, upscale=1)
+    if restored_region is None:
+        return None
+
+    output_img = input_img.copy()
+    output_img[region_top:region_bottom, region_left:region_right] = restored_region
+    output_img = cap_size(output_img, max_side)
+    return encode(output_img, ext) if ext else output_img
 
 def restore_face(input_path, output_dir):
     """
     GFPGAN을 사용하여 얼굴 이미지를 복원하는 함수
-    
+
     Args:
         input_path (str): 입력 이미지 경로
         output_dir (str): 출력 폴더 경로
-        
+
     Returns:
         str: 복원된 이미지의 저장 경로
     """
@@ -33,17 +254,13 @@ def restore_face(input_path, output_dir):
     input_img = cv2.imread(input_path, cv2.IMREAD_COLOR)
 
     # 이미지 복원
-    _, _, restored_img = restorer.enhance(
-        input_img,
-        has_aligned=False,
-        only_center_face=False,
-        paste_back=True,
-        weight=0.5)
+    restored_bytes = restore_array(input_img, weight=0.5)
 
     # 결과 저장
     save_restore_path = None
-    if restored_img is not None:
+    if restored_bytes is not None:
         save_restore_path = os.path.join(output_dir, 'restored_imgs', f'{basename}.png')
-        imwrite(restored_img, save_restore_path)
-    
-    return save_restore_path
\ No newline at end of file
+        with open(save_restore_path, 'wb') as file:
+            file.write(restored_bytes)
+
+    return save_restore_path
@@ -0,0 +1,369 @@
+# In-memory stand-ins for the AWS clients used by the gallery Lambda handlers.
+#
+# They implement only the calls (and the expression syntax) the handlers make, and are installed
+# with gallery_runtime.set_client, so the handler code runs unchanged. Every call sleeps for
+# latency_ms to approximate the round trip to the real service.
+
+import copy
+import fnmatch
+import io
+import json
+import random
+import re
+import threading
+import time
+import urllib.parse
+from botocore.exceptions import ClientError
+from gallery_runtime import job_timer
+
+
+def client_error(code, message, operation_name, **extra):
+    return ClientError({'Error': {'Code': code, 'Message': message}, **extra}, operation_name)
+
+
+class FakeS3:
+    """
+    Objects in memory; listeners are called like S3 notifications after every write whose event type
+    (s3:ObjectCreated:Put or s3:ObjectCreated:Copy) matches one of the subscribed events.
+    """
+
+    def __init__(self, latency_ms=0, events=('s3:ObjectCreated:*',)):
+        self.latency_ms = latency_ms
+        self.events = list(events)
+        self.objects = {}
+        self.listeners = []
+        # presigned PUT url -> signed request parameters
+        self.signed_uploads = {}
+        self.lock = threading.Lock()
+
+    def sleep(self):
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000)
+
+    def notify(self, bucket_name, object_key, event_name):
+        if not any(fnmatch.fnmatchcase(event_name, event) for event in self.events):
+            return
+        for listener in self.listeners:
+            listener(bucket_name, object_key)
+
+    def put_object(self, Bucket, Key, Body, ContentType='binary/octet-stream', Metadata=None):
+        self.sleep()
+        if isinstance(Body, str):
+            Body = Body.encode('utf-8')
+        with self.lock:
+            self.objects[(Bucket, Key)] = {'Body': bytes(Body), 'ContentType': ContentType, 'Metadata': dict(Metadata or {})}
+        self.notify(Bucket, Key, 's3:ObjectCreated:Put')
+        return {'ETag': f'"{hash(Body) & 0xffffffff:08x}"'}
+
+    def get_stored_object(self, bucket_name, object_key, operation_name):
+        with self.lock:
+            stored = self.objects.get((bucket_name, object_key))
+        if stored is None:
+            # head_object reports a bare 404, like the real API
+            code = '404' if operation_name == 'HeadObject' else 'NoSuchKey'
+            raise client_error(code, f'{object_key} does not exist', operation_name)
+        return stored
+
+    def get_object(self, Bucket, Key):
+        self.sleep()
+        stored = self.get_stored_object(Bucket, Key, 'GetObject')
+        return {
+            'Body': io.BytesIO(stored['Body']),
+            'ContentType': stored['ContentType'],
+            'ContentLength': len(stored['Body']),
+            'Metadata': dict(stored['Metadata'])
+        }
+
+    def head_object(self, Bucket, Key):
+        self.sleep()
+        stored = self.get_stored_object(Bucket, Key, 'HeadObject')
+        return {'ContentType': stored['ContentType'], 'ContentLength': len(stored['Body']), 'Metadata': dict(stored['Metadata'])}
+
+    def copy_object(self, Bucket, Key, CopySource, ContentType=None, Metadata=None, MetadataDirective='COPY'):
+        self.sleep()
+        stored = self.get_stored_object(CopySource['Bucket'], CopySource['Key'], 'CopyObject')
+        with self.lock:
+            self.objects[(Bucket, Key)] = {
+                'Body': stored['Body'],
+                'ContentType': ContentType or stored['ContentType'],
+                'Metadata': dict(Metadata or {}) if MetadataDirective == 'REPLACE' else dict(stored['Metadata'])
+            }
+        self.notify(Bucket, Key, 's3:ObjectCreated:Copy')
+        return {}
+
+    def generate_presigned_url(self, ClientMethod, Params, ExpiresIn=3600):
+        # Signing is local in the real SDK as well, so there is no latency here
+        url = f"https://{Params['Bucket']}.s3.emulator/{urllib.parse.quote(Params['Key'])}?X-Amz-Expires={ExpiresIn}&X-Amz-Nonce={random.getrandbits(32):08x}"
+        if ClientMethod == 'put_object':
+            with self.lock:
+                self.signed_uploads[url] = Params
+        return url
+
+    def upload_presigned(self, url, body, headers):
+        """PUT body to a presigned upload url; S3 rejects uploads whose signed headers differ."""
+        with self.lock:
+            params = self.signed_uploads.pop(url)
+        metadata = {key[len('x-amz-meta-'):]: value for key, value in headers.items() if key.startswith('x-amz-meta-')}
+        if metadata != params.get('Metadata', {}) or headers.get('Content-Type') != params.get('ContentType'):
+            raise client_error('SignatureDoesNotMatch', 'Signed headers do not match the request', 'PutObject')
+        return self.put_object(Bucket=params['Bucket'], Key=params['Key'], Body=body,
+                               ContentType=params.get('ContentType'), Metadata=metadata)
+
+
+class FakeSQS:
+    """Hands the records of every sent message to the listener registered for its queue url."""
+
+    def __init__(self, latency_ms=0):
+        self.latency_ms = latency_ms
+        self.listeners = {}
+
+    def send_message(self, QueueUrl, MessageBody):
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000)
+        for record in json.loads(MessageBody).get('Records', []):
+            self.listeners[QueueUrl](record)
+        return {'MessageId': f'{random.getrandbits(64):016x}'}
+
+
+def typed_value(value):
+    (kind, inner), = value.items()
+    return float(inner) if kind == 'N' else inner
+
+
+class FakeDynamoDB:
+    """Tables keyed by PK (and SK when the item has one), with the expression subset the handlers use."""
+
+    def __init__(self, latency_ms=0):
+        self.latency_ms = latency_ms
+        # table name -> {(PK, SK): item}
+        self.tables = {}
+        self.lock = threading.Lock()
+
+    def sleep(self):
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000)
+
+    def table(self, table_name):
+        return self.tables.setdefault(table_name, {})
+
+    @staticmethod
+    def item_key(key):
+        return key['PK']['S'], key.get('SK', {}).get('S')
+
+    @staticmethod
+    def resolve(path, names):
+        return [names.get(part, part) for part in path.strip().split('.')]
+
+    @staticmethod
+    def get_path(item, path):
+        value = {'M': item}
+        for part in path:
+            value = (value or {}).get('M', {}).get(part)
+        return value
+
+    def evaluate(self, expression, item, names, values):
+        # OR of ANDs of: attribute_exists(path), attribute_not_exists(path), begins_with(path, :v), path <op> :v
+        for clause in re.split(r'\s+OR\s+', expression.strip()):
+            if all(self.evaluate_term(term, item, names, values) for term in re.split(r'\s+AND\s+', clause)):
+                return True
+        return False
+
+    def evaluate_term(self, term, item, names, values):
+        term = term.strip()
+        function = re.match(r'(attribute_exists|attribute_not_exists|begins_with)\(([^,)]+)(?:,\s*(:\w+))?\)$', term)
+        if function:
+            name, path, value_name = function.groups()
+            value = self.get_path(item, self.resolve(path, names))
+            if name == 'attribute_exists':
+                return value is not None
+            if name == 'attribute_not_exists':
+                return value is None
+            return value is not None and typed_value(value).startswith(typed_value(values[value_name]))
+
+        path, operator, value_name = re.match(r'(\S+)\s*(<=|>=|<>|=|<|>)\s*(:\w+)$', term).groups()
+        value = self.get_path(item, self.resolve(path, names))
+        if value is None:
+            return operator == '<>'
+        left, right = typed_value(value), typed_value(values[value_name])
+        return {
+            '=': left == right, '<>': left != right, '<': left < right,
+            '<=': left <= right, '>': left > right, '>=': left >= right
+        }[operator]
+
+    def get_item(self, TableName, Key, ProjectionExpression=None, ExpressionAttributeNames=None):
+        # Projections are not applied; the handlers only read the attributes they project
+        self.sleep()
+        with self.lock:
+            item = self.table(TableName).get(self.item_key(Key))
+            return {'Item': copy.deepcopy(item)} if item is not None else {}
+
+    def put_item(self, TableName, Item, ConditionExpression=None, ExpressionAttributeNames=None,
+                 ExpressionAttributeValues=None, ReturnValuesOnConditionCheckFailure=None):
+        self.sleep()
+        key = self.item_key(Item)
+        with self.lock:
+            table = self.table(TableName)
+            existing = table.get(key)
+            if ConditionExpression and not self.evaluate(ConditionExpression, existing or {}, ExpressionAttributeNames or {}, ExpressionAttributeValues or {}):
+                extra = {'Item': copy.deepcopy(existing)} if existing and ReturnValuesOnConditionCheckFailure == 'ALL_OLD' else {}
+                raise client_error('ConditionalCheckFailedException', 'The conditional request failed', 'PutItem', **extra)
+            table[key] = copy.deepcopy(Item)
+        return {}
+
+    @staticmethod
+    def split_top_level(expression):
+        parts, depth, current = [], 0, ''
+        for char in expression:
+            depth += char == '('
+            depth -= char == ')'
+            if char == ',' and depth == 0:
+                parts.append(current)
+                current = ''
+            else:
+                current += char
+        return [part.strip() for part in parts + [current] if part.strip()]
+
+    def update_item(self, TableName, Key, UpdateExpression, ConditionExpression=None, ExpressionAttributeNames=None,
+                    ExpressionAttributeValues=None):
+        self.sleep()
+        names = ExpressionAttributeNames or {}
+        values = ExpressionAttributeValues or {}
+        with self.lock:
+            table = self.table(TableName)
+            if ConditionExpression and not self.evaluate(ConditionExpression, table.get(self.item_key(Key)) or {}, names, values):
+                raise client_error('ConditionalCheckFailedException', 'The conditional request failed', 'UpdateItem')
+            item = table.setdefault(self.item_key(Key), copy.deepcopy(Key))
+            for action, body in re.findall(r'\b(SET|REMOVE)\s+(.*?)(?=\s+\b(?:SET|REMOVE)\b|$)', UpdateExpression):
+                for part in self.split_top_level(body):
+                    if action == 'REMOVE':
+                        *parents, leaf = self.resolve(part, names)
+                        parent = self.get_path(item, parents) if parents else {'M': item}
+                        (parent or {}).get('M', {}).pop(leaf, None)
+                        continue
+
+                    path, expression = [side.strip() for side in part.split('=', 1)]
+                    if_not_exists = re.match(r'if_not_exists\(([^,]+),\s*(:\w+)\)$', expression)
+                    if if_not_exists:
+                        existing = self.get_path(item, self.resolve(if_not_exists.group(1), names))
+                        value = existing if existing is not None else values[if_not_exists.group(2)]
+                    else:
+                        value = values[expression]
+
+                    *parents, leaf = self.resolve(path, names)
+                    parent = self.get_path(item, parents) if parents else {'M': item}
+                    if parent is None:
+                        raise client_error('ValidationException', 'The document path provided in the update expression is invalid for update', 'UpdateItem')
+                    parent['M'][leaf] = copy.deepcopy(value)
+        return {}
+
+    def query(self, TableName, KeyConditionExpression, ExpressionAttributeNames=None, ExpressionAttributeValues=None,
+              ScanIndexForward=True, Limit=None, ExclusiveStartKey=None):
+        self.sleep()
+        names = ExpressionAttributeNames or {}
+        values = ExpressionAttributeValues or {}
+        with self.lock:
+            matches = [
+                copy.deepcopy(item) for item in self.table(TableName).values()
+                if self.evaluate(KeyConditionExpression, item, names, values)
+            ]
+        matches.sort(key=lambda item: item.get('SK', {}).get('S', ''), reverse=not ScanIndexForward)
+        if ExclusiveStartKey:
+            start_sort_key = ExclusiveStartKey['SK']['S']
+            matches = [item for item in matches if (item['SK']['S'] < start_sort_key if not ScanIndexForward else item['SK']['S'] > start_sort_key)]
+
+        response = {'Items': matches[:Limit] if Limit else matches}
+        response['Count'] = len(response['Items'])
+        if Limit and len(matches) > Limit:
+            last_item = response['Items'][-1]
+            response['LastEvaluatedKey'] = {key: last_item[key] for key in ('PK', 'SK') if key in last_item}
+        return response
+
+
+class FakeRekognition:
+    """Finds one face in the middle of every image, with a fixed confidence."""
+
+    def __init__(self, latency_ms=0, box=(0.35, 0.25, 0.3, 0.4), confidence=99.9):
+        self.latency_ms = latency_ms
+        self.box = box
+        self.confidence = confidence
+
+    def detect_faces(self, Image, Attributes=None):
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000)
+        left, top, width, height = self.box
+        return {'FaceDetails': [{
+            'BoundingBox': {'Left': left, 'Top': top, 'Width': width, 'Height': height},
+            'Confidence': self.confidence
+        }]}
+
+
+class StubPredictor:
+    """
+    Stands in for the FaceChain endpoint: reads the source and target objects, holds one of
+    `instances` model slots for a latency drawn around latency_ms, and writes the target image
+    as the result with the request metadata, like byoc/facechain/src/predictor.py.
+    """
+
+    def __init__(self, s3, latency_ms=2500, jitter_ms=0, instances=1, on_inference=None):
+        self.s3 = s3
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.slots = threading.BoundedSemaphore(instances)
+        # Requests waiting for a model slot, reported back like the container's queue_depth
+        self.waiting = 0
+        self.lock = threading.Lock()
+        # on_inference(request, queued_at, started_at, finished_at)
+        self.on_inference = on_inference
+
+    def invoke_endpoint(self, EndpointName, Body, ContentType='application/json', **kwargs):
+        request = json.loads(Body)
+        # Multi-template requests take a model slot per fusion, one latency draw per target
+        targets = request.get('targets') or [request]
+        properties = {'jobs': [target['uuid'] for target in targets]} if len(targets) > 1 else {}
+        # Same timing line as the container's predictor
+        with job_timer('facechain', targets[0]['uuid'], restore=request.get('restore', False), **properties) as timer:
+            queued_at = time.time()
+            with timer.phase('fetch'):
+                self.s3.get_object(Bucket=request['bucket'], Key=request['source'])['Body'].read()
+                target_images = [self.s3.get_object(Bucket=request['bucket'], Key=target['target'])['Body'].read() for target in targets]
+
+            with timer.phase('inference'):
+                for target in targets:
+                    with self.lock:
+                        self.waiting += 1
+                    with self.slots:
+                        with self.lock:
+                            self.waiting -= 1
+                        started_at = time.time()
+                        time.sleep(max(0.0, random.gauss(self.latency_ms, self.jitter_ms)) / 1000)
+                        finished_at = time.time()
+                    if self.on_inference:
+                        self.on_inference(target, queued_at, started_at, finished_at)
+
+            with timer.phase('upload'):
+                for target, target_image in zip(targets, target_images):
+                    self.s3.put_object(Bucket=request['bucket'], Key=target['output'], Body=target_image,
+                                       ContentType='image/png', Metadata=target.get('metadata', {}))
+        response = dict(request, model_status={'in_flight': 0, 'queue_depth': self.waiting})
+        return {'Body': io.BytesIO(json.dumps(response).encode('utf-8')), 'ContentType': 'application/json'}
+
+
+class StubEndpoint:
+    """
+    An endpoint with several StubPredictor variants. Requests without a TargetVariant go to the
+    primary (the only variant with a weight), like the FaceChain endpoint with an overflow variant.
+    """
+
+    def __init__(self, variants, primary_variant, on_invoke=None):
+        self.variants = variants
+        self.primary_variant = primary_variant
+        # on_invoke(variant_name)
+        self.on_invoke = on_invoke
+
+    def invoke_endpoint(self, EndpointName, Body, ContentType='application/json', TargetVariant=None, **kwargs):
+        variant_name = TargetVariant or self.primary_variant
+        if variant_name not in self.variants:
+            raise client_error('ValidationError', f'Variant {variant_name} does not exist', 'InvokeEndpoint')
+        if self.on_invoke:
+            self.on_invoke(variant_name)
+        return self.variants[variant_name].invoke_endpoint(EndpointName, Body, ContentType)
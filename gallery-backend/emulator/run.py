@@ -0,0 +1,470 @@
+#!/usr/bin/env python
+# Run the whole gallery pipeline locally and report latency percentiles.
+#
+# The real handler code runs against in-memory S3/DynamoDB/Rekognition stand-ins (fakes.py), with a
+# stub FaceChain predictor that sleeps instead of running the model:
+#
+#   visitor -> put-image -> presigned upload -> face-crop -> face-swap -> predictor
+#           -> face-swap-completion -> get-job-status (polled) -> get-image
+#
+# Every stage has an emulated SQS event source with the batch size, batching window and maximum
+# concurrency the CDK stack uses (overridable with the same context keys, e.g. -c face_swap_batch_size=1).
+# Uploads reach face-crop through the bucket notification; face-crop and face-swap queue the next
+# stage themselves, with the job's metadata in the message. Run it from gallery-backend/:
+#
+#   python emulator/run.py --visitors 50 --concurrency 10
+#   python emulator/run.py --visitors 100 --predictor-ms 2500 --endpoint-instances 2 -c face_swap_max_concurrency=4
+#   python emulator/run.py --visitors 20 --duplicate-ratio 0.5 --json /tmp/run.json
+#   python emulator/run.py --visitors 20 --duplicate-ratio 0.5 --notify-results
+#   python emulator/run.py --visitors 20 --themes-per-visit 3
+#   python emulator/run.py --visitors 50 --overflow-instances 2 --overflow-ms 6000 -c facechain_spillover_queue_depth=1
+#   python emulator/run.py --visitors 20 --log /tmp/run.log && python tools/pipeline_waterfall.py /tmp/run.log
+#
+# Requires boto3 (botocore) and Pillow, the same packages the handlers import.
+
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import queue
+import random
+import statistics
+import sys
+import threading
+import time
+import urllib.parse
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+EMULATOR_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.dirname(EMULATOR_DIR)
+LAMBDA_DIR = os.path.join(BACKEND_DIR, 'lambda')
+sys.path.insert(0, os.path.join(LAMBDA_DIR, 'layers', 'gallery-runtime', 'python'))
+
+from fakes import FakeDynamoDB, FakeRekognition, FakeS3, FakeSQS, StubEndpoint, StubPredictor
+import gallery_runtime
+
+BUCKET_NAME = 'emulator-gallery-bucket'
+ENVIRONMENT = {
+    'AWS_DEFAULT_REGION': 'us-east-1',
+    'BUCKET_NAME': BUCKET_NAME,
+    'OBJECT_PATH': 'images/',
+    'FACE_CROPPED_OBJECT_PATH': 'face-cropped/',
+    'RESULT_OBJECT_PATH': 'result/',
+    'FACECHAIN_SAGEMAKER_ENDPOINT_NAME': 'emulator-facechain-endpoint',
+    'DDB_AMAZON_BEDROCK_GALLERY_PROCESS_TABLE_NAME': 'emulator-process',
+    'DDB_AMAZON_BEDROCK_GALLERY_DISPLAY_TABLE_NAME': 'emulator-display',
+    'DDB_AMAZON_BEDROCK_GALLERY_DISPLAY_FEED_TABLE_NAME': 'emulator-display-feed',
+    'DDB_AMAZON_BEDROCK_GALLERY_BASE_RESOURCE_TABLE_NAME': 'emulator-base-resource',
+    'FACE_SWAP_QUEUE_URL': 'emulator-queue/face-swap',
+    'FACE_SWAP_COMPLETION_QUEUE_URL': 'emulator-queue/face-swap-completion',
+}
+
+# Same defaults as LambdaImageProcessingStack.create_stage_queue; a prefix means the stage is fed by
+# the bucket notification, a queue url that the previous stage sends to it
+STAGES = {
+    'face_crop': {'handler': 'image-processing/face-crop', 'prefix': ENVIRONMENT['OBJECT_PATH'],
+                  'batch_size': 10, 'max_batching_window': 1, 'max_concurrency': 10},
+    'face_swap': {'handler': 'image-processing/face-swap', 'queue_url': ENVIRONMENT['FACE_SWAP_QUEUE_URL'],
+                  'batch_size': 4, 'max_batching_window': 1, 'max_concurrency': 2},
+    'face_swap_completion': {'handler': 'image-processing/face-swap-completion', 'queue_url': ENVIRONMENT['FACE_SWAP_COMPLETION_QUEUE_URL'],
+                             'batch_size': 10, 'max_batching_window': 1, 'max_concurrency': 5},
+}
+# Context keys of the image-processing stack that end up as face-swap environment variables
+FACE_SWAP_CONTEXT = {
+    'facechain_max_targets_per_invocation': 'FACECHAIN_MAX_TARGETS_PER_INVOCATION',
+    'facechain_spillover_queue_depth': 'FACECHAIN_SPILLOVER_QUEUE_DEPTH',
+    'facechain_spillover_latency_ms': 'FACECHAIN_SPILLOVER_LATENCY_MS',
+    'facechain_spillover_hold_seconds': 'FACECHAIN_SPILLOVER_HOLD_SECONDS',
+}
+# Same as NOTIFICATION_EVENTS in the image-processing stack
+NOTIFICATION_EVENTS = ['s3:ObjectCreated:*']
+PRIMARY_VARIANT = 'FaceChainVariant'
+OVERFLOW_VARIANT = 'FaceChainOverflowVariant'
+# SQS redrive policy of the stage queues
+MAX_RECEIVE_COUNT = 3
+
+THEMES = ['spring', 'summer', 'autumn', 'winter']
+GENDERS = ['male', 'female']
+SKINS = ['light', 'dark']
+
+
+def load_handler(relative_path):
+    # Every handler is an index.py, so each gets its own module name; face-crop also imports detectors.py
+    handler_dir = os.path.join(LAMBDA_DIR, relative_path)
+    sys.path.insert(0, handler_dir)
+    module_name = 'emulated_' + os.path.basename(relative_path).replace('-', '_')
+    spec = importlib.util.spec_from_file_location(module_name, os.path.join(handler_dir, 'index.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    sys.path.remove(handler_dir)
+    return module
+
+
+def job_id_of(object_key):
+    return os.path.splitext(os.path.basename(object_key))[0]
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+class Timeline:
+    """Phase durations per job, in milliseconds."""
+
+    def __init__(self):
+        self.phases = defaultdict(dict)
+        self.counters = defaultdict(int)
+        self.lock = threading.Lock()
+
+    def record(self, job_id, phase, started_at, finished_at):
+        with self.lock:
+            self.phases[phase][job_id] = (finished_at - started_at) * 1000
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+
+    def summary(self):
+        return {
+            phase: {
+                'count': len(durations),
+                'mean': statistics.mean(durations.values()),
+                'p50': percentile(durations.values(), 0.5),
+                'p90': percentile(durations.values(), 0.9),
+                'p99': percentile(durations.values(), 0.99),
+                'max': max(durations.values())
+            }
+            for phase, durations in self.phases.items() if durations
+        }
+
+
+class StageEventSource:
+    """
+    An SQS queue and Lambda event source for one stage: S3 notifications are queued as messages,
+    and up to max_concurrency pollers each collect up to batch_size messages (waiting at most
+    max_batching_window seconds for a full batch) and invoke the handler with them.
+    """
+
+    def __init__(self, name, handler, timeline, batch_size, max_batching_window, max_concurrency):
+        self.name = name
+        self.handler = handler
+        self.timeline = timeline
+        self.batch_size = batch_size
+        self.max_batching_window = max_batching_window
+        self.messages = queue.Queue()
+        self.stopped = threading.Event()
+        self.pollers = [threading.Thread(target=self.poll, daemon=True) for _ in range(max_concurrency)]
+        for poller in self.pollers:
+            poller.start()
+
+    def send(self, bucket_name, object_key, receive_count=0, sent_at=None, metadata=None):
+        # A retried message keeps the time of the original notification
+        sent_at = sent_at or time.time()
+        s3_record = {
+            'eventSource': 'aws:s3',
+            'eventTime': datetime.fromtimestamp(sent_at, timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
+            's3': {'bucket': {'name': bucket_name}, 'object': {'key': urllib.parse.quote_plus(object_key)}}
+        }
+        if metadata is not None:
+            s3_record['metadata'] = metadata
+        self.messages.put({
+            'messageId': str(uuid.uuid4()),
+            'eventSource': 'aws:sqs',
+            'body': json.dumps({'Records': [s3_record]}),
+            'object_key': object_key,
+            'metadata': metadata,
+            'receive_count': receive_count,
+            'sent_at': sent_at
+        })
+
+    def receive_batch(self):
+        try:
+            batch = [self.messages.get(timeout=0.1)]
+        except queue.Empty:
+            return []
+        deadline = time.time() + self.max_batching_window
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.messages.get(timeout=max(0.0, deadline - time.time())))
+            except queue.Empty:
+                break
+        return batch
+
+    def poll(self):
+        while not self.stopped.is_set():
+            batch = self.receive_batch()
+            if not batch:
+                continue
+
+            started_at = time.time()
+            event = {'Records': [
+                dict({key: message[key] for key in ('messageId', 'eventSource', 'body')},
+                     attributes={'ApproximateReceiveCount': str(message['receive_count'] + 1)})
+                for message in batch
+            ]}
+            try:
+                result = self.handler.lambda_handler(event, None) or {}
+                failed = {failure['itemIdentifier'] for failure in result.get('batchItemFailures', [])}
+                if result.get('deduplicated'):
+                    # face-crop answered these jobs from an earlier result
+                    self.timeline.count(f'{self.name}_deduplicated', len(result['deduplicated']))
+            except Exception as e:
+                # An unhandled error fails the whole batch
+                print(f"{self.name} error: {e}", file=sys.__stderr__)
+                failed = {message['messageId'] for message in batch}
+            finished_at = time.time()
+
+            self.timeline.count(f'{self.name}_invocations')
+            for message in batch:
+                job_id = job_id_of(message['object_key'])
+                self.timeline.record(job_id, f'{self.name}_queue_wait', message['sent_at'], started_at)
+                self.timeline.record(job_id, self.name, started_at, finished_at)
+                if message['messageId'] not in failed:
+                    continue
+                if message['receive_count'] + 1 >= MAX_RECEIVE_COUNT:
+                    self.timeline.count(f'{self.name}_dead_lettered')
+                else:
+                    self.timeline.count(f'{self.name}_retries')
+                    self.send(BUCKET_NAME, message['object_key'], message['receive_count'] + 1, message['sent_at'], message['metadata'])
+
+    def stop(self):
+        self.stopped.set()
+        for poller in self.pollers:
+            poller.join()
+
+
+def synthetic_photo(rng, width=1600, height=1200):
+    # Random blocks rather than a flat face, so every visitor's face crop hashes differently
+    from PIL import Image, ImageDraw
+
+    image = Image.new('RGB', (width, height), tuple(rng.randrange(256) for _ in range(3)))
+    draw = ImageDraw.Draw(image)
+    for _ in range(40):
+        left, top = rng.randrange(width), rng.randrange(height)
+        draw.rectangle([left, top, left + rng.randrange(40, 400), top + rng.randrange(40, 400)],
+                       fill=tuple(rng.randrange(256) for _ in range(3)))
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', quality=90)
+    return buffer.getvalue()
+
+
+def seed_base_resources(s3, ddb, rng):
+    photo = synthetic_photo(rng, 1024, 1024)
+    for theme in THEMES:
+        for gender in GENDERS:
+            for skin in SKINS:
+                base_image_object_key = f'base/{theme}-{gender}-{skin}.jpeg'
+                s3.objects[(BUCKET_NAME, base_image_object_key)] = {'Body': photo, 'ContentType': 'image/jpeg', 'Metadata': {}}
+                ddb.table(ENVIRONMENT['DDB_AMAZON_BEDROCK_GALLERY_BASE_RESOURCE_TABLE_NAME'])[(f'#THEME#{theme}#GENDER#{gender}#SKIN#{skin}', None)] = {
+                    'PK': {'S': f'#THEME#{theme}#GENDER#{gender}#SKIN#{skin}'},
+                    'base_image_object_key': {'S': base_image_object_key},
+                    'story': {'S': f'A {theme} portrait.'}
+                }
+
+
+class Visitor:
+    """One kiosk visit: request an upload URL, upload the photo, poll the job until the result shows."""
+
+    def __init__(self, apis, s3, timeline, poll_interval, timeout, themes_per_visit=1):
+        self.apis = apis
+        self.themes_per_visit = themes_per_visit
+        self.s3 = s3
+        self.timeline = timeline
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        # user id -> job ids of all the visits of that user
+        self.user_jobs = defaultdict(set)
+
+    def call(self, api, method, **event):
+        response = self.apis[api].lambda_handler({'httpMethod': method, **event}, None)
+        body = json.loads(response['body']) if response.get('body') else {}
+        if response['statusCode'] >= 400:
+            raise Exception(f"{api} returned {response['statusCode']}: {body}")
+        return body
+
+    def visit(self, user_id, theme, gender, skin, photo):
+        started_at = time.time()
+        request = {'userId': user_id, 'theme': theme, 'gender': gender, 'skin': skin}
+        if self.themes_per_visit > 1:
+            # The visitor's theme first, then the next themes in order
+            offset = THEMES.index(theme)
+            request['themes'] = [THEMES[(offset + index) % len(THEMES)] for index in range(self.themes_per_visit)]
+        upload = self.call('put-image', 'POST', body=json.dumps(request))
+        job_id = upload['jobId']
+        self.user_jobs[user_id].update(job['jobId'] for job in upload['jobs'])
+        requested_at = time.time()
+        self.timeline.record(job_id, 'put_image_api', started_at, requested_at)
+
+        self.s3.upload_presigned(upload['uploadUrl'], photo, upload['uploadHeaders'])
+        uploaded_at = time.time()
+        self.timeline.record(job_id, 'upload', requested_at, uploaded_at)
+
+        deadline = uploaded_at + self.timeout
+        for job in upload['jobs']:
+            if not self.wait_for_job(job['jobId'], deadline):
+                self.timeline.count('jobs_failed')
+                return job_id
+            if job['jobId'] != job_id:
+                self.timeline.count('sibling_jobs_completed')
+        completed_at = time.time()
+        self.timeline.record(job_id, 'upload_to_completed', uploaded_at, completed_at)
+
+        display = self.call('get-image', 'GET', pathParameters={'userId': user_id})
+        finished_at = time.time()
+        # With several themes, or a repeated visit of the same user, the display shows the newest completed job
+        if display.get('uuid') not in self.user_jobs[user_id]:
+            raise Exception(f"get-image shows {display.get('uuid')} instead of {job_id}")
+        self.timeline.record(job_id, 'end_to_end', started_at, finished_at)
+        self.timeline.count('jobs_completed')
+        return job_id
+
+    def wait_for_job(self, job_id, deadline):
+        while time.time() < deadline:
+            status = self.call('get-job-status', 'GET', pathParameters={'jobId': job_id}, queryStringParameters={})
+            if status['status'] in ('COMPLETED', 'FAILED'):
+                return status['status'] == 'COMPLETED'
+            time.sleep(self.poll_interval)
+        return False
+
+
+def parse_context(values):
+    context = {}
+    for value in values or []:
+        key, _, setting = value.partition('=')
+        context[key] = float(setting) if '.' in setting else int(setting)
+    return context
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the gallery pipeline locally against in-memory AWS stand-ins.')
+    parser.add_argument('--visitors', type=int, default=20, help='number of visits to run')
+    parser.add_argument('--concurrency', type=int, default=5, help='visits in progress at the same time')
+    parser.add_argument('--duplicate-ratio', type=float, default=0.0, help='share of visits that re-upload an earlier photo')
+    parser.add_argument('--predictor-ms', type=float, default=2500, help='stub model latency per request')
+    parser.add_argument('--predictor-jitter-ms', type=float, default=250)
+    parser.add_argument('--endpoint-instances', type=int, default=1, help='requests the endpoint runs at the same time')
+    parser.add_argument('--aws-latency-ms', type=float, default=5, help='round trip added to every S3/DynamoDB/Rekognition call')
+    parser.add_argument('--poll-ms', type=float, default=250, help='get-job-status polling interval')
+    parser.add_argument('--timeout', type=float, default=300, help='seconds a visit waits for its result')
+    parser.add_argument('-c', '--context', action='append', metavar='KEY=VALUE',
+                        help='stage event source or spillover setting, e.g. face_swap_batch_size=1 (CDK context key names)')
+    parser.add_argument('--themes-per-visit', type=int, default=1, help='themes requested with one upload')
+    parser.add_argument('--notify-results', action='store_true',
+                        help='deliver results to face-swap-completion through the bucket notification, as with an async endpoint')
+    parser.add_argument('--overflow-instances', type=int, default=0, help='add an overflow variant with this many model slots')
+    parser.add_argument('--overflow-ms', type=float, default=6000, help='stub model latency of the overflow variant')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='also write the summary to this file')
+    parser.add_argument('--verbose', action='store_true', help='show handler logs')
+    parser.add_argument('--log', help='write handler logs (including the timing lines for tools/pipeline_waterfall.py) to this file')
+    args = parser.parse_args()
+
+    os.environ.update(ENVIRONMENT)
+    if args.notify_results:
+        # face-swap and face-crop leave the completion to the notification of the result (Put) or the
+        # deduplicated copy (Copy), as they do with an async endpoint
+        del os.environ['FACE_SWAP_COMPLETION_QUEUE_URL']
+        STAGES['face_swap_completion']['prefix'] = ENVIRONMENT['RESULT_OBJECT_PATH']
+    context = parse_context(args.context)
+    os.environ.update({name: str(context[key]) for key, name in FACE_SWAP_CONTEXT.items() if key in context})
+    os.environ['FACECHAIN_OVERFLOW_VARIANT'] = OVERFLOW_VARIANT if args.overflow_instances > 0 else ''
+    rng = random.Random(args.seed)
+    timeline = Timeline()
+
+    s3 = FakeS3(args.aws_latency_ms, NOTIFICATION_EVENTS)
+    ddb = FakeDynamoDB(args.aws_latency_ms)
+    def on_inference(request, queued_at, started_at, finished_at):
+        timeline.record(request['uuid'], 'predictor_wait', queued_at, started_at)
+        timeline.record(request['uuid'], 'predictor', started_at, finished_at)
+
+    variants = {PRIMARY_VARIANT: StubPredictor(s3, args.predictor_ms, args.predictor_jitter_ms, args.endpoint_instances, on_inference)}
+    if args.overflow_instances > 0:
+        variants[OVERFLOW_VARIANT] = StubPredictor(s3, args.overflow_ms, args.predictor_jitter_ms, args.overflow_instances, on_inference)
+    endpoint = StubEndpoint(variants, PRIMARY_VARIANT, on_invoke=lambda variant_name: timeline.count(f'{variant_name}_invocations'))
+    gallery_runtime.set_client('s3', s3)
+    gallery_runtime.set_client('dynamodb', ddb)
+    gallery_runtime.set_client('rekognition', FakeRekognition(args.aws_latency_ms * 20))
+    gallery_runtime.set_client('sagemaker-runtime', endpoint)
+    sqs = FakeSQS(args.aws_latency_ms)
+    gallery_runtime.set_client('sqs', sqs)
+    seed_base_resources(s3, ddb, rng)
+
+    apis = {name: load_handler(f'apis/{name}') for name in ('put-image', 'get-job-status', 'get-image')}
+    sources = {}
+    for name, stage in STAGES.items():
+        settings = {key: context.get(f'{name}_{key}', stage[key]) for key in ('batch_size', 'max_batching_window', 'max_concurrency')}
+        sources[name] = StageEventSource(name, load_handler(stage['handler']), timeline, **settings)
+        if 'queue_url' in stage:
+            sqs.listeners[stage['queue_url']] = lambda record, source=sources[name]: source.send(
+                record['s3']['bucket']['name'], urllib.parse.unquote_plus(record['s3']['object']['key']), metadata=record.get('metadata'))
+
+    def deliver(bucket_name, object_key):
+        # Bucket notifications by prefix, as configured by the image-processing stack
+        for name, stage in STAGES.items():
+            if 'prefix' in stage and object_key.startswith(stage['prefix']):
+                sources[name].send(bucket_name, object_key)
+    s3.listeners.append(deliver)
+
+    visits = []
+    for index in range(args.visitors):
+        if visits and rng.random() < args.duplicate_ratio:
+            # The same visitor uploads the same photo again; results are only reused for the same user
+            user_id, theme, gender, skin, photo = rng.choice(visits)
+        else:
+            user_id = f'visitor{index:04d}'
+            theme, gender, skin, photo = rng.choice(THEMES), rng.choice(GENDERS), rng.choice(SKINS), synthetic_photo(rng)
+        visits.append((user_id, theme, gender, skin, photo))
+
+    visitor = Visitor(apis, s3, timeline, args.poll_ms / 1000, args.timeout, args.themes_per_visit)
+    print(f"Running {args.visitors} visits, {args.concurrency} at a time ...", file=sys.stderr)
+    run_started_at = time.time()
+    # Handler logs are noise at this volume; errors still reach stderr
+    log_file = open(args.log, 'w') if args.log else None
+    with contextlib.redirect_stdout(sys.stdout if args.verbose else log_file or io.StringIO()):
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            futures = [executor.submit(visitor.visit, *visit) for visit in visits]
+            for future in futures:
+                try:
+                    future.result()
+                except Exception as e:
+                    print(f"visit error: {e}", file=sys.stderr)
+                    timeline.count('jobs_failed')
+        run_seconds = time.time() - run_started_at
+        for source in sources.values():
+            source.stop()
+    if log_file:
+        log_file.close()
+
+    summary = timeline.summary()
+    phase_order = ['put_image_api', 'upload', 'face_crop_queue_wait', 'face_crop', 'face_swap_queue_wait', 'face_swap',
+                   'predictor_wait', 'predictor', 'face_swap_completion_queue_wait', 'face_swap_completion',
+                   'upload_to_completed', 'end_to_end']
+    print(f"{'phase (ms)':<34}{'count':>7}{'mean':>9}{'p50':>9}{'p90':>9}{'p99':>9}{'max':>9}")
+    for phase in phase_order:
+        if phase in summary:
+            row = summary[phase]
+            print(f"{phase:<34}{row['count']:>7}{row['mean']:>9.0f}{row['p50']:>9.0f}{row['p90']:>9.0f}{row['p99']:>9.0f}{row['max']:>9.0f}")
+
+    completed = timeline.counters['jobs_completed']
+    print(f"\n{completed}/{args.visitors} visits completed in {run_seconds:.1f} s ({completed / run_seconds * 60:.1f} per minute)")
+    for name, value in sorted(timeline.counters.items()):
+        if name != 'jobs_completed':
+            print(f"  {name}: {value}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'arguments': vars(args), 'run_seconds': run_seconds, 'counters': timeline.counters, 'phases': summary}, f, indent=2)
+
+    # Every visit has to complete, deduplicated ones included
+    if completed < args.visitors:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+import base64
+import json
+import os
+import time
+from datetime import datetime, timedelta
+from typing import Dict, Any, List
+from gallery_runtime import create_response, lazy_client, presign_get_object
+
+ddb_client = lazy_client('dynamodb')
+BUCKET_NAME = os.environ.get('BUCKET_NAME')
+DDB_AMAZON_BEDROCK_GALLERY_DISPLAY_FEED_TABLE_NAME = os.environ.get('DDB_AMAZON_BEDROCK_GALLERY_DISPLAY_FEED_TABLE_NAME')
+
+# Must match the partitioning used by face-swap-completion (#TIME#{hour})
+TIME_BUCKET_FORMAT = '%Y%m%d%H'
+# How many hourly partitions a single page walks back through before giving up
+MAX_BUCKETS_PER_PAGE = int(os.environ.get('FEED_MAX_BUCKETS_PER_PAGE', 24))
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 100
+CACHE_MAX_AGE_SECONDS = int(os.environ.get('CACHE_MAX_AGE_SECONDS', 2))
+
+PRESIGNED_URL_EXPIRES_IN = 300
+# A cached presigned URL is reused only while it stays valid for at least this long
+PRESIGNED_URL_MIN_REMAINING_SECONDS = 60
+# result_object_key -> (presigned_at, url)
+presigned_url_cache = {}
+
+def generate_presigned_urls(object_keys: List[str]) -> Dict[str, str]:
+    # Presign the whole page in one pass, reusing URLs signed by earlier requests to this container
+    now = time.time()
+    for object_key, (presigned_at, _) in list(presigned_url_cache.items()):
+        if now - presigned_at >= PRESIGNED_URL_EXPIRES_IN - PRESIGNED_URL_MIN_REMAINING_SECONDS:
+            del presigned_url_cache[object_key]
+
+    for object_key in object_keys:
+        if object_key not in presigned_url_cache:
+            presigned_url_cache[object_key] = (now, presign_get_object(BUCKET_NAME, object_key, PRESIGNED_URL_EXPIRES_IN))
+    return {object_key: presigned_url_cache[object_key][1] for object_key in object_keys}
+
+def encode_cursor(time_bucket: str, sort_key: str) -> str:
+    return base64.urlsafe_b64encode(json.dumps({'bucket': time_bucket, 'sk': sort_key}).encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor: str) -> Dict[str, str]:
+    decoded = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    datetime.strptime(decoded['bucket'], TIME_BUCKET_FORMAT)
+    return {'bucket': decoded['bucket'], 'sk': str(decoded['sk'])}
+
+def query_feed(limit: int, cursor: Dict[str, str] = None):
+    """
+    Read the newest history items, walking back one hourly partition at a time.
+
+    Returns the items and the cursor for the next page (None when a whole walk found nothing older).
+    """
+    if cursor:
+        time_bucket = datetime.strptime(cursor['bucket'], TIME_BUCKET_FORMAT)
+        before_sort_key = cursor['sk']
+    else:
+        time_bucket = datetime.now()
+        before_sort_key = None
+
+    items = []
+    for _ in range(MAX_BUCKETS_PER_PAGE):
+        partition = time_bucket.strftime(TIME_BUCKET_FORMAT)
+        key_condition_expression = '#pk = :pk'
+        expression_attribute_values = {':pk': {'S': f'#TIME#{partition}'}}
+        if before_sort_key:
+            key_condition_expression += ' AND #sk < :sk'
+            expression_attribute_values[':sk'] = {'S': before_sort_key}
+
+        response = ddb_client.query(
+            TableName=DDB_AMAZON_BEDROCK_GALLERY_DISPLAY_FEED_TABLE_NAME,
+            KeyConditionExpression=key_condition_expression,
+            ExpressionAttributeNames={'#pk': 'PK', '#sk': 'SK'},
+            ExpressionAttributeValues=expression_attribute_values,
+            ScanIndexForward=False,
+            Limit=limit - len(items)
+        )
+        items.extend((partition, item) for item in response['Items'])
+
+        if len(items) >= limit:
+            last_partition, last_item = items[-1]
+            return [item for _, item in items], encode_cursor(last_partition, last_item['SK']['S'])
+        if response.get('LastEvaluatedKey'):
+            # The page size was reached inside this partition; continue from the last item
+            before_sort_key = response['LastEvaluatedKey']['SK']['S']
+            continue
+
+        time_bucket -= timedelta(hours=1)
+        before_sort_key = None
+
+    if not items:
+        return [], None
+    # The page is short because nothing older is within reach; the next page continues from there
+    return [item for _, item in items], encode_cursor(time_bucket.strftime(TIME_BUCKET_FORMAT), '~')
+
+def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    if event['httpMethod'] == 'OPTIONS':
+        return create_response(200, {})
+
+    if event['httpMethod'] != 'GET':
+        return create_response(405, {'error': f"{event['httpMethod']} Methods are not allowed."})
+
+    try:
+        # limit: number of results, newest first
+        # cursor: nextCursor from the previous page
+        query_parameters = event.get('queryStringParameters') or {}
+        limit = max(1, min(int(query_parameters.get('limit', DEFAULT_LIMIT)), MAX_LIMIT))
+        cursor = query_parameters.get('cursor')
+
+        try:
+            cursor = decode_cursor(cursor) if cursor else None
+        except (ValueError, TypeError, KeyError):
+            return create_response(400, {'error': 'Bad Request: invalid cursor.'})
+
+        items, next_cursor = query_feed(limit, cursor)
+        presigned_urls = generate_presigned_urls([item['result_object_key']['S'] for item in items])
+
+        results = [
+            {
+                'imageUrl': presigned_urls[item['result_object_key']['S']],
+                'story': item.get('base_story', {}).get('S'),
+                'theme': item.get('theme', {}).get('S'),
+                'gender': item.get('gender', {}).get('S'),
+                'skin': item.get('skin', {}).get('S'),
+                'uuid': item.get('uuid', {}).get('S'),
+                'userId': item.get('userId', {}).get('S'),
+                'createdAt': item.get('created_at', {}).get('S')
+            }
+            for item in items
+        ]
+
+        return create_response(200, {
+            'items': results,
+            'nextCursor': next_cursor
+        }, {'Cache-Control': f'public, max-age={CACHE_MAX_AGE_SECONDS}'})
+
+    except Exception as e:
+        return create_response(500, {'error': f'Internal server error: {str(e)}'})
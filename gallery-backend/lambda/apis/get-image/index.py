@@ -1,37 +1,91 @@
-import boto3
-import json
-import uuid
+import hashlib
 import os
-from datetime import datetime
-from typing import Dict, Any
+import time
+from collections import OrderedDict
+from typing import Dict, Any, Tuple
+from gallery_runtime import create_response, lazy_client, long_poll, presign_get_object
 
-s3_client = boto3.client('s3')
-ddb_client = boto3.client('dynamodb')
+ddb_client = lazy_client('dynamodb')
 BUCKET_NAME = os.environ.get('BUCKET_NAME')
 DDB_AMAZON_BEDROCK_GALLERY_DISPLAY_TABLE_NAME = os.environ.get('DDB_AMAZON_BEDROCK_GALLERY_DISPLAY_TABLE_NAME')
 
-def create_response(status_code: int, body: Dict[str, Any]) -> Dict[str, Any]:
-    return {
-        'statusCode': status_code,
-        'body': json.dumps(body),
-        'headers': {
-            'Content-Type': 'application/json',
-            'Access-Control-Allow-Origin': '*',
-            'Access-Control-Allow-Headers': 'Content-Type,X-Amz-Date,Authorization,X-Api-Key,X-Amz-Security-Token',
-            'Access-Control-Allow-Methods': 'OPTIONS,GET,POST'
+# API Gateway closes the integration after 29 seconds, so long-polls are capped well below that.
+# The display item is read 1 second after the request, then at growing intervals of up to 5 seconds.
+MAX_WAIT_SECONDS = 20
+POLL_INTERVAL_SECONDS = 1
+MAX_POLL_INTERVAL_SECONDS = 5
+
+# Warm-container caches
+#
+# Parameter                Environment Variable              Default Value
+# ---------                --------------------              -------------
+# display item ttl         DISPLAY_ITEM_CACHE_TTL_SECONDS    1 second
+# cached display items     DISPLAY_ITEM_CACHE_SIZE           256
+# cached responses         RESPONSE_CACHE_SIZE               256
+# browser cache max-age    CACHE_MAX_AGE_SECONDS             5 seconds
+DISPLAY_ITEM_CACHE_TTL_SECONDS = float(os.environ.get('DISPLAY_ITEM_CACHE_TTL_SECONDS', 1))
+DISPLAY_ITEM_CACHE_SIZE = int(os.environ.get('DISPLAY_ITEM_CACHE_SIZE', 256))
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', 256))
+CACHE_MAX_AGE_SECONDS = int(os.environ.get('CACHE_MAX_AGE_SECONDS', 5))
+PRESIGNED_URL_EXPIRES_IN = 300
+# A cached presigned URL is reused only while it stays valid for at least this long
+PRESIGNED_URL_MIN_REMAINING_SECONDS = 60
+
+# user_id -> (fetched_at, item), oldest fetch first
+display_item_cache = OrderedDict()
+# (user_id, updated_at) -> (presigned_at, response body), least recently used first
+response_cache = OrderedDict()
+
+def get_display_item(user_id: str) -> Dict[str, Any]:
+    # Repeated views of the same display within the TTL share one read
+    cached = display_item_cache.get(user_id)
+    if cached and time.time() - cached[0] < DISPLAY_ITEM_CACHE_TTL_SECONDS:
+        return cached[1]
+
+    response = ddb_client.get_item(
+        TableName=DDB_AMAZON_BEDROCK_GALLERY_DISPLAY_TABLE_NAME,
+        Key={
+            'PK': {'S': f'#USERID#{user_id}'}
         }
+    )
+    item = response.get('Item')
+    # Re-inserted at the end, so the first entries are always the stalest ones
+    display_item_cache.pop(user_id, None)
+    display_item_cache[user_id] = (time.time(), item)
+    while len(display_item_cache) > DISPLAY_ITEM_CACHE_SIZE:
+        display_item_cache.popitem(last=False)
+    return item
+
+def build_response_body(user_id: str, item: Dict[str, Any]) -> Tuple[float, Dict[str, Any]]:
+    # The item only changes together with updated_at, so the body and its presigned URL can be reused
+    # until the URL gets close to expiring. Returns (presigned_at, body).
+    cache_key = (user_id, item.get('updated_at', {}).get('S'))
+    cached = response_cache.get(cache_key)
+    if cached and time.time() - cached[0] < PRESIGNED_URL_EXPIRES_IN - PRESIGNED_URL_MIN_REMAINING_SECONDS:
+        response_cache.move_to_end(cache_key)
+        return cached
+
+    body = {
+        'imageUrl': presign_get_object(BUCKET_NAME, item.get('result_object_key', {}).get('S'), PRESIGNED_URL_EXPIRES_IN),
+        'story': item.get('base_story', {}).get('S'),
+        'theme': item.get('theme', {}).get('S'),
+        'gender': item.get('gender', {}).get('S'),
+        'skin': item.get('skin', {}).get('S'),
+        'uuid': item.get('uuid', {}).get('S'),
+        'userId': user_id
     }
 
-def generate_presigned_url(object_key: str) -> str:
-    return s3_client.generate_presigned_url(
-        'get_object',
-        Params={
-            'Bucket': BUCKET_NAME,
-            'Key': object_key,
-            'ResponseContentType': 'image/jpeg'
-        },
-        ExpiresIn='300'
-    )
+    response_cache[cache_key] = (time.time(), body)
+    response_cache.move_to_end(cache_key)
+    while len(response_cache) > RESPONSE_CACHE_SIZE:
+        response_cache.popitem(last=False)
+    return response_cache[cache_key]
+
+def generate_etag(user_id: str, item: Dict[str, Any], presigned_at: float) -> str:
+    # The presign time is part of the version: once the cached URL is re-presigned, a browser holding
+    # the old body (and its expiring URL) gets the new one instead of a 304
+    version = f"{user_id}#{item.get('uuid', {}).get('S')}#{item.get('updated_at', {}).get('S')}#{presigned_at}"
+    return f'"{hashlib.sha256(version.encode("utf-8")).hexdigest()[:32]}"'
 
 def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     if event['httpMethod'] == 'OPTIONS':
@@ -48,37 +102,40 @@ def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         if not user_id:
             return create_response(400, {'error': 'Bad Request: userId is required.'})
         
-        # DynamoDB에서 user_id에 해당하는 아이템 조회
-        response = ddb_client.get_item(
-            TableName=DDB_AMAZON_BEDROCK_GALLERY_DISPLAY_TABLE_NAME,
-            Key={
-                'PK': {'S': f'#USERID#{user_id}'}
-            }
+        # wait: long-poll for up to this many seconds
+        # since: the uuid the client is already showing; the response is held until a newer one is written
+        query_parameters = event.get('queryStringParameters') or {}
+        wait_seconds = min(float(query_parameters.get('wait', 0)), MAX_WAIT_SECONDS)
+        since = query_parameters.get('since')
+
+        # DynamoDB에서 user_id에 해당하는 아이템 조회 (변경될 때까지 대기)
+        item = long_poll(
+            lambda: get_display_item(user_id),
+            lambda item: bool(item) and item.get('uuid', {}).get('S') != since,
+            wait_seconds, POLL_INTERVAL_SECONDS, MAX_POLL_INTERVAL_SECONDS
         )
         
         # 조회된 아이템이 있는지 확인
-        item = response.get('Item')
         if not item:
             return create_response(404, {'error': 'User not found'})
 
-        uuid = item.get('uuid', {}).get('S')
-        base_image_object_key = item.get('base_image_object_key', {}).get('S')
-        result_object_key = item.get('result_object_key', {}).get('S')
-        theme = item.get('theme', {}).get('S')
-        gender = item.get('gender', {}).get('S')
-        skin = item.get('skin', {}).get('S')
-        base_story = item.get('base_story', {}).get('S')
-        presigned_url = generate_presigned_url(result_object_key)
-
-        return create_response(200, {
-            'imageUrl': presigned_url,
-            'story': base_story,
-            'theme': theme,
-            'gender': gender,
-            'skin': skin,
-            'uuid': uuid,
-            'userId': user_id
-        })
+        display_uuid = item.get('uuid', {}).get('S')
+        if since and display_uuid == since:
+            # Nothing new; skip the presign and let the client poll again
+            return create_response(200, {'uuid': display_uuid, 'userId': user_id, 'changed': False})
+
+        # Conditional requests for an unchanged display item whose URL is still valid don't need a body
+        presigned_at, body = build_response_body(user_id, item)
+        etag = generate_etag(user_id, item, presigned_at)
+        cache_headers = {
+            'ETag': etag,
+            'Cache-Control': f'private, max-age={CACHE_MAX_AGE_SECONDS}'
+        }
+        request_headers = {key.lower(): value for key, value in (event.get('headers') or {}).items()}
+        if request_headers.get('if-none-match') == etag:
+            return create_response(304, None, cache_headers)
+
+        return create_response(200, body, cache_headers)
 
     except Exception as e:
         return create_response(500, {'error': f'Internal server error: {str(e)}'})
\ No newline at end of file
@@ -0,0 +1,77 @@
+import os
+from typing import Dict, Any
+from gallery_runtime import create_response, lazy_client, long_poll, presign_get_object
+
+ddb_client = lazy_client('dynamodb')
+BUCKET_NAME = os.environ.get('BUCKET_NAME')
+RESULT_OBJECT_PATH = os.environ.get('RESULT_OBJECT_PATH')
+DDB_AMAZON_BEDROCK_GALLERY_PROCESS_TABLE_NAME = os.environ.get('DDB_AMAZON_BEDROCK_GALLERY_PROCESS_TABLE_NAME')
+
+# API Gateway closes the integration after 29 seconds, so long-polls are capped well below that.
+# The process item is read 1 second after the request, then at growing intervals of up to 5 seconds.
+MAX_WAIT_SECONDS = 20
+POLL_INTERVAL_SECONDS = 1
+MAX_POLL_INTERVAL_SECONDS = 5
+
+def read_job_status(job_id: str) -> Dict[str, Any]:
+    # job_id: {current_time}-{user_id}-{theme}-{gender}-{skin}-{unique_id}
+    process_item = ddb_client.get_item(
+        TableName=DDB_AMAZON_BEDROCK_GALLERY_PROCESS_TABLE_NAME,
+        Key={'PK': {'S': f'#UUID#{job_id}'}},
+        ProjectionExpression='userId, stages, job_status, job_error, updated_at'
+    ).get('Item')
+    if not process_item:
+        return None
+
+    # face-swap-completion (or the orchestrator) marks the job's own item, so one read per poll is enough
+    status = process_item.get('job_status', {}).get('S', 'PROCESSING')
+
+    stages = {
+        stage: {key: next(iter(value.values())) for key, value in stage_value['M'].items()}
+        for stage, stage_value in process_item.get('stages', {}).get('M', {}).items()
+    }
+
+    return {
+        'jobId': job_id,
+        'status': status,
+        'stages': stages,
+        'error': process_item.get('job_error', {}).get('S'),
+        'version': process_item.get('updated_at', {}).get('S')
+    }
+
+def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    if event['httpMethod'] == 'OPTIONS':
+        return create_response(200, {})
+
+    if event['httpMethod'] != 'GET':
+        return create_response(405, {'error': f"{event['httpMethod']} Methods are not allowed."})
+
+    try:
+        path_parameters = event.get('pathParameters') or {}
+        query_parameters = event.get('queryStringParameters') or {}
+        job_id = path_parameters.get('jobId')
+
+        if not job_id:
+            return create_response(400, {'error': 'Bad Request: jobId is required.'})
+
+        # wait: long-poll for up to this many seconds
+        # since: the version the client already has; the response is held until the job changes
+        wait_seconds = min(float(query_parameters.get('wait', 0)), MAX_WAIT_SECONDS)
+        since = query_parameters.get('since')
+
+        job_status = long_poll(
+            lambda: read_job_status(job_id),
+            lambda job_status: job_status is not None and (job_status['status'] in ('COMPLETED', 'FAILED') or job_status['version'] != since),
+            wait_seconds, POLL_INTERVAL_SECONDS, MAX_POLL_INTERVAL_SECONDS
+        )
+
+        if job_status is None:
+            return create_response(404, {'error': 'Job not found'})
+
+        if job_status['status'] == 'COMPLETED':
+            job_status['imageUrl'] = presign_get_object(BUCKET_NAME, os.path.join(RESULT_OBJECT_PATH, f'{job_id}.jpeg'))
+
+        return create_response(200, job_status)
+
+    except Exception as e:
+        return create_response(500, {'error': f'Internal server error: {str(e)}'})
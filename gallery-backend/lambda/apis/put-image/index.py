@@ -1,41 +1,86 @@
-import boto3
+import base64
 import json
 import uuid
 import os
 from datetime import datetime
-from typing import Dict, Any
+from typing import Dict, Any, List
 import random
+import urllib.parse
+from gallery_runtime import JobTimer, create_response, lazy_client
 
-s3_client = boto3.client('s3')
-ddb_client = boto3.client('dynamodb')
+s3_client = lazy_client('s3')
+ddb_client = lazy_client('dynamodb')
 BUCKET_NAME = os.environ['BUCKET_NAME']
 OBJECT_PATH = os.environ['OBJECT_PATH']
 DDB_AMAZON_BEDROCK_GALLERY_PROCESS_TABLE_NAME = os.environ['DDB_AMAZON_BEDROCK_GALLERY_PROCESS_TABLE_NAME']
 DDB_AMAZON_BEDROCK_GALLERY_BASE_RESOURCE_TABLE_NAME = os.environ['DDB_AMAZON_BEDROCK_GALLERY_BASE_RESOURCE_TABLE_NAME']
-
-def create_response(status_code: int, body: Dict[str, Any]) -> Dict[str, Any]:
-    return {
-        'statusCode': status_code,
-        'body': json.dumps(body),
-        'headers': {
-            'Content-Type': 'application/json',
-            'Access-Control-Allow-Origin': '*',
-            'Access-Control-Allow-Headers': 'Content-Type,X-Amz-Date,Authorization,X-Api-Key,X-Amz-Security-Token',
-            'Access-Control-Allow-Methods': 'OPTIONS,GET,POST'
-        }
-    }
+# One upload can be fused into this many themes (the first is the job of the upload itself)
+MAX_THEMES_PER_UPLOAD = int(os.environ.get('MAX_THEMES_PER_UPLOAD', '4'))
 
 def generate_image_ojbect_name(uuid: str, user_id: str, theme: str, gender: str, skin: str) -> str:
     current_time = datetime.now().strftime("%Y%m%d%S")
     return f"{current_time}-{user_id}-{theme}-{gender}-{skin}-{uuid}"
 
-def generate_presigned_url(object_key: str) -> str:
+# S3 user metadata is limited to 2KB per object, so longer stories are left to the DynamoDB fallback
+MAX_METADATA_STORY_LENGTH = 1024
+
+def generate_object_metadata(base_image_object_key: str, base_story: str, created_at: str, sibling_jobs: List[str] = None) -> Dict[str, str]:
+    # Carried forward on the upload -> crop -> result objects so later stages can skip the process table
+    metadata = {'created-at': created_at}
+    if base_image_object_key.isascii():
+        metadata['base-image-object-key'] = base_image_object_key
+    encoded_story = base64.urlsafe_b64encode(base_story.encode('utf-8')).decode('ascii')
+    if len(encoded_story) <= MAX_METADATA_STORY_LENGTH:
+        metadata['base-story'] = encoded_story
+    if sibling_jobs:
+        # Jobs of the other themes, fused from the same face by face-swap (quoted, metadata is ASCII only)
+        metadata['sibling-jobs'] = ','.join(urllib.parse.quote(job_id) for job_id in sibling_jobs)
+    return metadata
+
+def get_random_base_resource(theme: str, gender: str, skin: str) -> Dict[str, Any]:
+    ddb_response = ddb_client.query(
+        TableName=DDB_AMAZON_BEDROCK_GALLERY_BASE_RESOURCE_TABLE_NAME,
+        KeyConditionExpression="#pk = :pk",
+        ExpressionAttributeNames={
+            '#pk': 'PK'
+        },
+        ExpressionAttributeValues={
+            ':pk': {'S': f'#THEME#{theme}#GENDER#{gender}#SKIN#{skin}'},
+        }
+    )
+
+    if not ddb_response['Items']:
+        raise Exception(f"Could not find image with theme({theme}) and gender({gender}) and skin({skin})")
+
+    return random.choice(ddb_response['Items'])
+
+def put_process_item(image_object_name: str, user_id: str, theme: str, gender: str, skin: str,
+                     base_resource: Dict[str, Any], created_at: str, extra_attributes: Dict[str, Any]) -> None:
+    # uuid and userId and theme info to ddb with proper DynamoDB types
+    ddb_client.put_item(
+        TableName=DDB_AMAZON_BEDROCK_GALLERY_PROCESS_TABLE_NAME,
+        Item={
+            'PK': {'S': f'#UUID#{image_object_name}'},
+            'userId': {'S': user_id},
+            'theme': {'S': theme},
+            'gender': {'S': gender},
+            'skin': {'S': skin},
+            'base_image_object_key': {'S': base_resource['base_image_object_key']['S']},
+            'base_story': {'S': base_resource['story']['S']},
+            'updated_at': {"S": created_at},
+            'created_at': {"S": created_at},
+            **extra_attributes
+        }
+    )
+
+def generate_presigned_url(object_key: str, metadata: Dict[str, str]) -> str:
     return s3_client.generate_presigned_url(
         'put_object',
         Params={
             'Bucket': BUCKET_NAME, 
             'Key': object_key, 
-            'ContentType': 'image/jpeg'
+            'ContentType': 'image/jpeg',
+            'Metadata': metadata
         },
         ExpiresIn='300'
     )
@@ -58,57 +103,62 @@ def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             body = json.loads(body)
         
         user_id = body.get('userId')
-        theme = body.get('theme')
+        # themes: optional list; the upload is fused into every theme, each with its own job
+        themes = body.get('themes') or ([body.get('theme')] if body.get('theme') else [])
         gender = body.get('gender')
         skin = body.get('skin')
         
         # required parameter check
-        if not user_id or not theme or not gender or not skin:
-            return create_response(400, {'error': 'Bad Request: userId, theme, gender and skin values are required.'})
+        if not user_id or not themes or not gender or not skin:
+            return create_response(400, {'error': 'Bad Request: userId, theme (or themes), gender and skin values are required.'})
+        if not isinstance(themes, list) or len(themes) > MAX_THEMES_PER_UPLOAD or not all(isinstance(theme, str) and theme for theme in themes):
+            return create_response(400, {'error': f'Bad Request: themes must be a list of up to {MAX_THEMES_PER_UPLOAD} theme names.'})
+        themes = list(dict.fromkeys(themes))
         
-        # get random base resource
-        ddb_response = ddb_client.query(
-            TableName=DDB_AMAZON_BEDROCK_GALLERY_BASE_RESOURCE_TABLE_NAME,
-            KeyConditionExpression="#pk = :pk",
-            ExpressionAttributeNames={
-                '#pk': 'PK'
-            },
-            ExpressionAttributeValues={
-                ':pk': {'S': f'#THEME#{theme}#GENDER#{gender}#SKIN#{skin}'},
-            }
-        )
-    
-        if not ddb_response['Items']:
-            raise Exception(f"Could not find image with theme({theme}) and gender({gender}) and skin({skin})")
-        
-        random_item = random.choice(ddb_response['Items'])
+        # Timings of this request, emitted under the job id once the job exists
+        timer = JobTimer('put_image', themes=len(themes))
+
+        # get random base resource for every theme
+        with timer.phase('base_resource'):
+            base_resources = [get_random_base_resource(theme, gender, skin) for theme in themes]
         
-        # unique image name create
-        unique_id = str(uuid.uuid4())[:8]
-        # uuid and userId and theme info to ddb with proper DynamoDB types
-        image_object_name = generate_image_ojbect_name(unique_id, user_id, theme, gender, skin)
-        ddb_client.put_item(
-            TableName=DDB_AMAZON_BEDROCK_GALLERY_PROCESS_TABLE_NAME,
-            Item={
-                'PK': {'S': f'#UUID#{image_object_name}'},
-                'userId': {'S': user_id},
-                'theme': {'S': theme},
-                'gender': {'S': gender},
-                'skin': {'S': skin},
-                'base_image_object_key': {'S': random_item['base_image_object_key']['S']},
-                'base_story': {'S': random_item['story']['S']},
-                'updated_at': {"S": datetime.now().isoformat()},
-                'created_at': {"S": datetime.now().isoformat()}
-            }
-        )
+        # unique image name create; the upload is named after the first theme's job
+        unique_ids = [str(uuid.uuid4())[:8] for _ in themes]
+        image_object_names = [
+            generate_image_ojbect_name(unique_id, user_id, theme, gender, skin)
+            for unique_id, theme in zip(unique_ids, themes)
+        ]
+        image_object_name, sibling_jobs = image_object_names[0], image_object_names[1:]
+        # face-swap-completion orders the display row of the user by this time
+        created_at = datetime.now().isoformat()
+        with timer.phase('process_record'):
+            for index, (theme, base_resource) in enumerate(zip(themes, base_resources)):
+                if index == 0:
+                    extra_attributes = {'sibling_jobs': {'L': [{'S': job_id} for job_id in sibling_jobs]}} if sibling_jobs else {}
+                else:
+                    extra_attributes = {'primary_job': {'S': image_object_name}}
+                put_process_item(image_object_names[index], user_id, theme, gender, skin, base_resource, created_at, extra_attributes)
 
         # userId and theme info to path (OBJECT_PATH is the default path on S3)
         image_object_key = os.path.join(OBJECT_PATH, f'{image_object_name}.jpeg')
-        image_upload_presigned_url = generate_presigned_url(image_object_key)
+        metadata = generate_object_metadata(base_resources[0]['base_image_object_key']['S'], base_resources[0]['story']['S'], created_at, sibling_jobs)
+        with timer.phase('presign'):
+            image_upload_presigned_url = generate_presigned_url(image_object_key, metadata)
+        timer.job_id = image_object_name
+        timer.emit()
+
+        # The metadata headers are part of the signature, so the client has to send them with the upload
+        upload_headers = {'Content-Type': 'image/jpeg'}
+        upload_headers.update({f'x-amz-meta-{key}': value for key, value in metadata.items()})
 
         return create_response(200, {
-            'uuid': unique_id,
-            'uploadUrl': image_upload_presigned_url
+            'uuid': unique_ids[0],
+            # Job id for /apis/jobs/{jobId}
+            'jobId': image_object_name,
+            # One job per requested theme, all completed from this upload
+            'jobs': [{'theme': theme, 'jobId': job_id} for theme, job_id in zip(themes, image_object_names)],
+            'uploadUrl': image_upload_presigned_url,
+            'uploadHeaders': upload_headers
         })
 
     except Exception as e:
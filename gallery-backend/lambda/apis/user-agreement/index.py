@@ -1,12 +1,11 @@
 import json
-import boto3
 import os
 from datetime import datetime
-from boto3.dynamodb.conditions import Key
+from gallery_runtime import lazy_client
 
-# DynamoDB 클라이언트 초기화
-dynamodb = boto3.resource('dynamodb')
-table = dynamodb.Table(os.environ['DDB_AMAZON_BEDROCK_USER_AGREEMENT_TABLE_NAME'])
+# DynamoDB 클라이언트 초기화 (리소스 API 대신 첫 호출 시 생성되는 저수준 클라이언트 사용)
+ddb_client = lazy_client('dynamodb')
+DDB_AMAZON_BEDROCK_USER_AGREEMENT_TABLE_NAME = os.environ['DDB_AMAZON_BEDROCK_USER_AGREEMENT_TABLE_NAME']
 
 def handler(event, context):
     try:
@@ -35,7 +34,13 @@ def handler(event, context):
             'imageId': image_id
         }
         
-        response = table.put_item(Item=params)
+        # 리소스 API와 같은 방식으로 값을 DynamoDB 타입으로 변환
+        from boto3.dynamodb.types import TypeSerializer
+        serializer = TypeSerializer()
+        response = ddb_client.put_item(
+            TableName=DDB_AMAZON_BEDROCK_USER_AGREEMENT_TABLE_NAME,
+            Item={key: serializer.serialize(value) for key, value in params.items()}
+        )
       
         return {
             'statusCode': 200,
@@ -0,0 +1,119 @@
+import os
+import threading
+from io import BytesIO
+from gallery_runtime import lazy_client
+
+# Face detectors for face-crop. Every detector returns a list of faces as
+# (left, top, width, height, confidence) in source pixels, confidence in 0-100.
+#
+# Parameter                Environment Variable              Default Value
+# ---------                --------------------              -------------
+# detector                 FACE_DETECTOR                     rekognition (rekognition | opencv)
+# opencv model directory   FACE_DETECTOR_MODEL_DIR           /opt/face-detector
+# fallback threshold       FACE_DETECTOR_MIN_CONFIDENCE      80
+FACE_DETECTOR = os.environ.get('FACE_DETECTOR', 'rekognition')
+FACE_DETECTOR_MODEL_DIR = os.environ.get('FACE_DETECTOR_MODEL_DIR', '/opt/face-detector')
+FACE_DETECTOR_MIN_CONFIDENCE = float(os.environ.get('FACE_DETECTOR_MIN_CONFIDENCE', 80))
+
+MAX_IMAGE_SIZE = 5 * 1024 * 1024  # 5MB
+
+
+class RekognitionDetector:
+    """Rekognition DetectFaces with the default attribute set (bounding box, confidence, landmarks, pose, quality)."""
+
+    def __init__(self):
+        # Only created when a detection actually reaches Rekognition
+        self.client = lazy_client('rekognition')
+
+    def detect(self, image, bucket_name, object_key):
+        img_width, img_height = image.size
+
+        # Save image to a memory buffer in jpeg format
+        buffer = BytesIO()
+        image.save(buffer, format="JPEG")
+        image_bytes = buffer.getvalue()
+
+        # If the image size exceeds MAX_IMAGE_SIZE, use S3 object reference for face detection
+        if len(image_bytes) > MAX_IMAGE_SIZE:
+            print(f"Image size exceeds {MAX_IMAGE_SIZE} bytes. Using S3 object reference.")
+            request_image = {'S3Object': {'Bucket': bucket_name, 'Name': object_key}}
+        else:
+            request_image = {'Bytes': image_bytes}
+        response = self.client.detect_faces(Image=request_image, Attributes=['DEFAULT'])
+
+        faces = []
+        for face_detail in response['FaceDetails']:
+            box = face_detail['BoundingBox']
+            faces.append((
+                img_width * box['Left'],
+                img_height * box['Top'],
+                img_width * box['Width'],
+                img_height * box['Height'],
+                face_detail['Confidence']
+            ))
+        return faces
+
+
+class OpenCVDetector:
+    """In-process OpenCV DNN detector (ResNet-10 SSD, 300x300) loaded from a Lambda layer."""
+
+    def __init__(self, model_dir=FACE_DETECTOR_MODEL_DIR):
+        import cv2
+
+        self.cv2 = cv2
+        self.net = cv2.dnn.readNetFromCaffe(
+            os.path.join(model_dir, 'deploy.prototxt'),
+            os.path.join(model_dir, 'res10_300x300_ssd_iter_140000.caffemodel'))
+        # face-crop detects concurrently and cv2.dnn.Net keeps the input between setInput and forward
+        self.lock = threading.Lock()
+
+    def detect(self, image, bucket_name, object_key):
+        import numpy as np
+
+        img_width, img_height = image.size
+        # PIL gives RGB; the model was trained on BGR with these channel means
+        bgr = np.asarray(image.convert('RGB'))[:, :, ::-1]
+        blob = self.cv2.dnn.blobFromImage(self.cv2.resize(bgr, (300, 300)), 1.0, (300, 300), (104.0, 177.0, 123.0))
+        with self.lock:
+            self.net.setInput(blob)
+            detections = self.net.forward()
+
+        faces = []
+        for i in range(detections.shape[2]):
+            confidence = float(detections[0, 0, i, 2]) * 100
+            if confidence < 10:
+                continue
+            left, top, right, bottom = np.clip(detections[0, 0, i, 3:7], 0.0, 1.0)
+            faces.append((
+                img_width * left,
+                img_height * top,
+                img_width * (right - left),
+                img_height * (bottom - top),
+                confidence
+            ))
+        return faces
+
+
+class FallbackDetector:
+    """Use the primary detector, and the fallback when its best face is below min_confidence."""
+
+    def __init__(self, primary, fallback, min_confidence=FACE_DETECTOR_MIN_CONFIDENCE):
+        self.primary = primary
+        self.fallback = fallback
+        self.min_confidence = min_confidence
+
+    def detect(self, image, bucket_name, object_key):
+        faces = self.primary.detect(image, bucket_name, object_key)
+        if faces and max(face[4] for face in faces) >= self.min_confidence:
+            return [face for face in faces if face[4] >= self.min_confidence]
+
+        print(f"Low confidence from {type(self.primary).__name__}, falling back to {type(self.fallback).__name__}")
+        return self.fallback.detect(image, bucket_name, object_key)
+
+
+def create_detector(name=FACE_DETECTOR):
+    if name == 'rekognition':
+        return RekognitionDetector()
+    if name == 'opencv':
+        return FallbackDetector(OpenCVDetector(), RekognitionDetector())
+    raise ValueError(f"Unsupported face detector: {name}")
@@ -1,100 +1,272 @@
-import boto3
 import json
 import os
-import copy
+import math
+import time
 import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
 from io import BytesIO
 from PIL import Image
 from datetime import datetime
 from typing import Dict, Any
+from detectors import create_detector
+from gallery_runtime import iter_s3_records, job_id_from_key, job_timer, lazy_client, phase, send_stage_records, stage_record
 
-s3_client = boto3.client('s3')
-rekognition_client = boto3.client('rekognition')
+s3_client = lazy_client('s3')
+ddb_client = lazy_client('dynamodb')
 BUCKET_NAME = os.environ.get('BUCKET_NAME')
 FACE_CROPPED_OBJECT_PATH = os.environ.get('FACE_CROPPED_OBJECT_PATH')
-MAX_IMAGE_SIZE = 5 * 1024 * 1024  # 5MB
+RESULT_OBJECT_PATH = os.environ.get('RESULT_OBJECT_PATH')
+DDB_AMAZON_BEDROCK_GALLERY_PROCESS_TABLE_NAME = os.environ.get('DDB_AMAZON_BEDROCK_GALLERY_PROCESS_TABLE_NAME')
+# Queues of the next stages in the event pipeline; the job's metadata travels with the message.
+# Not set in the orchestrated pipeline, where the orchestrator passes it on from this function's response.
+FACE_SWAP_QUEUE_URL = os.environ.get('FACE_SWAP_QUEUE_URL', '')
+FACE_SWAP_COMPLETION_QUEUE_URL = os.environ.get('FACE_SWAP_COMPLETION_QUEUE_URL', '')
+# A (user, face hash, base image) triple is answered from the earlier result for this long; 0 disables deduplication
+DEDUP_TTL_SECONDS = int(os.environ.get('DEDUP_TTL_SECONDS', 3600))
+
+# Records in one SQS batch are cropped concurrently, up to this many at a time
+MAX_PARALLEL_CROPS = int(os.environ.get('MAX_PARALLEL_CROPS', 4))
+
+# Long side of the image decoded for face detection
+FACE_DETECT_SIZE = int(os.environ.get('FACE_DETECT_SIZE', 1280))
+# The crop is a FACE_CROP_SIZE square, the input size the FaceChain fusion model works at
+FACE_CROP_SIZE = int(os.environ.get('FACE_CROP_SIZE', 512))
+# jpeg, or png for a lossless crop
+FACE_CROP_FORMAT = os.environ.get('FACE_CROP_FORMAT', 'jpeg').lower()
+FACE_CROP_JPEG_QUALITY = int(os.environ.get('FACE_CROP_JPEG_QUALITY', 90))
+
+# Rekognition by default, or the in-process OpenCV detector (FACE_DETECTOR=opencv) with Rekognition fallback
+face_detector = create_detector()
 
 def lambda_handler(event, context):
-    # S3 이벤트 처리
-    s3_event = event['Records'][0]['s3']
-    bucket_name = s3_event['bucket']['name']
-    encoded_object_key = s3_event['object']['key']
-    source_object_key = urllib.parse.unquote_plus(encoded_object_key)
-    
+    # 배치 내 메시지는 동시에 처리하고, 실패한 메시지만 재시도되도록 보고
+    with ThreadPoolExecutor(max_workers=MAX_PARALLEL_CROPS) as executor:
+        futures = [
+            (message_id, executor.submit(crop_faces, s3_records))
+            for message_id, s3_records in iter_s3_records(event)
+        ]
+
+    batch_item_failures = []
+    # Result keys answered from an earlier identical job, so a caller can skip the face swap
+    deduplicated = []
+    # Object metadata per job id, for the orchestrator to pass on to the later stages
+    job_metadata = {}
+    for message_id, future in futures:
+        try:
+            for job_id, duplicate_result_object_key, object_metadata in future.result():
+                if duplicate_result_object_key:
+                    deduplicated.append(duplicate_result_object_key)
+                job_metadata[job_id] = object_metadata
+        except Exception as e:
+            print(f"error: {str(e)}")
+            if message_id is None:
+                raise e
+            batch_item_failures.append({'itemIdentifier': message_id})
+
+    return {'batchItemFailures': batch_item_failures, 'deduplicated': deduplicated, 'metadata': job_metadata}
+
+def crop_faces(s3_records):
+    results = []
+    for s3_record in s3_records:
+        s3_event = s3_record['s3']
+        object_key = urllib.parse.unquote_plus(s3_event['object']['key'])
+        with job_timer('face_crop', job_id_from_key(object_key), s3_record) as timer:
+            message, duplicate_result_object_key, object_metadata = crop_face(s3_event['bucket']['name'], object_key)
+            if duplicate_result_object_key:
+                timer.status = 'deduplicated'
+        print(message)
+        results.append((job_id_from_key(object_key), duplicate_result_object_key, object_metadata))
+    return results
+
+def crop_face(bucket_name, source_object_key):
     # Load image file from S3
-    response = s3_client.get_object(Bucket=bucket_name, Key=source_object_key)
-    image_content = response['Body'].read()  
-    image = Image.open(BytesIO(image_content))
-    if image.mode == 'RGBA':
-        image = image.convert('RGB')
+    with phase('download'):
+        response = s3_client.get_object(Bucket=bucket_name, Key=source_object_key)
+        image_content = response['Body'].read()
+    # Process-record fields set by put-image; carried forward to the cropped image
+    object_metadata = response.get('Metadata', {})
+    # Detect on a reduced-resolution decode; the face box is mapped back to source pixels
+    with phase('decode'):
+        image, scale = open_scaled_image(image_content, FACE_DETECT_SIZE)
     
     # Detect faces and find the largest face area (with padding)
-    ori_image, imgWidth, imgHeight, f_left, f_top, f_width, f_height, rekognition_response = show_faces(image, bucket_name, source_object_key)
+    with phase('detect'):
+        ori_image, imgWidth, imgHeight, f_left, f_top, f_width, f_height, faces = show_faces(image, bucket_name, source_object_key)
     
     if f_left is not None:
-        # Crop the detected face area
-        cropped_image = ori_image.crop((f_left, f_top, f_left + f_width, f_top + f_height))
+        # Decode only as much resolution as the face area needs, then crop it to a canonical square
+        face_box = (f_left * scale, f_top * scale, f_width * scale, f_height * scale)
+        with phase('crop'):
+            cropped_image = crop_scaled_region(image_content, face_box, FACE_CROP_SIZE)
         
         # Extract the filename from source_object_key
         filename = os.path.basename(source_object_key)
+
+        # The same face on the same base image was processed recently: reuse that result
+        with phase('dedup'):
+            result_object_key = reuse_duplicate_result(bucket_name, filename, compute_face_hash(cropped_image), object_metadata)
+        if result_object_key:
+            return f"Duplicate face image, reused result at {result_object_key}", result_object_key, object_metadata
         
         # Create the key for the cropped image
         face_cropped_object_key = os.path.join(FACE_CROPPED_OBJECT_PATH, filename)
         
-        # Save the cropped image to a memory buffer in jpeg format and upload to S3
-        buffered = BytesIO()
-        cropped_image.save(buffered, format="JPEG")
-        image_bytes = buffered.getvalue()
-        s3_client.put_object(
-            Bucket=bucket_name,
-            Key=face_cropped_object_key,
-            Body=image_bytes,
-            ContentType="image/jpeg"
-        )
+        # Save the cropped image to a memory buffer and upload to S3
+        with phase('encode'):
+            buffered = BytesIO()
+            if FACE_CROP_FORMAT == 'png':
+                cropped_image.save(buffered, format="PNG")
+                content_type = "image/png"
+            else:
+                cropped_image.save(buffered, format="JPEG", quality=FACE_CROP_JPEG_QUALITY)
+                content_type = "image/jpeg"
+            image_bytes = buffered.getvalue()
+        with phase('upload'):
+            s3_client.put_object(
+                Bucket=bucket_name,
+                Key=face_cropped_object_key,
+                Body=image_bytes,
+                ContentType=content_type,
+                Metadata=object_metadata
+            )
+
+        if FACE_SWAP_QUEUE_URL:
+            with phase('next_stage'):
+                send_stage_records(FACE_SWAP_QUEUE_URL, [stage_record(bucket_name, face_cropped_object_key, object_metadata)])
         
-        return {
-            'statusCode': 200,
-            'body': json.dumps(f"Cropped face image saved successfully at {face_cropped_object_key}!")
-        }
+        return f"Cropped face image saved successfully at {face_cropped_object_key}!", None, object_metadata
     else:
-        return {
-            'statusCode': 200,
-            'body': json.dumps("No faces detected in the image.")
-        }
+        return f"No faces detected in the image: {source_object_key}", None, object_metadata
 
-def show_faces(image, bucket_name, object_key, padding_ratio=0.5):
-    imgWidth, imgHeight = image.size
-    ori_image = copy.deepcopy(image)
-    
-    # Save image to a memory buffer in jpeg format
-    buffer = BytesIO()
-    image.save(buffer, format="JPEG")
-    image_bytes = buffer.getvalue()
-    
-    # If the image size exceeds MAX_IMAGE_SIZE, use S3 object reference for face detection
-    if len(image_bytes) > MAX_IMAGE_SIZE:
-        print(f"Image size exceeds {MAX_IMAGE_SIZE} bytes. Using S3 object reference.")
-        response = rekognition_client.detect_faces(
-            Image={'S3Object': {'Bucket': bucket_name, 'Name': object_key}},
-            Attributes=['ALL']
+def open_scaled_image(image_content, target_size):
+    """
+    JPEG draft mode로 target_size 이상이 되는 가장 작은 1/2, 1/4, 1/8 배율로만 디코딩하는 함수
+
+    Returns:
+        tuple: (RGB 이미지, 원본 대비 축소 비율)
+    """
+    image = Image.open(BytesIO(image_content))
+    source_width, source_height = image.size
+    ratio = min(1.0, target_size / max(source_width, source_height))
+    # draft only applies to JPEG and picks a DCT scale whose output is still at least the requested size
+    image.draft('RGB', (math.ceil(source_width * ratio), math.ceil(source_height * ratio)))
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    return image, source_width / image.size[0]
+
+def square_box(face_box, source_width, source_height):
+    # Grow the shorter side around the face center, shifting the square back inside the image at the edges
+    left, top, width, height = face_box
+    side = min(max(width, height), source_width, source_height)
+    center_x, center_y = left + width / 2, top + height / 2
+    square_left = min(max(0, center_x - side / 2), source_width - side)
+    square_top = min(max(0, center_y - side / 2), source_height - side)
+    return square_left, square_top, side
+
+def crop_scaled_region(image_content, face_box, output_size):
+    """
+    얼굴 영역을 정사각형으로 맞춘 뒤, output_size 이상을 유지하는 가장 작은 배율로 디코딩하여
+    output_size x output_size 크기로 잘라내는 함수
+    """
+    image = Image.open(BytesIO(image_content))
+    source_width, source_height = image.size
+    left, top, side = square_box(face_box, source_width, source_height)
+
+    ratio = min(1.0, output_size / max(side, 1))
+    image.draft('RGB', (math.ceil(source_width * ratio), math.ceil(source_height * ratio)))
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+
+    scale = image.size[0] / source_width
+    box = (int(left * scale), int(top * scale), int((left + side) * scale), int((top + side) * scale))
+    return image.resize((output_size, output_size), Image.LANCZOS, box=box)
+
+def compute_face_hash(image):
+    # Difference hash (dHash) of the cropped face: 64 bits from comparing neighbouring pixels of a 9x8 thumbnail
+    thumbnail = image.convert('L').resize((9, 8), Image.LANCZOS)
+    pixels = list(thumbnail.getdata())
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            bits = (bits << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return f'{bits:016x}'
+
+def reuse_duplicate_result(bucket_name, filename, face_hash, object_metadata):
+    """
+    Claim the (user, face hash, base image) triple for this job, or copy the result of the job that claimed it.
+
+    Returns the result object key written for this job, or None when this job has to be processed.
+    The claim is scoped to the user: a 64-bit hash of a crop can match another person's face, and
+    their result must never be shown to this visitor.
+    """
+    base_image_object_key = object_metadata.get('base-image-object-key')
+    if not DEDUP_TTL_SECONDS or not base_image_object_key:
+        return None
+    # Only this job's result could be copied; the sibling themes still need the fusion
+    if object_metadata.get('sibling-jobs'):
+        return None
+
+    uuid = os.path.splitext(filename)[0]
+    user_id = uuid.split('-')[1]
+    now = int(time.time())
+    try:
+        ddb_client.put_item(
+            TableName=DDB_AMAZON_BEDROCK_GALLERY_PROCESS_TABLE_NAME,
+            Item={
+                'PK': {'S': f'#DEDUP#{user_id}#{face_hash}#{base_image_object_key}'},
+                'job_id': {'S': uuid},
+                'expires_at': {'N': str(now + DEDUP_TTL_SECONDS)}
+            },
+            # TTL deletion is lazy, so expired claims are overwritten as well
+            ConditionExpression='attribute_not_exists(PK) OR expires_at < :now',
+            ExpressionAttributeValues={':now': {'N': str(now)}},
+            ReturnValuesOnConditionCheckFailure='ALL_OLD'
         )
-    else:
-        response = rekognition_client.detect_faces(
-            Image={'Bytes': image_bytes},
-            Attributes=['ALL']
+        return None
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise e
+        original_job_id = e.response.get('Item', {}).get('job_id', {}).get('S')
+
+    if not original_job_id or original_job_id == uuid:
+        return None
+
+    result_object_key = os.path.join(RESULT_OBJECT_PATH, filename)
+    try:
+        s3_client.copy_object(
+            Bucket=bucket_name,
+            Key=result_object_key,
+            CopySource={'Bucket': bucket_name, 'Key': os.path.join(RESULT_OBJECT_PATH, f'{original_job_id}.jpeg')},
+            ContentType='image/png',
+            Metadata=object_metadata,
+            MetadataDirective='REPLACE'
         )
-        
+    except ClientError as e:
+        # The original job has not produced its result (yet), so process this one normally
+        if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+            raise e
+        print(f"No result yet for duplicate of {original_job_id}")
+        return None
+
+    if FACE_SWAP_COMPLETION_QUEUE_URL:
+        send_stage_records(FACE_SWAP_COMPLETION_QUEUE_URL, [stage_record(bucket_name, result_object_key, object_metadata)])
+
+    print(f"Duplicate of {original_job_id}: {face_hash}")
+    return result_object_key
+
+def show_faces(image, bucket_name, object_key, padding_ratio=0.5):
+    imgWidth, imgHeight = image.size
+    # The detection image is not modified, so it is returned as is
+    ori_image = image
+
+    faces = face_detector.detect(image, bucket_name, object_key)
+
     largest_area = 0
     largest_face_box = None
     
     # Select the largest face area from each face area
-    for faceDetail in response['FaceDetails']:
-        box = faceDetail['BoundingBox']
-        left = imgWidth * box['Left']
-        top = imgHeight * box['Top']
-        width = imgWidth * box['Width']
-        height = imgHeight * box['Height']
-        
+    for left, top, width, height, confidence in faces:
         current_area = width * height
         if current_area > largest_area:
             largest_area = current_area
@@ -110,6 +282,6 @@ def show_faces(image, bucket_name, object_key, padding_ratio=0.5):
         padded_right = min(imgWidth, left + width + padding_width)
         padded_bottom = min(imgHeight, top + height + padding_height)
         
-        return ori_image, imgWidth, imgHeight, int(padded_left), int(padded_top), int(padded_right - padded_left), int(padded_bottom - padded_top), response
+        return ori_image, imgWidth, imgHeight, int(padded_left), int(padded_top), int(padded_right - padded_left), int(padded_bottom - padded_top), faces
     else:
         return None, None, None, None, None, None, None, None
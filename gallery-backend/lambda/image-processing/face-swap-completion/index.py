@@ -1,20 +1,41 @@
+import base64
 import json
-import boto3
 import os
 import urllib.request
 import urllib.error
 import io
 from datetime import datetime
+from botocore.exceptions import ClientError
+from gallery_runtime import iter_s3_records, job_id_from_key, job_timer, lazy_client, phase
 
 DDB_AMAZON_BEDROCK_GALLERY_PROCESS_TABLE_NAME = os.environ['DDB_AMAZON_BEDROCK_GALLERY_PROCESS_TABLE_NAME']
 DDB_AMAZON_BEDROCK_GALLERY_DISPLAY_TABLE_NAME = os.environ['DDB_AMAZON_BEDROCK_GALLERY_DISPLAY_TABLE_NAME']
+DDB_AMAZON_BEDROCK_GALLERY_DISPLAY_FEED_TABLE_NAME = os.environ['DDB_AMAZON_BEDROCK_GALLERY_DISPLAY_FEED_TABLE_NAME']
+# History items are partitioned by hour so the feed reads the latest results from one or two partitions
+TIME_BUCKET_FORMAT = '%Y%m%d%H'
 
-ddb_client = boto3.client('dynamodb')
+ddb_client = lazy_client('dynamodb')
 
 def lambda_handler(event, context):
-    s3_event = event['Records'][0]['s3']
-    encoded_object_key = s3_event['object']['key']
-    result_object_key = urllib.parse.unquote_plus(encoded_object_key) # user's result image
+    # S3 이벤트 처리 (SQS 배치 또는 직접 S3 이벤트), 실패한 메시지만 재시도되도록 보고
+    batch_item_failures = []
+    for message_id, s3_records in iter_s3_records(event):
+        try:
+            for s3_record in s3_records:
+                s3_event = s3_record['s3']
+                object_key = urllib.parse.unquote_plus(s3_event['object']['key'])
+                with job_timer('face_swap_completion', job_id_from_key(object_key), s3_record):
+                    complete_face_swap(s3_event['bucket']['name'], object_key, s3_record.get('metadata'))
+        except Exception as e:
+            print(f"error: {str(e)}")
+            if message_id is None:
+                raise e
+            batch_item_failures.append({'itemIdentifier': message_id})
+
+    return {'batchItemFailures': batch_item_failures}
+
+def complete_face_swap(bucket_name, result_object_key, object_metadata=None):
+    # result_object_key: user's result image
     result_object_filename = os.path.basename(result_object_key) # result_object_filename: {current_time}-{user_id}-{theme}-{gender}-{skin}-{unique_id}.jpeg
     uuid = os.path.splitext(result_object_filename)[0]
     userId = uuid.split('-')[1]
@@ -22,83 +43,115 @@ def lambda_handler(event, context):
     gender = uuid.split('-')[3]
     skin = uuid.split('-')[4]
 
-    # get process image info
-    ddb_response = ddb_client.query(
-        TableName=DDB_AMAZON_BEDROCK_GALLERY_PROCESS_TABLE_NAME,
-        KeyConditionExpression='#pk = :pk',
-        ExpressionAttributeNames={
-            '#pk': 'PK'
-        },
-        ExpressionAttributeValues={
-            ':pk': {'S': f'#UUID#{uuid}'}
-        }
-    )
-    
-    if not ddb_response['Items']:
-        raise Exception(f"Could not find image with uuid({uuid})")
-
-    process_image_info = ddb_response['Items'][0]
-    base_image_object_key = process_image_info['base_image_object_key']['S']
-    base_story = process_image_info['base_story']['S']
-    theme = process_image_info['theme']['S']
-    gender = process_image_info['gender']['S']
-    skin = process_image_info['skin']['S']
+    # get process image info (the job's metadata from the message first, process table as fallback)
+    object_metadata = object_metadata or {}
+    if 'base-image-object-key' in object_metadata and 'base-story' in object_metadata:
+        base_image_object_key = object_metadata['base-image-object-key']
+        base_story = base64.urlsafe_b64decode(object_metadata['base-story']).decode('utf-8')
+        job_created_at = object_metadata.get('created-at')
+    else:
+        with phase('metadata'):
+            process_image_info = get_process_image_info(uuid)
+            base_image_object_key = process_image_info['base_image_object_key']['S']
+            base_story = process_image_info['base_story']['S']
+            theme = process_image_info['theme']['S']
+            gender = process_image_info['gender']['S']
+            skin = process_image_info['skin']['S']
+            job_created_at = process_image_info.get('created_at', {}).get('S')
     
     try:
-        response = ddb_client.query(
-            TableName=DDB_AMAZON_BEDROCK_GALLERY_DISPLAY_TABLE_NAME,
-            KeyConditionExpression='PK = :pk',
-            ExpressionAttributeValues={
-                ':pk': {'S': f'#USERID#{userId}'}
-            }
-        )
-        
-        current_time = datetime.now().isoformat()
-        
-        if response['Items']:
-            # if there is an item, update it (#USERID#{user_id})
-            ddb_client.update_item(
-                TableName=DDB_AMAZON_BEDROCK_GALLERY_DISPLAY_TABLE_NAME,
-                Key={
-                    'PK': {'S': f'#USERID#{userId}'}
-                },
-                UpdateExpression='SET #uuid_attr = :uuid, base_image_object_key = :base_image_object_key, result_object_key = :result_object_key, base_story = :base_story, theme = :theme, updated_at = :updated_at, gender = :gender, skin = :skin',
-                ExpressionAttributeNames={
-                    '#uuid_attr': 'uuid',
-                },
-                ExpressionAttributeValues={
-                    ':uuid': {'S': uuid},
-                    ':base_image_object_key': {'S': base_image_object_key},
-                    ':result_object_key': {'S': result_object_key},
-                    ':base_story': {'S': base_story},
-                    ':theme': {'S': theme},
-                    ':gender': {'S': gender},
-                    ':skin': {'S': skin},
-                    ':updated_at': {'S': current_time}
-                }
-            )
-        else:
+        now = datetime.now()
+        current_time = now.isoformat()
+        job_created_at = job_created_at or current_time
+
+        # Single upsert of the display row (#USERID#{user_id}); created_at is only set on first write.
+        # The row only moves forward to jobs created at or after the one it shows, so a redelivered
+        # or late completion of an older job does not replace a newer result.
+        with phase('display'):
+            try:
+                ddb_client.update_item(
+                    TableName=DDB_AMAZON_BEDROCK_GALLERY_DISPLAY_TABLE_NAME,
+                    Key={
+                        'PK': {'S': f'#USERID#{userId}'}
+                    },
+                    UpdateExpression='SET #uuid_attr = :uuid, userId = :userId, base_image_object_key = :base_image_object_key, result_object_key = :result_object_key, base_story = :base_story, theme = :theme, updated_at = :updated_at, gender = :gender, skin = :skin, job_created_at = :job_created_at, created_at = if_not_exists(created_at, :updated_at)',
+                    ConditionExpression='attribute_not_exists(PK) OR attribute_not_exists(job_created_at) OR job_created_at <= :job_created_at',
+                    ExpressionAttributeNames={
+                        '#uuid_attr': 'uuid',
+                    },
+                    ExpressionAttributeValues={
+                        ':uuid': {'S': uuid},
+                        ':userId': {'S': userId},
+                        ':base_image_object_key': {'S': base_image_object_key},
+                        ':result_object_key': {'S': result_object_key},
+                        ':base_story': {'S': base_story},
+                        ':theme': {'S': theme},
+                        ':gender': {'S': gender},
+                        ':skin': {'S': skin},
+                        ':job_created_at': {'S': job_created_at},
+                        ':updated_at': {'S': current_time}
+                    }
+                )
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                    raise e
+                print(f"Display row of {userId} already shows a newer job than {uuid}")
+
+        # Append to the time-ordered feed (#TIME#{hour}, {created_at}#{uuid}). The key comes from the job's
+        # creation time, so a redelivered completion overwrites its own item instead of adding another.
+        with phase('history'):
             ddb_client.put_item(
-                TableName=DDB_AMAZON_BEDROCK_GALLERY_DISPLAY_TABLE_NAME,
+                TableName=DDB_AMAZON_BEDROCK_GALLERY_DISPLAY_FEED_TABLE_NAME,
                 Item={
-                    'PK': {'S': f'#USERID#{userId}'},
+                    'PK': {'S': f'#TIME#{datetime.fromisoformat(job_created_at).strftime(TIME_BUCKET_FORMAT)}'},
+                    'SK': {'S': f'{job_created_at}#{uuid}'},
                     'uuid': {'S': uuid},
                     'userId': {'S': userId},
-                    'gender': {'S': gender},
-                    'skin': {'S': skin},
-                    'base_image_object_key': {'S': base_image_object_key},
                     'result_object_key': {'S': result_object_key},
                     'base_story': {'S': base_story},
                     'theme': {'S': theme},
-                    'updated_at': {'S': current_time},
-                    'created_at': {'S': current_time}
+                    'gender': {'S': gender},
+                    'skin': {'S': skin},
+                    'created_at': {'S': job_created_at}
                 }
             )
+
+        # The job reports its completion on its own process record, the only item get-job-status
+        # reads. Jobs the orchestrator started are marked by the orchestrator once restore finished too.
+        with phase('job_status'):
+            try:
+                ddb_client.update_item(
+                    TableName=DDB_AMAZON_BEDROCK_GALLERY_PROCESS_TABLE_NAME,
+                    Key={'PK': {'S': f'#UUID#{uuid}'}},
+                    UpdateExpression='SET job_status = :job_status, updated_at = :updated_at',
+                    ConditionExpression='attribute_not_exists(job_started_at)',
+                    ExpressionAttributeValues={
+                        ':job_status': {'S': 'COMPLETED'},
+                        ':updated_at': {'S': current_time}
+                    }
+                )
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                    raise e
     except Exception as e:
         print(f"error: {str(e)}")
         raise e
+
+    print(f"Face swap complete: {result_object_key}")
+
+def get_process_image_info(uuid):
+    ddb_response = ddb_client.query(
+        TableName=DDB_AMAZON_BEDROCK_GALLERY_PROCESS_TABLE_NAME,
+        KeyConditionExpression='#pk = :pk',
+        ExpressionAttributeNames={
+            '#pk': 'PK'
+        },
+        ExpressionAttributeValues={
+            ':pk': {'S': f'#UUID#{uuid}'}
+        }
+    )
     
-    return {
-        'statusCode': 200,
-        'body': json.dumps('Face swap complete')
-    }
+    if not ddb_response['Items']:
+        raise Exception(f"Could not find image with uuid({uuid})")
+
+    return ddb_response['Items'][0]
@@ -1,28 +1,274 @@
 import json
-import boto3
 import os
+import threading
+import time
 import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
+from gallery_runtime import attach_job_timer, current_job_timer, iter_s3_records, job_id_from_key, job_timer, lazy_client, phase, send_stage_records, stage_record
 
-ddb_client = boto3.client('dynamodb')
-sagemaker_runtime = boto3.client('sagemaker-runtime')
+s3_client = lazy_client('s3')
+ddb_client = lazy_client('dynamodb')
+sagemaker_runtime = lazy_client('sagemaker-runtime')
 
 BUCKET_NAME = os.environ['BUCKET_NAME']
 RESULT_OBJECT_PATH = os.environ['RESULT_OBJECT_PATH']
 FACECHAIN_SAGEMAKER_ENDPOINT_NAME = os.environ['FACECHAIN_SAGEMAKER_ENDPOINT_NAME']
+# Async endpoints take the request body from S3 and return before the result image is written
+FACECHAIN_SAGEMAKER_ENDPOINT_ASYNC = os.environ.get('FACECHAIN_SAGEMAKER_ENDPOINT_ASYNC', 'false').lower() == 'true'
+FACECHAIN_ASYNC_INPUT_PATH = os.environ.get('FACECHAIN_ASYNC_INPUT_PATH', 'async-input/')
+# With a synchronous endpoint in the event pipeline, completions are queued here with the job's metadata
+FACE_SWAP_COMPLETION_QUEUE_URL = os.environ.get('FACE_SWAP_COMPLETION_QUEUE_URL', '')
 DDB_AMAZON_BEDROCK_GALLERY_PROCESS_TABLE_NAME = os.environ['DDB_AMAZON_BEDROCK_GALLERY_PROCESS_TABLE_NAME']
+FACECHAIN_RESTORE_ENABLED = os.environ.get('FACECHAIN_RESTORE_ENABLED', 'false').lower() == 'true'
+FACECHAIN_RESTORE_WEIGHT = float(os.environ.get('FACECHAIN_RESTORE_WEIGHT', '0.5'))
+# Requests go to the primary variant until its queue depth or invoke latency crosses a threshold,
+# then to the overflow variant for the hold time (empty overflow variant: endpoint weights decide)
+FACECHAIN_PRIMARY_VARIANT = os.environ.get('FACECHAIN_PRIMARY_VARIANT', 'FaceChainVariant')
+FACECHAIN_OVERFLOW_VARIANT = os.environ.get('FACECHAIN_OVERFLOW_VARIANT', '')
+FACECHAIN_SPILLOVER_QUEUE_DEPTH = int(os.environ.get('FACECHAIN_SPILLOVER_QUEUE_DEPTH', '2'))
+FACECHAIN_SPILLOVER_LATENCY_MS = float(os.environ.get('FACECHAIN_SPILLOVER_LATENCY_MS', '8000'))
+FACECHAIN_SPILLOVER_HOLD_SECONDS = float(os.environ.get('FACECHAIN_SPILLOVER_HOLD_SECONDS', '15'))
+# Errors of the primary variant that mean it is out of capacity rather than that the request is bad
+CAPACITY_ERROR_CODES = ('ThrottlingException', 'ServiceUnavailable', 'ModelNotReadyException')
+# Records in one SQS batch invoke the endpoint concurrently, up to this many at a time
+MAX_PARALLEL_INVOCATIONS = int(os.environ.get('MAX_PARALLEL_INVOCATIONS', '4'))
+# Themes fused from one face per request, so the fusions fit the 60 second invocation and model server timeouts
+FACECHAIN_MAX_TARGETS_PER_INVOCATION = max(1, int(os.environ.get('FACECHAIN_MAX_TARGETS_PER_INVOCATION', '2')))
+
+class SpilloverRouter:
+    """
+    Chooses between the primary and the overflow variant.
+
+    The primary reports its queue depth in every response, and the router keeps an EWMA of its
+    invoke latency. When either crosses its threshold, or the primary is out of capacity, requests
+    go to the overflow variant for hold_seconds. The next request after that probes the primary.
+    The state is per Lambda container, so every container reaches the same decision from its own requests.
+    """
+
+    def __init__(self, queue_depth_threshold, latency_threshold_ms, hold_seconds, alpha=0.3):
+        self.queue_depth_threshold = queue_depth_threshold
+        self.latency_threshold_ms = latency_threshold_ms
+        self.hold_seconds = hold_seconds
+        self.alpha = alpha
+        self.latency_ewma_ms = None
+        self.spill_until = 0.0
+        self.lock = threading.Lock()
+
+    def spilling(self):
+        return time.time() < self.spill_until
+
+    def spill(self, reason):
+        with self.lock:
+            if not self.spilling():
+                print(f"Spilling over to {FACECHAIN_OVERFLOW_VARIANT} for {self.hold_seconds}s: {reason}")
+            self.spill_until = time.time() + self.hold_seconds
+            # Probing starts from a fresh average once the hold time is over
+            self.latency_ewma_ms = None
+
+    def observe(self, latency_ms, queue_depth):
+        with self.lock:
+            if self.latency_ewma_ms is None:
+                self.latency_ewma_ms = latency_ms
+            else:
+                self.latency_ewma_ms += self.alpha * (latency_ms - self.latency_ewma_ms)
+            latency_ewma_ms = self.latency_ewma_ms
+
+        if self.queue_depth_threshold > 0 and queue_depth >= self.queue_depth_threshold:
+            self.spill(f"queue depth {queue_depth}")
+        elif self.latency_threshold_ms > 0 and latency_ewma_ms >= self.latency_threshold_ms:
+            self.spill(f"latency {latency_ewma_ms:.0f} ms")
+
+
+spillover_router = SpilloverRouter(FACECHAIN_SPILLOVER_QUEUE_DEPTH, FACECHAIN_SPILLOVER_LATENCY_MS, FACECHAIN_SPILLOVER_HOLD_SECONDS)
 
 def lambda_handler(event, context):
-    s3_event = event['Records'][0]['s3']
-    bucket_name = s3_event['bucket']['name']
-    encoded_object_key = s3_event['object']['key']
-    source_object_key = urllib.parse.unquote_plus(encoded_object_key) # user's cropped face image
+    # 배치 내 메시지는 동시에 처리하고, 실패한 메시지만 재시도되도록 보고
+    with ThreadPoolExecutor(max_workers=MAX_PARALLEL_INVOCATIONS) as executor:
+        futures = [
+            (message_id, executor.submit(swap_faces, s3_records))
+            for message_id, s3_records in iter_s3_records(event)
+        ]
+
+    batch_item_failures = []
+    for message_id, future in futures:
+        try:
+            future.result()
+        except Exception as e:
+            print(f"error: {str(e)}")
+            if message_id is None:
+                raise e
+            batch_item_failures.append({'itemIdentifier': message_id})
+
+    return {'batchItemFailures': batch_item_failures}
+
+def swap_faces(s3_records):
+    for s3_record in s3_records:
+        s3_event = s3_record['s3']
+        object_key = urllib.parse.unquote_plus(s3_event['object']['key'])
+        with job_timer('face_swap', job_id_from_key(object_key), s3_record):
+            swap_face(s3_event['bucket']['name'], object_key, s3_record.get('metadata'), s3_record.get('receive_count', 1) > 1)
+
+def swap_face(bucket_name, source_object_key, object_metadata=None, redelivered=False):
+    # source_object_key: user's cropped face image
     source_object_filename = os.path.basename(source_object_key) # source_object_filename: {current_time}-{user_id}-{theme}-{gender}-{skin}-{unique_id}.jpeg
     uuid = os.path.splitext(source_object_filename)[0] 
-    user_id = uuid.split('-')[1]
-    theme = uuid.split('-')[2]
-    gender = uuid.split('-')[3]
-    skin = uuid.split('-')[4]
     
+    # The job's metadata comes with the message from face-crop; the process table is the fallback
+    object_metadata = object_metadata or {}
+    if 'base-image-object-key' in object_metadata:
+        target_object_key = object_metadata['base-image-object-key']
+        sibling_jobs = [urllib.parse.unquote(job_id) for job_id in object_metadata.get('sibling-jobs', '').split(',') if job_id]
+    else:
+        with phase('metadata'):
+            process_item = get_process_item(uuid)
+        target_object_key = process_item['base_image_object_key']['S']
+        sibling_jobs = [value['S'] for value in process_item.get('sibling_jobs', {}).get('L', [])]
+    output_object_key = os.path.join(RESULT_OBJECT_PATH, source_object_filename)
+
+    targets = [{'uuid': uuid, 'target': target_object_key, 'output': output_object_key, 'metadata': object_metadata}]
+    # Jobs of the other themes requested with this upload are fused from the same face
+    if sibling_jobs:
+        with phase('siblings'):
+            targets += [sibling_target(sibling_job, uuid) for sibling_job in sibling_jobs]
+
+    # A redelivered message only fuses the themes whose result is still missing
+    if redelivered:
+        with phase('existing_results'):
+            finished = [target for target in targets if result_exists(target['output'])]
+        targets = [target for target in targets if target not in finished]
+        # An async endpoint's results are delivered by the bucket notification
+        if not FACECHAIN_SAGEMAKER_ENDPOINT_ASYNC:
+            queue_completions(finished)
+        if not targets:
+            print(f"Face swap already complete: {output_object_key}")
+            return
+
+    # Up to FACECHAIN_MAX_TARGETS_PER_INVOCATION themes share the face in one request. While requests spill
+    # over to the slower overflow variant, every theme goes in a request of its own.
+    max_targets = 1 if spillover_router.spilling() else FACECHAIN_MAX_TARGETS_PER_INVOCATION
+    target_groups = [targets[index:index + max_targets] for index in range(0, len(targets), max_targets)]
+
+    if FACECHAIN_SAGEMAKER_ENDPOINT_ASYNC:
+        # The result images still trigger face-swap-completion once the endpoint has written them
+        with phase('invoke_endpoint_async'):
+            for target_group in target_groups:
+                input_object_key = os.path.join(FACECHAIN_ASYNC_INPUT_PATH, f"{target_group[0]['uuid']}.json")
+                s3_client.put_object(Bucket=BUCKET_NAME, Key=input_object_key, Body=json.dumps(facechain_request(source_object_key, target_group)), ContentType='application/json')
+                sagemaker_runtime.invoke_endpoint_async(
+                    EndpointName=FACECHAIN_SAGEMAKER_ENDPOINT_NAME,
+                    ContentType='application/json',
+                    InputLocation=f's3://{BUCKET_NAME}/{input_object_key}'
+                )
+        print(f"Face swap queued: {output_object_key}")
+        return
+
+    # The requests run concurrently, so the endpoint spreads them over its instances
+    timer = current_job_timer()
+    if len(target_groups) == 1:
+        swap_targets(source_object_key, targets, timer)
+    else:
+        with ThreadPoolExecutor(max_workers=len(target_groups)) as executor:
+            futures = [executor.submit(swap_targets, source_object_key, target_group, timer) for target_group in target_groups]
+        # Every group has finished and queued its completions before a failed one fails the message
+        errors = [future.exception() for future in futures if future.exception()]
+        if errors:
+            raise errors[0]
+    print(f"Face swap complete: {output_object_key}")
+
+def swap_targets(source_object_key, targets, timer):
+    # Runs on a worker thread for all but single-group uploads; its phases still belong to the job
+    with attach_job_timer(timer):
+        invoke_facechain(json.dumps(facechain_request(source_object_key, targets)), len(targets))
+        queue_completions(targets)
+
+def facechain_request(source_object_key, targets):
+    request_body = {
+        'bucket': BUCKET_NAME,
+        'source': source_object_key,
+        'restore': FACECHAIN_RESTORE_ENABLED,
+        'restore_weight': FACECHAIN_RESTORE_WEIGHT
+    }
+    # One target keeps the single-target form, with its fields at the top level
+    if len(targets) == 1:
+        request_body.update(targets[0])
+    else:
+        request_body['targets'] = targets
+    return request_body
+
+def queue_completions(targets):
+    if FACE_SWAP_COMPLETION_QUEUE_URL and targets:
+        with phase('next_stage'):
+            send_stage_records(FACE_SWAP_COMPLETION_QUEUE_URL, [
+                stage_record(BUCKET_NAME, target['output'], target['metadata'])
+                for target in targets
+            ])
+
+def result_exists(object_key):
+    try:
+        s3_client.head_object(Bucket=BUCKET_NAME, Key=object_key)
+        return True
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+            return False
+        raise e
+
+def invoke_facechain(body, fusions=1):
+    # Includes the endpoint's own fetch/fuse/upload phases, emitted by the predictor under the same job id
+    if not FACECHAIN_OVERFLOW_VARIANT:
+        with phase('invoke_endpoint'):
+            return sagemaker_runtime.invoke_endpoint(EndpointName=FACECHAIN_SAGEMAKER_ENDPOINT_NAME, ContentType='application/json', Body=body)
+
+    if spillover_router.spilling():
+        return invoke_variant(FACECHAIN_OVERFLOW_VARIANT, body, 'invoke_overflow')
+
+    started_at = time.time()
+    try:
+        response = invoke_variant(FACECHAIN_PRIMARY_VARIANT, body, 'invoke_endpoint')
+    except ClientError as e:
+        if not is_capacity_error(e):
+            raise e
+        spillover_router.spill(e.response['Error']['Code'])
+        return invoke_variant(FACECHAIN_OVERFLOW_VARIANT, body, 'invoke_overflow')
+
+    model_status = json.loads(response['Body'].read()).get('model_status', {})
+    # The latency threshold is per fusion, whatever the number of themes in the request
+    spillover_router.observe((time.time() - started_at) * 1000 / fusions, model_status.get('queue_depth', 0))
+    return response
+
+def invoke_variant(variant_name, body, phase_name):
+    with phase(phase_name):
+        return sagemaker_runtime.invoke_endpoint(
+            EndpointName=FACECHAIN_SAGEMAKER_ENDPOINT_NAME,
+            TargetVariant=variant_name,
+            ContentType='application/json',
+            Body=body
+        )
+
+def is_capacity_error(e):
+    error = e.response.get('Error', {})
+    if error.get('Code') in CAPACITY_ERROR_CODES:
+        return True
+    # The container answered 503/429, e.g. while /ping reports it as overloaded
+    return error.get('Code') == 'ModelError' and e.response.get('OriginalStatusCode') in (429, 503)
+
+def sibling_target(sibling_job, primary_job):
+    base_image_object_key = get_base_image_object_key(sibling_job)
+    # face-swap-completion reads the rest of the sibling's process record from the table
+    metadata = {'primary-job': urllib.parse.quote(primary_job)}
+    if base_image_object_key.isascii():
+        metadata['base-image-object-key'] = base_image_object_key
+    return {
+        'uuid': sibling_job,
+        'target': base_image_object_key,
+        'output': os.path.join(RESULT_OBJECT_PATH, f'{sibling_job}.jpeg'),
+        'metadata': metadata
+    }
+
+def get_base_image_object_key(uuid):
+    return get_process_item(uuid)['base_image_object_key']['S']
+
+def get_process_item(uuid):
     ddb_response = ddb_client.query(
         TableName=DDB_AMAZON_BEDROCK_GALLERY_PROCESS_TABLE_NAME,
         KeyConditionExpression='#pk = :pk',
@@ -37,24 +283,4 @@ def lambda_handler(event, context):
     if not ddb_response['Items']:
         raise Exception(f"Could not find image with uuid({uuid})")
     
-    target_object_key = ddb_response['Items'][0]['base_image_object_key']['S']
-    output_object_key = os.path.join(RESULT_OBJECT_PATH, source_object_filename)
-
-    request_body = {
-        'uuid': uuid,
-        'bucket': BUCKET_NAME,
-        'source': source_object_key,
-        'target': target_object_key,
-        'output': output_object_key
-    }
-    
-    sagemaker_runtime.invoke_endpoint(
-        EndpointName=FACECHAIN_SAGEMAKER_ENDPOINT_NAME,
-        ContentType='application/json',
-        Body=json.dumps(request_body)
-    )
-    
-    return {
-        'statusCode': 200,
-        'body': json.dumps('Face swap complete')
-    }
\ No newline at end of file
+    return ddb_response['Items'][0]
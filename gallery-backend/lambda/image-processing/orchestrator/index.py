@@ -0,0 +1,237 @@
+import json
+import os
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from gallery_runtime import iter_s3_records, job_id_from_key, job_timer, lazy_client, phase, stage_record
+
+lambda_client = lazy_client('lambda')
+sagemaker_runtime = lazy_client('sagemaker-runtime')
+ddb_client = lazy_client('dynamodb')
+
+DDB_AMAZON_BEDROCK_GALLERY_PROCESS_TABLE_NAME = os.environ['DDB_AMAZON_BEDROCK_GALLERY_PROCESS_TABLE_NAME']
+FACE_CROPPED_OBJECT_PATH = os.environ['FACE_CROPPED_OBJECT_PATH']
+RESULT_OBJECT_PATH = os.environ['RESULT_OBJECT_PATH']
+FACE_CROP_FUNCTION_NAME = os.environ.get('FACE_CROP_FUNCTION_NAME')
+FACE_SWAP_FUNCTION_NAME = os.environ.get('FACE_SWAP_FUNCTION_NAME')
+FACE_SWAP_COMPLETION_FUNCTION_NAME = os.environ.get('FACE_SWAP_COMPLETION_FUNCTION_NAME')
+# GFPGAN endpoint for the restore stage; the stage is skipped when it is not set
+RESTORE_SAGEMAKER_ENDPOINT_NAME = os.environ.get('RESTORE_SAGEMAKER_ENDPOINT_NAME', '')
+RESTORE_WEIGHT = float(os.environ.get('RESTORE_WEIGHT', '0.5'))
+# Comma separated stage names to skip, e.g. "crop" when uploads are already cropped faces
+SKIP_STAGES = [stage for stage in os.environ.get('SKIP_STAGES', '').split(',') if stage]
+
+# Stages run group by group; stages in the same group run in parallel on the same input object.
+# Restoring the result in place runs alongside the display-row write in face-swap-completion.
+PIPELINE = [
+    ['crop'],
+    ['swap'],
+    ['restore', 'complete'],
+]
+
+# Object metadata of the jobs in progress, returned by face-crop and passed with the later stage events
+job_metadata = {}
+
+def lambda_handler(event, context):
+    # S3 이벤트 처리 (SQS 배치 또는 직접 S3 이벤트), 실패한 메시지만 재시도되도록 보고
+    batch_item_failures = []
+    for message_id, s3_records in iter_s3_records(event):
+        try:
+            for s3_record in s3_records:
+                s3_event = s3_record['s3']
+                object_key = urllib.parse.unquote_plus(s3_event['object']['key'])
+                with job_timer('orchestrator', job_id_from_key(object_key), s3_record):
+                    run_pipeline(s3_event['bucket']['name'], object_key)
+        except Exception as e:
+            print(f"error: {str(e)}")
+            if message_id is None:
+                raise e
+            batch_item_failures.append({'itemIdentifier': message_id})
+
+    return {'batchItemFailures': batch_item_failures}
+
+def run_pipeline(bucket_name, object_key, runners=None, skip_stages=None):
+    """
+    Drive one job (the uploaded object name, {current_time}-{user_id}-{theme}-{gender}-{skin}-{unique_id})
+    through PIPELINE and record every stage in the job's process table item.
+
+    runners maps stage name -> function(bucket_name, object_key) returning the stage's output key,
+    or (output key, names of later stages to skip), so the pipeline can run locally against
+    stand-ins for the stage Lambdas and endpoints.
+    """
+    runners = runners or STAGE_RUNNERS
+    skip_stages = list(SKIP_STAGES if skip_stages is None else skip_stages)
+    job_id = os.path.splitext(os.path.basename(object_key))[0]
+
+    start_job(job_id)
+    pipeline_start = time.time()
+    try:
+        for group in PIPELINE:
+            stages = [stage for stage in group if stage not in skip_stages and runners.get(stage)]
+            for stage in group:
+                if stage not in stages:
+                    update_stage(job_id, stage, {'status': {'S': 'SKIPPED'}})
+
+            if not stages:
+                continue
+            # Parallel stages are recorded as one phase, e.g. restore+complete
+            with phase('+'.join(stages)):
+                if len(stages) == 1:
+                    output_keys = [run_stage(job_id, stages[0], runners[stages[0]], bucket_name, object_key)]
+                else:
+                    with ThreadPoolExecutor(max_workers=len(stages)) as executor:
+                        futures = [
+                            executor.submit(run_stage, job_id, stage, runners[stage], bucket_name, object_key)
+                            for stage in stages
+                        ]
+                        output_keys = [future.result() for future in futures]
+
+            for index, output_key in enumerate(output_keys):
+                if isinstance(output_key, tuple):
+                    output_keys[index], later_skip_stages = output_key
+                    skip_stages.extend(later_skip_stages)
+
+            # The next group works on the first stage's output (parallel branches work on the same object)
+            object_key = output_keys[0] or object_key
+    except Exception as e:
+        finish_job(job_id, 'FAILED', pipeline_start, error=str(e))
+        raise e
+    finally:
+        job_metadata.pop(job_id, None)
+
+    finish_job(job_id, 'COMPLETED', pipeline_start)
+    print(f"Pipeline complete: {job_id} ({(time.time() - pipeline_start) * 1000:.0f} ms)")
+    return job_id
+
+def run_stage(job_id, stage, runner, bucket_name, object_key):
+    started_at = datetime.now().isoformat()
+    start = time.time()
+    update_stage(job_id, stage, {'status': {'S': 'RUNNING'}, 'started_at': {'S': started_at}})
+    try:
+        output_key = runner(bucket_name, object_key)
+    except Exception as e:
+        update_stage(job_id, stage, {
+            'status': {'S': 'FAILED'},
+            'started_at': {'S': started_at},
+            'finished_at': {'S': datetime.now().isoformat()},
+            'duration_ms': {'N': str(int((time.time() - start) * 1000))},
+            'error': {'S': str(e)}
+        })
+        raise e
+
+    update_stage(job_id, stage, {
+        'status': {'S': 'COMPLETED'},
+        'started_at': {'S': started_at},
+        'finished_at': {'S': datetime.now().isoformat()},
+        'duration_ms': {'N': str(int((time.time() - start) * 1000))}
+    })
+    return output_key
+
+def start_job(job_id):
+    # The stages map has to exist before the per-stage updates can set its entries
+    ddb_client.update_item(
+        TableName=DDB_AMAZON_BEDROCK_GALLERY_PROCESS_TABLE_NAME,
+        Key={'PK': {'S': f'#UUID#{job_id}'}},
+        UpdateExpression='SET stages = :stages, job_status = :job_status, job_started_at = :started_at, updated_at = :started_at REMOVE job_error',
+        ExpressionAttributeValues={
+            ':stages': {'M': {}},
+            ':job_status': {'S': 'RUNNING'},
+            ':started_at': {'S': datetime.now().isoformat()}
+        }
+    )
+
+def update_stage(job_id, stage, value):
+    ddb_client.update_item(
+        TableName=DDB_AMAZON_BEDROCK_GALLERY_PROCESS_TABLE_NAME,
+        Key={'PK': {'S': f'#UUID#{job_id}'}},
+        UpdateExpression='SET stages.#stage = :value, updated_at = :updated_at',
+        ExpressionAttributeNames={'#stage': stage},
+        ExpressionAttributeValues={
+            ':value': {'M': value},
+            ':updated_at': {'S': datetime.now().isoformat()}
+        }
+    )
+
+def finish_job(job_id, job_status, pipeline_start, error=None):
+    update_expression = 'SET job_status = :job_status, job_finished_at = :finished_at, job_duration_ms = :duration_ms, updated_at = :finished_at'
+    expression_attribute_values = {
+        ':job_status': {'S': job_status},
+        ':finished_at': {'S': datetime.now().isoformat()},
+        ':duration_ms': {'N': str(int((time.time() - pipeline_start) * 1000))}
+    }
+    if error is not None:
+        update_expression += ', job_error = :job_error'
+        expression_attribute_values[':job_error'] = {'S': error}
+
+    ddb_client.update_item(
+        TableName=DDB_AMAZON_BEDROCK_GALLERY_PROCESS_TABLE_NAME,
+        Key={'PK': {'S': f'#UUID#{job_id}'}},
+        UpdateExpression=update_expression,
+        ExpressionAttributeValues=expression_attribute_values
+    )
+
+def invoke_stage_function(function_name, bucket_name, *object_keys):
+    # The stage Lambdas take the same S3 event shape they receive from the bucket notifications,
+    # with the job's metadata so they skip the process table lookup
+    s3_event = {'Records': [
+        stage_record(bucket_name, object_key, job_metadata.get(job_id_from_key(object_key)))
+        for object_key in object_keys
+    ]}
+    response = lambda_client.invoke(
+        FunctionName=function_name,
+        InvocationType='RequestResponse',
+        Payload=json.dumps(s3_event)
+    )
+    payload = response['Payload'].read()
+    if 'FunctionError' in response:
+        raise Exception(f"{function_name} failed: {payload.decode('utf-8')}")
+    return json.loads(payload) if payload else None
+
+def crop(bucket_name, object_key):
+    payload = invoke_stage_function(FACE_CROP_FUNCTION_NAME, bucket_name, object_key)
+    job_metadata.update((payload or {}).get('metadata', {}))
+    if payload and payload.get('deduplicated'):
+        # face-crop copied the result of an earlier job with the same face and base image
+        return payload['deduplicated'][0], ['swap', 'restore']
+    return os.path.join(FACE_CROPPED_OBJECT_PATH, os.path.basename(object_key))
+
+def swap(bucket_name, object_key):
+    invoke_stage_function(FACE_SWAP_FUNCTION_NAME, bucket_name, object_key)
+    return os.path.join(RESULT_OBJECT_PATH, os.path.basename(object_key))
+
+def restore(bucket_name, object_key):
+    # Restore the face region of the result in place, at the result's resolution
+    sagemaker_runtime.invoke_endpoint(
+        EndpointName=RESTORE_SAGEMAKER_ENDPOINT_NAME,
+        ContentType='application/json',
+        Body=json.dumps({
+            'bucket': bucket_name,
+            'source': object_key,
+            'output': object_key,
+            'weight': RESTORE_WEIGHT,
+            'mode': 'face'
+        })
+    )
+    return object_key
+
+def complete(bucket_name, object_key):
+    # face-swap also wrote the results of the other themes requested with this upload; complete them together
+    sibling_keys = [os.path.join(RESULT_OBJECT_PATH, f'{job_id}.jpeg') for job_id in get_sibling_jobs(job_id_from_key(object_key))]
+    invoke_stage_function(FACE_SWAP_COMPLETION_FUNCTION_NAME, bucket_name, object_key, *sibling_keys)
+    return object_key
+
+def get_sibling_jobs(job_id):
+    process_item = ddb_client.get_item(
+        TableName=DDB_AMAZON_BEDROCK_GALLERY_PROCESS_TABLE_NAME,
+        Key={'PK': {'S': f'#UUID#{job_id}'}},
+        ProjectionExpression='sibling_jobs'
+    ).get('Item', {})
+    return [value['S'] for value in process_item.get('sibling_jobs', {}).get('L', [])]
+
+STAGE_RUNNERS = {
+    'crop': crop,
+    'swap': swap,
+    'restore': restore if RESTORE_SAGEMAKER_ENDPOINT_NAME else None,
+    'complete': complete,
+}
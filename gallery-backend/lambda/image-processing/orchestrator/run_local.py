@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# Run the orchestrator locally with stubbed AWS clients and stage runners that only sleep.
+#
+#   python run_local.py --crop-ms 300 --swap-ms 2500 --restore-ms 800 --complete-ms 150
+#   python run_local.py --skip crop
+#
+# Prints the recorded job state item, so stage ordering, skipping and parallel branches can be
+# checked without a deployment.
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('DDB_AMAZON_BEDROCK_GALLERY_PROCESS_TABLE_NAME', 'local-process-table')
+os.environ.setdefault('FACE_CROPPED_OBJECT_PATH', 'face-cropped/')
+os.environ.setdefault('RESULT_OBJECT_PATH', 'result/')
+# In Lambda the shared runtime comes from the GalleryRuntime layer (/opt/python)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'layers', 'gallery-runtime', 'python'))
+
+import index
+
+
+class StubDynamoDB:
+    """Applies the orchestrator's update_item calls to an in-memory item."""
+
+    def __init__(self):
+        self.items = {}
+        self.lock = threading.Lock()
+
+    def update_item(self, TableName, Key, UpdateExpression, ExpressionAttributeValues, ExpressionAttributeNames=None, **kwargs):
+        names = ExpressionAttributeNames or {}
+        with self.lock:
+            item = self.items.setdefault(Key['PK']['S'], {})
+            set_clause, _, remove_clause = UpdateExpression.partition(' REMOVE ')
+            for assignment in set_clause[len('SET '):].split(', '):
+                path, value = assignment.split(' = ')
+                value = ExpressionAttributeValues[value]
+                if '.' in path:
+                    attribute, entry = path.split('.')
+                    item[attribute]['M'][names.get(entry, entry)] = value
+                else:
+                    item[path] = value
+            for attribute in filter(None, remove_clause.split(', ')):
+                item.pop(attribute, None)
+
+
+def sleeping_runner(name, milliseconds, output_path=None):
+    def runner(bucket_name, object_key):
+        print(f"{name}: {bucket_name}/{object_key}")
+        time.sleep(milliseconds / 1000)
+        return os.path.join(output_path, os.path.basename(object_key)) if output_path else object_key
+    return runner
+
+
+def plain(value):
+    # Strip the DynamoDB type descriptors for printing
+    if isinstance(value, dict) and len(value) == 1:
+        (kind, inner), = value.items()
+        if kind == 'M':
+            return {key: plain(item) for key, item in inner.items()}
+        if kind == 'N':
+            return int(inner)
+        return inner
+    return {key: plain(item) for key, item in value.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the image-processing orchestrator with stubbed AWS clients")
+    parser.add_argument('--object-key', default='face-image/2025010100-visitor-theme-female-light-0a1b2c3d.jpeg')
+    parser.add_argument('--crop-ms', type=int, default=300)
+    parser.add_argument('--swap-ms', type=int, default=2500)
+    parser.add_argument('--restore-ms', type=int, default=800)
+    parser.add_argument('--complete-ms', type=int, default=150)
+    parser.add_argument('--skip', default='', help="comma separated stage names to skip")
+    args = parser.parse_args()
+
+    index.ddb_client = StubDynamoDB()
+    runners = {
+        'crop': sleeping_runner('crop', args.crop_ms, index.FACE_CROPPED_OBJECT_PATH),
+        'swap': sleeping_runner('swap', args.swap_ms, index.RESULT_OBJECT_PATH),
+        'restore': sleeping_runner('restore', args.restore_ms),
+        'complete': sleeping_runner('complete', args.complete_ms),
+    }
+
+    job_id = index.run_pipeline('local-bucket', args.object_key, runners=runners,
+                                skip_stages=[stage for stage in args.skip.split(',') if stage])
+    print(json.dumps(plain(index.ddb_client.items[f'#UUID#{job_id}']), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,333 @@
+# Shared runtime for the gallery Lambda functions, deployed as the GalleryRuntime layer (/opt/python).
+#
+# Clients are created on first use instead of at import, so a cold start only pays for the services
+# the invocation actually touches, and all clients share one session and connection settings.
+#
+# Parameter                Environment Variable              Default Value
+# ---------                --------------------              -------------
+# pooled connections       AWS_MAX_POOL_CONNECTIONS          50
+# connect timeout          AWS_CONNECT_TIMEOUT               5 seconds
+# read timeout             AWS_READ_TIMEOUT                  70 seconds
+# metrics namespace        METRICS_NAMESPACE                 AmazonBedrockGallery
+
+import importlib
+import json
+import os
+import threading
+import time
+import urllib.parse
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+AWS_MAX_POOL_CONNECTIONS = int(os.environ.get('AWS_MAX_POOL_CONNECTIONS', 50))
+AWS_CONNECT_TIMEOUT = float(os.environ.get('AWS_CONNECT_TIMEOUT', 5))
+AWS_READ_TIMEOUT = float(os.environ.get('AWS_READ_TIMEOUT', 70))
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'AmazonBedrockGallery')
+
+CORS_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Headers': 'Content-Type,X-Amz-Date,Authorization,X-Api-Key,X-Amz-Security-Token',
+    'Access-Control-Allow-Methods': 'OPTIONS,GET,POST'
+}
+
+_session = None
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(service_name: str):
+    """Return the shared client for service_name, creating it (and the boto3 session) on first use."""
+    global _session
+    client = _clients.get(service_name)
+    if client is not None:
+        return client
+
+    with _clients_lock:
+        if service_name not in _clients:
+            import boto3
+            from botocore.config import Config
+
+            if _session is None:
+                _session = boto3.session.Session()
+            _clients[service_name] = _session.client(service_name, config=Config(
+                max_pool_connections=AWS_MAX_POOL_CONNECTIONS,
+                connect_timeout=AWS_CONNECT_TIMEOUT,
+                read_timeout=AWS_READ_TIMEOUT,
+                tcp_keepalive=True,
+                retries={'mode': 'standard'}
+            ))
+        return _clients[service_name]
+
+
+def set_client(service_name: str, client) -> None:
+    """Replace the shared client, e.g. with a stub for local runs."""
+    with _clients_lock:
+        _clients[service_name] = client
+
+
+class LazyClient:
+    """Module-level stand-in for a boto3 client; the real client is created on first attribute access."""
+
+    def __init__(self, service_name: str):
+        self._service_name = service_name
+
+    def __getattr__(self, name):
+        return getattr(get_client(self._service_name), name)
+
+
+def lazy_client(service_name: str) -> LazyClient:
+    return LazyClient(service_name)
+
+
+class LazyModule:
+    """Defers importing a heavy module (numpy, cv2, ...) until one of its attributes is used."""
+
+    def __init__(self, module_name: str):
+        self._module_name = module_name
+        self._module = None
+
+    def __getattr__(self, name):
+        if self._module is None:
+            self._module = importlib.import_module(self._module_name)
+        return getattr(self._module, name)
+
+
+def lazy_import(module_name: str) -> LazyModule:
+    return LazyModule(module_name)
+
+
+def create_response(status_code: int, body: Optional[Dict[str, Any]], headers: Dict[str, str] = None) -> Dict[str, Any]:
+    return {
+        'statusCode': status_code,
+        'body': json.dumps(body) if body is not None else '',
+        'headers': {
+            'Content-Type': 'application/json',
+            **CORS_HEADERS,
+            **(headers or {})
+        }
+    }
+
+
+def presign_get_object(bucket_name: str, object_key: str, expires_in: int = 300, content_type: str = 'image/jpeg') -> str:
+    # Presigning is local signing work; only the client creation touches botocore
+    return get_client('s3').generate_presigned_url(
+        'get_object',
+        Params={
+            'Bucket': bucket_name,
+            'Key': object_key,
+            'ResponseContentType': content_type
+        },
+        ExpiresIn=str(expires_in)
+    )
+
+
+def long_poll(read: Callable[[], Any], done: Callable[[Any], bool], wait_seconds: float,
+              interval: float = 1.0, max_interval: float = 5.0, backoff: float = 1.5) -> Any:
+    """
+    Call read() until done(result) or wait_seconds have passed, and return the last result.
+
+    The interval between reads starts at interval and grows by backoff up to max_interval, so a
+    request held for 20 seconds costs seven reads: a change right after the request still shows
+    within a second, and a long wait stays cheap.
+    """
+    deadline = time.time() + wait_seconds
+    result = read()
+    while not done(result) and time.time() + interval < deadline:
+        time.sleep(interval)
+        result = read()
+        interval = min(interval * backoff, max_interval)
+    return result
+
+
+def iter_s3_records(event: Dict[str, Any]) -> Iterator[Tuple[Optional[str], List[Dict[str, Any]]]]:
+    """
+    Yield (SQS message id, S3 records) pairs; the message id is None for direct S3 events.
+
+    The records of an SQS message carry its receive_count, so a stage can tell a redelivery apart.
+    """
+    for record in event.get('Records', []):
+        if record.get('eventSource') == 'aws:sqs':
+            body = json.loads(record['body'])
+            receive_count = int(record.get('attributes', {}).get('ApproximateReceiveCount', 1))
+            # S3 sends an s3:TestEvent without records when the notification is first configured
+            s3_records = body.get('Records', [])
+            for s3_record in s3_records:
+                s3_record['receive_count'] = receive_count
+            yield record['messageId'], s3_records
+        else:
+            yield None, [record]
+
+
+def stage_record(bucket_name: str, object_key: str, metadata: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+    """
+    S3 event record for object_key, as a stage receives it from the bucket notification.
+
+    metadata is the job's object metadata (base-image-object-key, base-story, ...); a stage that
+    finds it on the record skips the process table lookup.
+    """
+    record = {
+        'eventSource': 'aws:s3',
+        'eventTime': datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
+        's3': {'bucket': {'name': bucket_name}, 'object': {'key': urllib.parse.quote_plus(object_key)}}
+    }
+    if metadata is not None:
+        record['metadata'] = metadata
+    return record
+
+
+def send_stage_records(queue_url: str, records: List[Dict[str, Any]]) -> None:
+    """Queue records for the next stage, one message per record so each job is retried on its own."""
+    for record in records:
+        get_client('sqs').send_message(QueueUrl=queue_url, MessageBody=json.dumps({'Records': [record]}))
+
+
+def from_ddb_value(value: Dict[str, Any]) -> Any:
+    (kind, inner), = value.items()
+    if kind == 'M':
+        return from_ddb_item(inner)
+    if kind == 'L':
+        return [from_ddb_value(item) for item in inner]
+    if kind == 'N':
+        return int(inner) if inner.lstrip('-').isdigit() else float(inner)
+    if kind == 'NULL':
+        return None
+    return inner
+
+
+def from_ddb_item(item: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """Strip the DynamoDB type descriptors from a low-level client item."""
+    if item is None:
+        return None
+    return {key: from_ddb_value(value) for key, value in item.items()}
+
+
+def job_id_from_key(object_key: str) -> str:
+    # Pipeline objects are named {job id}.{ext} under every prefix
+    return os.path.splitext(os.path.basename(object_key))[0]
+
+
+def s3_event_time(s3_record: Dict[str, Any]) -> Optional[float]:
+    event_time = s3_record.get('eventTime')
+    if not event_time:
+        return None
+    return datetime.strptime(event_time.replace('Z', '+0000'), '%Y-%m-%dT%H:%M:%S.%f%z').timestamp()
+
+
+class JobTimer:
+    """
+    Per-phase timings of one job in one stage, emitted as a single CloudWatch embedded metric format
+    (EMF) log line: {phase}_ms metrics per Stage, with job_id and the phase offsets as properties,
+    so tools/pipeline_waterfall.py can join the lines of every stage into a per-job waterfall.
+    """
+
+    def __init__(self, stage: str, job_id: Optional[str] = None, **properties):
+        self.stage = stage
+        self.job_id = job_id
+        self.properties = properties
+        self.status = 'ok'
+        self.started_at = time.time()
+        # (name, started_at, finished_at), in the order they finished
+        self.phases = []
+
+    def add_phase(self, name: str, started_at: float, finished_at: float) -> None:
+        self.phases.append((name, started_at, finished_at))
+
+    @contextmanager
+    def phase(self, name: str):
+        started_at = time.time()
+        try:
+            yield
+        finally:
+            self.add_phase(name, started_at, time.time())
+
+    def record(self, finished_at: float = None) -> Dict[str, Any]:
+        finished_at = finished_at or time.time()
+        origin = min([self.started_at] + [started_at for _, started_at, _ in self.phases])
+        metrics = {}
+        for name, started_at, phase_finished_at in self.phases:
+            metrics[f'{name}_ms'] = metrics.get(f'{name}_ms', 0) + round((phase_finished_at - started_at) * 1000, 1)
+        metrics['total_ms'] = round((finished_at - origin) * 1000, 1)
+
+        return {
+            '_aws': {
+                'Timestamp': int(origin * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': METRICS_NAMESPACE,
+                    'Dimensions': [['Stage']],
+                    'Metrics': [{'Name': name, 'Unit': 'Milliseconds'} for name in metrics]
+                }]
+            },
+            'Stage': self.stage,
+            'job_id': self.job_id,
+            'status': self.status,
+            'started_at_ms': int(origin * 1000),
+            # [name, offset from started_at_ms, duration] for the waterfall
+            'phases': [
+                [name, round((started_at - origin) * 1000, 1), round((phase_finished_at - started_at) * 1000, 1)]
+                for name, started_at, phase_finished_at in self.phases
+            ],
+            **metrics,
+            **self.properties
+        }
+
+    def emit(self) -> None:
+        if self.job_id:
+            print(json.dumps(self.record()))
+
+
+_current_timer = threading.local()
+
+
+@contextmanager
+def job_timer(stage: str, job_id: Optional[str] = None, s3_record: Dict[str, Any] = None, **properties):
+    """
+    Time one job through this stage and emit its timings on exit (status "error" if it raised).
+
+    With the S3 record that triggered the stage, the time since the object was written is recorded
+    as the queue_wait phase. phase() calls on the same thread are recorded on this timer, and on
+    worker threads that attach_job_timer() it.
+    """
+    timer = JobTimer(stage, job_id, **properties)
+    event_time = s3_event_time(s3_record) if s3_record else None
+    if event_time and event_time < timer.started_at:
+        timer.add_phase('queue_wait', event_time, timer.started_at)
+
+    previous_timer = getattr(_current_timer, 'timer', None)
+    _current_timer.timer = timer
+    try:
+        yield timer
+    except Exception as e:
+        timer.status = 'error'
+        timer.properties['error'] = str(e)
+        raise
+    finally:
+        _current_timer.timer = previous_timer
+        timer.emit()
+
+
+def current_job_timer() -> Optional[JobTimer]:
+    """The job_timer active on this thread, to hand to the worker threads of the job."""
+    return getattr(_current_timer, 'timer', None)
+
+
+@contextmanager
+def attach_job_timer(timer: Optional[JobTimer]):
+    """Record phase() calls on this thread on timer, a job_timer started on another thread."""
+    previous_timer = getattr(_current_timer, 'timer', None)
+    _current_timer.timer = timer
+    try:
+        yield timer
+    finally:
+        _current_timer.timer = previous_timer
+
+
+@contextmanager
+def phase(name: str):
+    """Record a phase on the job_timer active on this thread, if any."""
+    timer = getattr(_current_timer, 'timer', None)
+    if timer is None:
+        yield
+        return
+    with timer.phase(name):
+        yield
@@ -0,0 +1,48 @@
+#!/usr/bin/env bash
+
+# Builds the layer for face_detector=opencv and publishes it; pass the printed ARN as
+# opencv_face_detector_layer_arn. The layer holds opencv-python-headless for the Python 3.11
+# x86_64 runtime under python/ and the res10 SSD face model under face-detector/ (/opt/face-detector).
+#
+# Usage: ./build_and_publish.sh <bucket>
+# The zip is larger than a direct upload allows, so it is published from s3://<bucket>/layers/.
+
+set -e
+
+bucket=$1
+if [ -z "${bucket}" ]
+then
+    echo "Usage: $0 <bucket>" >&2
+    exit 1
+fi
+
+layer_name=opencv-face-detector
+
+# Region, defaults to us-west-2
+region=$(aws configure get region)
+
+build_dir=$(mktemp -d)
+trap 'rm -rf "${build_dir}"' EXIT
+mkdir -p ${build_dir}/python ${build_dir}/face-detector
+
+# Wheels for the Lambda runtime, so the layer can be built on any machine. numpy comes along as
+# the version cv2 was built against and takes precedence over the numpy layer.
+pip install opencv-python-headless \
+    --platform manylinux2014_x86_64 --implementation cp --python-version 3.11 --only-binary=:all: \
+    --target ${build_dir}/python
+
+curl -fsSL -o ${build_dir}/face-detector/deploy.prototxt \
+    https://raw.githubusercontent.com/opencv/opencv/4.x/samples/dnn/face_detector/deploy.prototxt
+curl -fsSL -o ${build_dir}/face-detector/res10_300x300_ssd_iter_140000.caffemodel \
+    https://raw.githubusercontent.com/opencv/opencv_3rdparty/dnn_samples_face_detector_20170830/res10_300x300_ssd_iter_140000.caffemodel
+
+(cd ${build_dir} && zip -qr ${layer_name}.zip python face-detector)
+aws s3 cp --region ${region} ${build_dir}/${layer_name}.zip s3://${bucket}/layers/${layer_name}.zip
+
+aws lambda publish-layer-version \
+    --region ${region} \
+    --layer-name ${layer_name} \
+    --content S3Bucket=${bucket},S3Key=layers/${layer_name}.zip \
+    --compatible-runtimes python3.11 \
+    --compatible-architectures x86_64 \
+    --query LayerVersionArn --output text
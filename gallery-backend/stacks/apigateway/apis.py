@@ -17,12 +17,17 @@ class ApiGatewayApisStack(Stack):
         # Retrieve S3 bucket name and object path from context
         self.s3_base_bucket_name = self.node.try_get_context("s3_base_bucket_name")
         self.s3_face_images_path = self.node.try_get_context("s3_face_images_path")
+        self.s3_result_images_path = self.node.try_get_context("s3_result_images_path")
         self.ddb_amazon_bedrock_gallery_process_table_name = self.node.try_get_context("ddb_amazon_bedrock_gallery_process_table_name")
         self.ddb_amazon_bedrock_gallery_display_table_name = self.node.try_get_context("ddb_amazon_bedrock_gallery_display_table_name")
         self.ddb_amazon_bedrock_gallery_display_history_table_name = self.node.try_get_context("ddb_amazon_bedrock_gallery_display_history_table_name")
+        self.ddb_amazon_bedrock_gallery_display_feed_table_name = self.node.try_get_context("ddb_amazon_bedrock_gallery_display_feed_table_name") or f"{self.ddb_amazon_bedrock_gallery_display_history_table_name}-feed"
         self.ddb_amazon_bedrock_gallery_base_resource_table_name = self.node.try_get_context("ddb_amazon_bedrock_gallery_base_resource_table_name")
         self.ddb_amazon_bedrock_user_agreement_table_name = self.node.try_get_context("ddb_amazon_bedrock_user_agreement_table_name")
 
+        # Shared runtime layer used by every API function
+        self.runtime_layer = self.create_runtime_layer()
+
         # Create API Gateway
         self.api_gateway = self.create_api_gateway()
 
@@ -85,6 +90,56 @@ class ApiGatewayApisStack(Stack):
             ]
         )
 
+        # Create API resources: /apis/jobs/{jobId}
+        self.get_job_status_resource = apis_resource.add_resource("jobs").add_resource("{jobId}")
+
+        # Create Lambda function for job status long-polling
+        self.get_job_status_lambda = self.create_get_job_status_lambda_function(
+            lambda_path="lambda/apis/get-job-status"
+        )
+
+        # Add GET method
+        self.get_job_status_resource.add_method(
+            "GET",
+            apigw.LambdaIntegration(self.get_job_status_lambda),
+            authorization_type=apigw.AuthorizationType.NONE,
+            method_responses=[
+                apigw.MethodResponse(
+                    status_code="200",
+                    response_parameters={
+                        "method.response.header.Access-Control-Allow-Origin": True,
+                        "method.response.header.Access-Control-Allow-Headers": True,
+                        "method.response.header.Access-Control-Allow-Methods": True
+                    }
+                )
+            ]
+        )
+
+        # Create API resources: /apis/feed
+        self.feed_resource = apis_resource.add_resource("feed")
+
+        # Create Lambda function for the gallery-wide feed of recent results
+        self.get_feed_lambda = self.create_get_feed_lambda_function(
+            lambda_path="lambda/apis/get-feed"
+        )
+
+        # Add GET method
+        self.feed_resource.add_method(
+            "GET",
+            apigw.LambdaIntegration(self.get_feed_lambda),
+            authorization_type=apigw.AuthorizationType.NONE,
+            method_responses=[
+                apigw.MethodResponse(
+                    status_code="200",
+                    response_parameters={
+                        "method.response.header.Access-Control-Allow-Origin": True,
+                        "method.response.header.Access-Control-Allow-Headers": True,
+                        "method.response.header.Access-Control-Allow-Methods": True
+                    }
+                )
+            ]
+        )
+
         self.user_agreement_lambda = self.create_user_agreement_lambda_function(
             lambda_path="lambda/apis/user-agreement"
         )
@@ -98,6 +153,15 @@ class ApiGatewayApisStack(Stack):
             description="The URL of the API Gateway"
         )
 
+    def create_runtime_layer(self):
+        # Shared lazy boto3 clients and response/event helpers (lambda/layers/gallery-runtime)
+        return lambda_.LayerVersion(
+            self, "GalleryRuntimeLayer",
+            code=lambda_.Code.from_asset("lambda/layers/gallery-runtime"),
+            compatible_runtimes=[lambda_.Runtime.PYTHON_3_11],
+            description="Shared runtime for the gallery Lambda functions"
+        )
+
     def create_api_gateway(self):
         """Create and return the API Gateway."""
         return apigw.RestApi(
@@ -153,11 +217,13 @@ class ApiGatewayApisStack(Stack):
             runtime=lambda_.Runtime.PYTHON_3_11,
             handler="index.lambda_handler",
             code=lambda_.Code.from_asset(lambda_path),
+            layers=[self.runtime_layer],
             environment={
                 "BUCKET_NAME": self.s3_base_bucket_name,
                 "DDB_AMAZON_BEDROCK_GALLERY_DISPLAY_TABLE_NAME": self.ddb_amazon_bedrock_gallery_display_table_name
             },
-            timeout=Duration.seconds(10),
+            # Long-polls hold the request for up to 20 seconds
+            timeout=Duration.seconds(29),
             memory_size=1024
         )
         
@@ -179,6 +245,78 @@ class ApiGatewayApisStack(Stack):
         
         return lambda_function
 
+    def create_get_job_status_lambda_function(self, lambda_path):
+        """Create and return a Lambda function with appropriate permissions."""
+        lambda_function = lambda_.Function(
+            self, "AmazonBedrockGalleryGetJobStatus",
+            function_name="AmazonBedrockGalleryGetJobStatus",
+            runtime=lambda_.Runtime.PYTHON_3_11,
+            handler="index.lambda_handler",
+            code=lambda_.Code.from_asset(lambda_path),
+            layers=[self.runtime_layer],
+            environment={
+                "BUCKET_NAME": self.s3_base_bucket_name,
+                "RESULT_OBJECT_PATH": self.s3_result_images_path,
+                "DDB_AMAZON_BEDROCK_GALLERY_PROCESS_TABLE_NAME": self.ddb_amazon_bedrock_gallery_process_table_name
+            },
+            # Long-polls hold the request for up to 20 seconds, mostly sleeping
+            timeout=Duration.seconds(29),
+            memory_size=128
+        )
+
+        # Grant permission to presign result objects
+        lambda_function.add_to_role_policy(iam.PolicyStatement(
+            effect=iam.Effect.ALLOW,
+            actions=["s3:GetObject"],
+            resources=[f"arn:aws:s3:::{self.s3_base_bucket_name}/{self.s3_result_images_path}*"]
+        ))
+
+        # Grant permission to read the job items
+        lambda_function.add_to_role_policy(iam.PolicyStatement(
+            effect=iam.Effect.ALLOW,
+            actions=["dynamodb:GetItem"],
+            resources=[
+                f"arn:aws:dynamodb:{self.region}:{self.account}:table/{self.ddb_amazon_bedrock_gallery_process_table_name}"
+            ]
+        ))
+
+        return lambda_function
+
+    def create_get_feed_lambda_function(self, lambda_path):
+        """Create and return a Lambda function with appropriate permissions."""
+        lambda_function = lambda_.Function(
+            self, "AmazonBedrockGalleryGetFeed",
+            function_name="AmazonBedrockGalleryGetFeed",
+            runtime=lambda_.Runtime.PYTHON_3_11,
+            handler="index.lambda_handler",
+            code=lambda_.Code.from_asset(lambda_path),
+            layers=[self.runtime_layer],
+            environment={
+                "BUCKET_NAME": self.s3_base_bucket_name,
+                "DDB_AMAZON_BEDROCK_GALLERY_DISPLAY_FEED_TABLE_NAME": self.ddb_amazon_bedrock_gallery_display_feed_table_name
+            },
+            timeout=Duration.seconds(10),
+            memory_size=512
+        )
+
+        # Grant permission to presign result objects
+        lambda_function.add_to_role_policy(iam.PolicyStatement(
+            effect=iam.Effect.ALLOW,
+            actions=["s3:GetObject"],
+            resources=[f"arn:aws:s3:::{self.s3_base_bucket_name}/{self.s3_result_images_path}*"]
+        ))
+
+        # Grant permission to query the display feed table
+        lambda_function.add_to_role_policy(iam.PolicyStatement(
+            effect=iam.Effect.ALLOW,
+            actions=["dynamodb:Query"],
+            resources=[
+                f"arn:aws:dynamodb:{self.region}:{self.account}:table/{self.ddb_amazon_bedrock_gallery_display_feed_table_name}"
+            ]
+        ))
+
+        return lambda_function
+
     def create_upload_image_lambda_function(self, lambda_path, object_path):
         """Create and return a Lambda function with appropriate permissions."""
         lambda_function = lambda_.Function(
@@ -187,6 +325,7 @@ class ApiGatewayApisStack(Stack):
             runtime=lambda_.Runtime.PYTHON_3_11,
             handler="index.lambda_handler",
             code=lambda_.Code.from_asset(lambda_path),
+            layers=[self.runtime_layer],
             environment={
                 "BUCKET_NAME": self.s3_base_bucket_name,
                 "OBJECT_PATH": object_path,
@@ -231,6 +370,7 @@ class ApiGatewayApisStack(Stack):
             runtime=lambda_.Runtime.PYTHON_3_11,
             handler="index.handler",
             code=lambda_.Code.from_asset(lambda_path),
+            layers=[self.runtime_layer],
             environment={
                 "DDB_AMAZON_BEDROCK_USER_AGREEMENT_TABLE_NAME": self.ddb_amazon_bedrock_user_agreement_table_name
             },
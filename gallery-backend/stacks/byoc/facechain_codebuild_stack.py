@@ -16,7 +16,8 @@ class ByocFaceChainCodeBuildStack(Stack):
 
         # Get the absolute path of the project root
         project_root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-        facechain_dir = os.path.join(project_root, "byoc", "facechain")
+        byoc_dir = os.path.join(project_root, "byoc")
+        facechain_dir = os.path.join(byoc_dir, "facechain")
 
         # Verify if the directory exists
         if not os.path.exists(facechain_dir):
@@ -27,9 +28,10 @@ class ByocFaceChainCodeBuildStack(Stack):
             removal_policy=RemovalPolicy.DESTROY,
             auto_delete_objects=True)
 
-        # Upload the Dockerfile and src directory to the S3 bucket
+        # Upload the Dockerfile and src directory to the S3 bucket, with the shared byoc/common modules;
+        # the image is built with byoc/ as the context
         s3_deployment = s3deploy.BucketDeployment(self, "DeployDockerfileAndSrc",
-            sources=[s3deploy.Source.asset(facechain_dir)],
+            sources=[s3deploy.Source.asset(byoc_dir, exclude=["gfpgan"])],
             destination_bucket=bucket,
             destination_key_prefix="source")
 
@@ -69,7 +71,7 @@ class ByocFaceChainCodeBuildStack(Stack):
                         "commands": [
                             "echo Build started on `date`",
                             "echo Building the Docker image...",
-                            "docker build --build-arg ECR_REGISTRY=$ECR_REGISTRY --build-arg ECR_REPOSITORY=$ECR_REPOSITORY --build-arg IMAGE_TAG=$IMAGE_TAG -t $ECR_REPO:$BUILD_IMAGE_TAG .",
+                            "docker build --build-arg ECR_REGISTRY=$ECR_REGISTRY --build-arg ECR_REPOSITORY=$ECR_REPOSITORY --build-arg IMAGE_TAG=$IMAGE_TAG -f facechain/Dockerfile -t $ECR_REPO:$BUILD_IMAGE_TAG .",
                             "docker tag $ECR_REPO:$BUILD_IMAGE_TAG $ECR_REPO:latest"
                         ]
                     },
@@ -14,6 +14,8 @@ class DDBTables(Stack):
         self.ddb_amazon_bedrock_gallery_process_table_name = self.node.try_get_context("ddb_amazon_bedrock_gallery_process_table_name")
         self.ddb_amazon_bedrock_gallery_display_table_name = self.node.try_get_context("ddb_amazon_bedrock_gallery_display_table_name")
         self.ddb_amazon_bedrock_gallery_display_history_table_name = self.node.try_get_context("ddb_amazon_bedrock_gallery_display_history_table_name")
+        # The feed has its own key schema; changing the key schema of the named history table in place would need a replacement
+        self.ddb_amazon_bedrock_gallery_display_feed_table_name = self.node.try_get_context("ddb_amazon_bedrock_gallery_display_feed_table_name") or f"{self.ddb_amazon_bedrock_gallery_display_history_table_name}-feed"
         self.ddb_amazon_bedrock_gallery_base_resource_table_name = self.node.try_get_context("ddb_amazon_bedrock_gallery_base_resource_table_name")
         self.ddb_amazon_bedrock_user_agreement_table_name = self.node.try_get_context("ddb_amazon_bedrock_user_agreement_table_name")
         
@@ -21,11 +23,13 @@ class DDBTables(Stack):
             self, 'AmazonBedrockGalleryProcessTable',
                 table_name=self.ddb_amazon_bedrock_gallery_process_table_name,
                 partition_key=dynamodb.Attribute(
-                    name='PK', #UUID#{uuid}
+                    name='PK', #UUID#{uuid}, #DEDUP#{face_hash}#{base_image_object_key}
                     type=dynamodb.AttributeType.STRING
                 ),
                 removal_policy=RemovalPolicy.DESTROY,
                 billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+                # Deduplication claims expire on their own
+                time_to_live_attribute='expires_at',
         )
         
         self.ddb_amazon_bedrock_gallery_display_table = dynamodb.Table(
@@ -50,6 +54,21 @@ class DDBTables(Stack):
                 billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
             )
 
+        self.ddb_amazon_bedrock_gallery_display_feed_table = dynamodb.Table(
+                self, 'AmazonBedrockGalleryDisplayFeedTable',
+                table_name=self.ddb_amazon_bedrock_gallery_display_feed_table_name,
+                partition_key=dynamodb.Attribute(
+                    name='PK', #TIME#{yyyymmddhh}
+                    type=dynamodb.AttributeType.STRING
+                ),
+                sort_key=dynamodb.Attribute(
+                    name='SK', #{created_at}#{uuid}
+                    type=dynamodb.AttributeType.STRING
+                ),
+                removal_policy=RemovalPolicy.DESTROY,
+                billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+            )
+
         self.ddb_amazon_bedrock_gallery_base_resource_table = dynamodb.Table(
             self, 'AmazonBedrockGalleryBaseResourceTable',
             table_name=self.ddb_amazon_bedrock_gallery_base_resource_table_name,
@@ -1,6 +1,9 @@
-from aws_cdk import Stack, CustomResource
+from aws_cdk import Stack, CustomResource, Duration
 from aws_cdk import aws_sagemaker as sagemaker
 from aws_cdk import aws_iam as iam
+from aws_cdk import aws_applicationautoscaling as appscaling
+from aws_cdk import aws_cloudwatch as cloudwatch
+from aws_cdk import aws_cloudwatch_actions as cloudwatch_actions
 from constructs import Construct
 
 class FaceChainSageMakerEndpointStack(Stack):
@@ -8,8 +11,14 @@ class FaceChainSageMakerEndpointStack(Stack):
         super().__init__(scope, construct_id, **kwargs)
 
         facechain_sagemaker_endpoint_name = self.node.try_get_context("facechain_sagemaker_endpoint_name")
-        facechain_sagemaker_endpoint_instance_count = self.node.try_get_context("facechain_sagemaker_endpoint_instance_count")
+        facechain_sagemaker_endpoint_instance_count = int(self.node.try_get_context("facechain_sagemaker_endpoint_instance_count") or 1)
         facechain_sagemaker_endpoint_instance_type = self.node.try_get_context("facechain_sagemaker_endpoint_instance_type")
+        # async: requests are queued by SageMaker (input in S3) and the variant can scale down to zero instances
+        self.facechain_sagemaker_endpoint_async = str(self.node.try_get_context("facechain_sagemaker_endpoint_async") or False).lower() == "true"
+        # Optional cheaper variant (e.g. a CPU instance) that face-swap spills over to while the primary is saturated
+        facechain_sagemaker_endpoint_overflow_instance_type = self.node.try_get_context("facechain_sagemaker_endpoint_overflow_instance_type")
+        if facechain_sagemaker_endpoint_overflow_instance_type and self.facechain_sagemaker_endpoint_async:
+            raise ValueError("facechain_sagemaker_endpoint_overflow_instance_type needs a synchronous endpoint; async invocations cannot target a variant")
 
         # Add a dependency on the CodeBuild status resource
         self.node.add_dependency(codebuild_status_resource)
@@ -34,20 +43,53 @@ class FaceChainSageMakerEndpointStack(Stack):
             model_name="facechain-sagemaker-model"
         )
 
+        production_variants = [
+            {
+                "initialInstanceCount": facechain_sagemaker_endpoint_instance_count,
+                "instanceType": facechain_sagemaker_endpoint_instance_type,
+                "modelName": facechain_model.model_name,
+                "variantName": "FaceChainVariant",
+                "initialVariantWeight": 1
+            }
+        ]
+
+        overflow_model = None
+        # The image build exports the torchscript and onnx artifacts (FACECHAIN_EXPORT_BACKENDS in the Dockerfile)
+        facechain_sagemaker_endpoint_overflow_backend = self.node.try_get_context("facechain_sagemaker_endpoint_overflow_backend") or "torch"
+        if facechain_sagemaker_endpoint_overflow_backend not in ("torch", "torchscript", "onnx"):
+            raise ValueError(f"Unsupported facechain_sagemaker_endpoint_overflow_backend: {facechain_sagemaker_endpoint_overflow_backend} (expected torch, torchscript or onnx)")
+        facechain_sagemaker_endpoint_overflow_instance_count = int(self.node.try_get_context("facechain_sagemaker_endpoint_overflow_instance_count") or 1)
+        if facechain_sagemaker_endpoint_overflow_instance_type:
+            # Same image with a CPU backend; the onnx and torchscript artifacts are exported during the image build
+            overflow_model = sagemaker.CfnModel(self, "FaceChainSageMakerOverflowModel",
+                execution_role_arn=sagemaker_role.role_arn,
+                primary_container={
+                    "image": facechain_image_uri,
+                    "mode": "SingleModel",
+                    "environment": {
+                        "FACECHAIN_BACKEND": facechain_sagemaker_endpoint_overflow_backend
+                    }
+                },
+                model_name="facechain-sagemaker-overflow-model"
+            )
+            # Weight 0: only requests that name the variant (TargetVariant) are routed to it
+            production_variants.append({
+                "initialInstanceCount": facechain_sagemaker_endpoint_overflow_instance_count,
+                "instanceType": facechain_sagemaker_endpoint_overflow_instance_type,
+                "modelName": overflow_model.model_name,
+                "variantName": "FaceChainOverflowVariant",
+                "initialVariantWeight": 0
+            })
+
         # Create SageMaker Endpoint Configuration for FaceChain
         facechain_endpoint_config = sagemaker.CfnEndpointConfig(self, "FaceChainSageMakerEndpointConfig",
-            production_variants=[
-                {
-                    "initialInstanceCount": facechain_sagemaker_endpoint_instance_count,
-                    "instanceType": facechain_sagemaker_endpoint_instance_type,
-                    "modelName": facechain_model.model_name,
-                    "variantName": "FaceChainVariant",
-                    "initialVariantWeight": 1
-                }
-            ],
+            production_variants=production_variants,
+            async_inference_config=self.create_async_inference_config() if self.facechain_sagemaker_endpoint_async else None,
             endpoint_config_name="facechain-sagemaker-endpoint-config"
         )
         facechain_endpoint_config.add_dependency(facechain_model)
+        if overflow_model:
+            facechain_endpoint_config.add_dependency(overflow_model)
 
         # Create SageMaker Endpoint for FaceChain
         facechain_endpoint = sagemaker.CfnEndpoint(self, "FaceChainSageMakerEndpoint",
@@ -56,4 +98,109 @@ class FaceChainSageMakerEndpointStack(Stack):
         )
         facechain_endpoint.add_dependency(facechain_endpoint_config)
 
-        self.facechain_endpoint_name = facechain_endpoint.endpoint_name
\ No newline at end of file
+        self.facechain_endpoint_name = facechain_endpoint.endpoint_name
+
+        # Scale each variant between the min/max instance counts from context
+        self.scalable_target = self.create_autoscaling(facechain_endpoint, "FaceChainVariant", "FaceChain",
+                                                       "facechain_sagemaker_endpoint", facechain_sagemaker_endpoint_instance_count)
+        self.overflow_scalable_target = None
+        if overflow_model:
+            self.overflow_scalable_target = self.create_autoscaling(facechain_endpoint, "FaceChainOverflowVariant", "FaceChainOverflow",
+                                                                    "facechain_sagemaker_endpoint_overflow", facechain_sagemaker_endpoint_overflow_instance_count)
+
+    def create_async_inference_config(self):
+        # The predictor writes the result image itself, so the output path only receives the small JSON responses
+        s3_base_bucket_name = self.node.try_get_context("s3_base_bucket_name")
+        async_output_path = self.node.try_get_context("facechain_sagemaker_endpoint_async_output_path") or "async-output/"
+        return {
+            "outputConfig": {
+                "s3OutputPath": f"s3://{s3_base_bucket_name}/{async_output_path}"
+            },
+            "clientConfig": {
+                "maxConcurrentInvocationsPerInstance": int(self.node.try_get_context("facechain_sagemaker_endpoint_async_max_concurrency") or 2)
+            }
+        }
+
+    def create_autoscaling(self, endpoint, variant_name, construct_prefix, context_prefix, instance_count):
+        # Context keys per variant, e.g. "facechain_sagemaker_endpoint_max_capacity" in cdk.context.json;
+        # the overflow variant uses the same keys with the "facechain_sagemaker_endpoint_overflow" prefix
+        #
+        # Parameter                        Context Key                     Default Value
+        # ---------                        -----------                     -------------
+        # minimum instances                {prefix}_min_capacity           1 (0 when async)
+        # maximum instances                {prefix}_max_capacity           max(2, instance count)
+        # invocations per instance/minute  {prefix}_target_invocations     20
+        # queued requests per instance     {prefix}_target_backlog         4 (async only)
+        # scale-in cooldown (seconds)      {prefix}_scale_in_cooldown      600
+        # scale-out cooldown (seconds)     {prefix}_scale_out_cooldown     60
+        min_capacity = self.node.try_get_context(f"{context_prefix}_min_capacity")
+        if min_capacity is None:
+            min_capacity = 0 if self.facechain_sagemaker_endpoint_async else 1
+        min_capacity = int(min_capacity)
+        max_capacity = int(self.node.try_get_context(f"{context_prefix}_max_capacity") or max(2, instance_count))
+        scale_in_cooldown = Duration.seconds(int(self.node.try_get_context(f"{context_prefix}_scale_in_cooldown") or 600))
+        scale_out_cooldown = Duration.seconds(int(self.node.try_get_context(f"{context_prefix}_scale_out_cooldown") or 60))
+
+        if min_capacity == 0 and not self.facechain_sagemaker_endpoint_async:
+            raise ValueError(f"{context_prefix}_min_capacity can only be 0 with facechain_sagemaker_endpoint_async")
+        if max_capacity < max(min_capacity, 1):
+            raise ValueError(f"{context_prefix}_max_capacity must be at least the min capacity and 1")
+
+        scalable_target = appscaling.ScalableTarget(self, f"{construct_prefix}ScalableTarget",
+            service_namespace=appscaling.ServiceNamespace.SAGEMAKER,
+            resource_id=f"endpoint/{endpoint.endpoint_name}/variant/{variant_name}",
+            scalable_dimension="sagemaker:variant:DesiredInstanceCount",
+            min_capacity=min_capacity,
+            max_capacity=max_capacity
+        )
+        # The variant has to exist before it can be registered
+        scalable_target.node.add_dependency(endpoint)
+
+        if not self.facechain_sagemaker_endpoint_async:
+            # Requests are answered synchronously, so track the invocation rate per instance
+            scalable_target.scale_to_track_metric(f"{construct_prefix}InvocationsPerInstance",
+                target_value=float(self.node.try_get_context(f"{context_prefix}_target_invocations") or 20),
+                predefined_metric=appscaling.PredefinedMetric.SAGEMAKER_VARIANT_INVOCATIONS_PER_INSTANCE,
+                scale_in_cooldown=scale_in_cooldown,
+                scale_out_cooldown=scale_out_cooldown
+            )
+            return scalable_target
+
+        # Async: track the queued requests per instance, which also scales the variant in to zero when idle
+        scalable_target.scale_to_track_metric("FaceChainBacklogPerInstance",
+            target_value=float(self.node.try_get_context(f"{context_prefix}_target_backlog") or 4),
+            custom_metric=cloudwatch.Metric(
+                namespace="AWS/SageMaker",
+                metric_name="ApproximateBacklogSizePerInstance",
+                dimensions_map={"EndpointName": endpoint.endpoint_name},
+                statistic="Average",
+                period=Duration.minutes(1)
+            ),
+            scale_in_cooldown=scale_in_cooldown,
+            scale_out_cooldown=scale_out_cooldown
+        )
+
+        # With zero instances there is no per-instance backlog to track, so a queued request starts the first instance
+        scale_out_from_zero = appscaling.StepScalingAction(self, "FaceChainScaleOutFromZero",
+            scaling_target=scalable_target,
+            adjustment_type=appscaling.AdjustmentType.CHANGE_IN_CAPACITY,
+            cooldown=scale_out_cooldown
+        )
+        scale_out_from_zero.add_adjustment(adjustment=1, lower_bound=0)
+
+        backlog_without_capacity_alarm = cloudwatch.Alarm(self, "FaceChainBacklogWithoutCapacityAlarm",
+            metric=cloudwatch.Metric(
+                namespace="AWS/SageMaker",
+                metric_name="HasBacklogWithoutCapacity",
+                dimensions_map={"EndpointName": endpoint.endpoint_name},
+                statistic="Average",
+                period=Duration.minutes(1)
+            ),
+            threshold=1,
+            comparison_operator=cloudwatch.ComparisonOperator.GREATER_THAN_OR_EQUAL_TO_THRESHOLD,
+            evaluation_periods=1,
+            treat_missing_data=cloudwatch.TreatMissingData.NOT_BREACHING
+        )
+        backlog_without_capacity_alarm.add_alarm_action(cloudwatch_actions.ApplicationScalingAction(scale_out_from_zero))
+
+        return scalable_target
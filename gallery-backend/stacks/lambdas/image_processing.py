@@ -1,3 +1,5 @@
+import math
+
 from aws_cdk import (
     Stack,
     CfnOutput,
@@ -11,23 +13,49 @@ from aws_cdk import (
     aws_s3 as s3,
     RemovalPolicy,
     aws_s3_notifications as s3n,
+    aws_sqs as sqs,
     CustomResource,
 )
 from constructs import Construct
 from aws_cdk.custom_resources import Provider
 
+# Event types the stage queues are subscribed to; face-crop writes deduplicated results with CopyObject
+NOTIFICATION_EVENTS = ["s3:ObjectCreated:*"]
+
 class LambdaImageProcessingStack(Stack):
     def __init__(self, scope: Construct, construct_id: str, **kwargs) -> None:
         super().__init__(scope, construct_id, **kwargs)
 
         self.ddb_amazon_bedrock_gallery_process_table_name = self.node.try_get_context("ddb_amazon_bedrock_gallery_process_table_name")
         self.ddb_amazon_bedrock_gallery_display_table_name = self.node.try_get_context("ddb_amazon_bedrock_gallery_display_table_name")
+        self.ddb_amazon_bedrock_gallery_display_history_table_name = self.node.try_get_context("ddb_amazon_bedrock_gallery_display_history_table_name")
+        self.ddb_amazon_bedrock_gallery_display_feed_table_name = self.node.try_get_context("ddb_amazon_bedrock_gallery_display_feed_table_name") or f"{self.ddb_amazon_bedrock_gallery_display_history_table_name}-feed"
         self.s3_base_bucket_name = self.node.try_get_context("s3_base_bucket_name")
         self.s3_face_images_path = self.node.try_get_context("s3_face_images_path")
         self.s3_face_cropped_images_path = self.node.try_get_context("s3_face_cropped_images_path")
         self.s3_face_swapped_images_path = self.node.try_get_context("s3_face_swapped_images_path")
         self.s3_result_images_path = self.node.try_get_context("s3_result_images_path")
         self.facechain_sagemaker_endpoint_name = self.node.try_get_context("facechain_sagemaker_endpoint_name")
+        self.facechain_restore_enabled = self.node.try_get_context("facechain_restore_enabled") or False
+        self.facechain_restore_weight = self.node.try_get_context("facechain_restore_weight") or 0.5
+        # event: each stage is triggered by the previous stage's S3 object
+        # orchestrated: uploads trigger the orchestrator, which invokes the stages and records their timings
+        self.pipeline_mode = self.node.try_get_context("pipeline_mode") or "event"
+        # Must match the FaceChain endpoint stack; an async endpoint answers before the result exists
+        self.facechain_sagemaker_endpoint_async = str(self.node.try_get_context("facechain_sagemaker_endpoint_async") or False).lower() == "true"
+        self.facechain_async_input_path = self.node.try_get_context("facechain_sagemaker_endpoint_async_input_path") or "async-input/"
+        if self.facechain_sagemaker_endpoint_async and self.pipeline_mode == "orchestrated":
+            raise ValueError("pipeline_mode orchestrated needs a synchronous FaceChain endpoint (facechain_sagemaker_endpoint_async)")
+        # With an overflow variant in the FaceChain endpoint stack, face-swap routes between the two variants
+        self.facechain_overflow_enabled = bool(self.node.try_get_context("facechain_sagemaker_endpoint_overflow_instance_type"))
+        self.restore_sagemaker_endpoint_name = self.node.try_get_context("restore_sagemaker_endpoint_name") or ""
+        # A visitor's repeated uploads of the same face for the same base image reuse their earlier result (0 disables)
+        self.face_dedup_ttl_seconds = self.node.try_get_context("face_dedup_ttl_seconds")
+        if self.face_dedup_ttl_seconds is None:
+            self.face_dedup_ttl_seconds = 3600
+
+        # Shared runtime layer used by every function in this stack
+        self.runtime_layer = self.create_runtime_layer()
 
         # Create the face crop Lambda function
         self.face_crop_lambda = self.create_face_crop_lambda()
@@ -37,10 +65,87 @@ class LambdaImageProcessingStack(Stack):
 
         # Create the face swap completion Lambda function
         self.face_swap_completion_lambda = self.create_face_swap_completion_lambda()
+
+        if self.pipeline_mode == "orchestrated":
+            # Create the orchestrator Lambda function and feed it the uploads
+            self.orchestrator_lambda = self.create_orchestrator_lambda()
+            self.orchestrator_queue = self.create_stage_queue("Orchestrator", self.orchestrator_lambda, "orchestrator")
+        else:
+            # Every stage reads from its own SQS queue (with a DLQ) so bursts are buffered
+            self.face_crop_queue = self.create_stage_queue("FaceCrop", self.face_crop_lambda, "face_crop")
+            self.face_swap_queue = self.create_stage_queue("FaceSwap", self.face_swap_lambda, "face_swap")
+            self.face_swap_completion_queue = self.create_stage_queue("FaceSwapCompletion", self.face_swap_completion_lambda, "face_swap_completion")
+            # face-crop and face-swap queue the next stage themselves, with the job's metadata in the message
+            self.connect_stage_queues()
         
-        # Configure S3 notifications after all Lambda functions are created
+        # Configure S3 notifications after all queues are created
         self.configure_s3_notifications()
 
+    def create_runtime_layer(self):
+        # Shared lazy boto3 clients and response/event helpers (lambda/layers/gallery-runtime)
+        return lambda_.LayerVersion(
+            self, "GalleryRuntimeLayer",
+            code=lambda_.Code.from_asset("lambda/layers/gallery-runtime"),
+            compatible_runtimes=[lambda_.Runtime.PYTHON_3_11],
+            description="Shared runtime for the gallery Lambda functions"
+        )
+
+    def create_stage_queue(self, stage_name, lambda_func, context_prefix):
+        # Per-stage batching and concurrency, e.g. "face_swap_max_concurrency" in cdk.context.json
+        defaults = {
+            "face_crop": {"batch_size": 10, "max_batching_window": 1, "max_concurrency": 10},
+            "face_swap": {"batch_size": 4, "max_batching_window": 1, "max_concurrency": 2},
+            "face_swap_completion": {"batch_size": 10, "max_batching_window": 1, "max_concurrency": 5},
+            "orchestrator": {"batch_size": 1, "max_batching_window": 0, "max_concurrency": 10},
+        }[context_prefix]
+        settings = {
+            key: self.node.try_get_context(f"{context_prefix}_{key}") or value
+            for key, value in defaults.items()
+        }
+
+        dead_letter_queue = sqs.Queue(
+            self, f"AmazonBedrockGallery{stage_name}DLQ",
+            retention_period=Duration.days(14)
+        )
+
+        # The visibility timeout must cover the function timeout plus the batching window
+        queue = sqs.Queue(
+            self, f"AmazonBedrockGallery{stage_name}Queue",
+            visibility_timeout=Duration.seconds(lambda_func.timeout.to_seconds() * 6),
+            dead_letter_queue=sqs.DeadLetterQueue(max_receive_count=3, queue=dead_letter_queue)
+        )
+
+        # Allow the bucket to deliver its event notifications to the queue
+        queue.add_to_resource_policy(iam.PolicyStatement(
+            effect=iam.Effect.ALLOW,
+            principals=[iam.ServicePrincipal("s3.amazonaws.com")],
+            actions=["sqs:SendMessage"],
+            resources=[queue.queue_arn],
+            conditions={
+                "ArnLike": {"aws:SourceArn": f"arn:aws:s3:::{self.s3_base_bucket_name}"}
+            }
+        ))
+
+        lambda_func.add_event_source(lambda_events.SqsEventSource(
+            queue,
+            batch_size=settings["batch_size"],
+            max_batching_window=Duration.seconds(settings["max_batching_window"]),
+            max_concurrency=settings["max_concurrency"],
+            report_batch_item_failures=True
+        ))
+
+        return queue
+
+    def connect_stage_queues(self):
+        self.face_crop_lambda.add_environment("FACE_SWAP_QUEUE_URL", self.face_swap_queue.queue_url)
+        self.face_swap_queue.grant_send_messages(self.face_crop_lambda)
+        # An async endpoint writes the result after face-swap returns, so its completions come from
+        # the bucket notification instead
+        if not self.facechain_sagemaker_endpoint_async:
+            for lambda_func in [self.face_crop_lambda, self.face_swap_lambda]:
+                lambda_func.add_environment("FACE_SWAP_COMPLETION_QUEUE_URL", self.face_swap_completion_queue.queue_url)
+                self.face_swap_completion_queue.grant_send_messages(lambda_func)
+
     def create_face_crop_lambda(self):
         # Create the necessary layers
         pillow_layer_arn = self.node.try_get_context("pillow_layer_arn")
@@ -55,6 +160,27 @@ class LambdaImageProcessingStack(Stack):
             layer_version_arn=numpy_layer_arn
         )
 
+        layers = [self.runtime_layer, pillow_layer, numpy_layer]
+
+        # The OpenCV detector needs a layer with opencv-python-headless (python/) and the
+        # res10 SSD model files (face-detector/), built by lambda/layers/opencv-face-detector/build_and_publish.sh;
+        # Rekognition stays the fallback
+        face_detector = self.node.try_get_context("face_detector") or "rekognition"
+        if face_detector == "opencv":
+            opencv_face_detector_layer_arn = self.node.try_get_context("opencv_face_detector_layer_arn")
+            if not opencv_face_detector_layer_arn:
+                raise ValueError("face_detector opencv needs opencv_face_detector_layer_arn; publish the layer with lambda/layers/opencv-face-detector/build_and_publish.sh")
+            layers.append(lambda_.LayerVersion.from_layer_version_arn(
+                self, "OpenCVFaceDetectorLayer",
+                layer_version_arn=opencv_face_detector_layer_arn
+            ))
+
+        # The records of a batch are cropped max_parallel_crops at a time, and each round of crops
+        # (Rekognition call, decode, crop, upload) gets 10 seconds
+        batch_size = self.node.try_get_context("face_crop_batch_size") or 10
+        max_parallel_crops = self.node.try_get_context("face_crop_max_parallel_crops") or 4
+        timeout_seconds = 10 * math.ceil(batch_size / max_parallel_crops)
+
         # Create the face-crop Lambda function inline
         lambda_func = lambda_.Function(
             self, "AmazonBedrockGalleryFaceCropLambda",
@@ -64,11 +190,21 @@ class LambdaImageProcessingStack(Stack):
             code=lambda_.Code.from_asset("lambda/image-processing/face-crop"),
             environment={
                 "BUCKET_NAME": self.s3_base_bucket_name,
-                "FACE_CROPPED_OBJECT_PATH": self.s3_face_cropped_images_path
+                "FACE_CROPPED_OBJECT_PATH": self.s3_face_cropped_images_path,
+                "RESULT_OBJECT_PATH": self.s3_result_images_path,
+                "DDB_AMAZON_BEDROCK_GALLERY_PROCESS_TABLE_NAME": self.ddb_amazon_bedrock_gallery_process_table_name,
+                "DEDUP_TTL_SECONDS": str(self.face_dedup_ttl_seconds),
+                "FACE_DETECTOR": face_detector,
+                "FACE_DETECTOR_MIN_CONFIDENCE": str(self.node.try_get_context("face_detector_min_confidence") or 80),
+                "FACE_CROP_SIZE": str(self.node.try_get_context("face_crop_size") or 512),
+                "FACE_CROP_FORMAT": self.node.try_get_context("face_crop_format") or "jpeg",
+                "FACE_CROP_JPEG_QUALITY": str(self.node.try_get_context("face_crop_jpeg_quality") or 90),
+                "MAX_PARALLEL_CROPS": str(max_parallel_crops)
             },
-            timeout=Duration.seconds(10),
-            memory_size=1024,
-            layers=[pillow_layer, numpy_layer]
+            timeout=Duration.seconds(timeout_seconds),
+            # Photos are decoded at reduced resolution (JPEG draft mode), so peak memory is a fraction of a full decode
+            memory_size=self.node.try_get_context("face_crop_memory_size") or 512,
+            layers=layers
         )
 
         # Grant permissions for S3 object put/get operations
@@ -78,7 +214,17 @@ class LambdaImageProcessingStack(Stack):
             resources=[
                 f"arn:aws:s3:::{self.s3_base_bucket_name}",
                 f"arn:aws:s3:::{self.s3_base_bucket_name}/{self.s3_face_cropped_images_path}*",
-                f"arn:aws:s3:::{self.s3_base_bucket_name}/{self.s3_face_images_path}*"
+                f"arn:aws:s3:::{self.s3_base_bucket_name}/{self.s3_face_images_path}*",
+                f"arn:aws:s3:::{self.s3_base_bucket_name}/{self.s3_result_images_path}*"
+            ]
+        ))
+
+        # Grant permissions for the deduplication claims in the process table
+        lambda_func.add_to_role_policy(iam.PolicyStatement(
+            effect=iam.Effect.ALLOW,
+            actions=["dynamodb:PutItem"],
+            resources=[
+                f"arn:aws:dynamodb:{self.region}:{self.account}:table/{self.ddb_amazon_bedrock_gallery_process_table_name}"
             ]
         ))
 
@@ -98,13 +244,25 @@ class LambdaImageProcessingStack(Stack):
             runtime=lambda_.Runtime.PYTHON_3_11,
             handler="index.lambda_handler",
             code=lambda_.Code.from_asset("lambda/image-processing/face-swap"),
+            layers=[self.runtime_layer],
             environment={
                 "BUCKET_NAME": self.s3_base_bucket_name,
                 "RESULT_OBJECT_PATH": self.s3_result_images_path,
                 "FACECHAIN_SAGEMAKER_ENDPOINT_NAME": self.facechain_sagemaker_endpoint_name,
+                "FACECHAIN_RESTORE_ENABLED": str(self.facechain_restore_enabled).lower(),
+                "FACECHAIN_RESTORE_WEIGHT": str(self.facechain_restore_weight),
+                "FACECHAIN_SAGEMAKER_ENDPOINT_ASYNC": str(self.facechain_sagemaker_endpoint_async).lower(),
+                "FACECHAIN_ASYNC_INPUT_PATH": self.facechain_async_input_path,
+                "FACECHAIN_OVERFLOW_VARIANT": "FaceChainOverflowVariant" if self.facechain_overflow_enabled else "",
+                "FACECHAIN_SPILLOVER_QUEUE_DEPTH": str(self.node.try_get_context("facechain_spillover_queue_depth") or 2),
+                "FACECHAIN_SPILLOVER_LATENCY_MS": str(self.node.try_get_context("facechain_spillover_latency_ms") or 8000),
+                "FACECHAIN_SPILLOVER_HOLD_SECONDS": str(self.node.try_get_context("facechain_spillover_hold_seconds") or 15),
+                "MAX_PARALLEL_INVOCATIONS": str(self.node.try_get_context("face_swap_batch_size") or 4),
+                "FACECHAIN_MAX_TARGETS_PER_INVOCATION": str(self.node.try_get_context("facechain_max_targets_per_invocation") or 2),
                 "DDB_AMAZON_BEDROCK_GALLERY_PROCESS_TABLE_NAME": self.ddb_amazon_bedrock_gallery_process_table_name
             },
-            timeout=Duration.seconds(60),
+            # A batch of messages shares one invocation, so leave room for requests queued at the endpoint
+            timeout=Duration.seconds(120),
             memory_size=1024
         )
 
@@ -120,7 +278,7 @@ class LambdaImageProcessingStack(Stack):
         # Grant SageMaker endpoint invoke permission
         lambda_func.add_to_role_policy(iam.PolicyStatement(
             effect=iam.Effect.ALLOW,
-            actions=["sagemaker:InvokeEndpoint"],
+            actions=["sagemaker:InvokeEndpoint", "sagemaker:InvokeEndpointAsync"],
             resources=[
                 f"arn:aws:sagemaker:{self.region}:{self.account}:endpoint/{self.facechain_sagemaker_endpoint_name}"
             ]
@@ -133,7 +291,17 @@ class LambdaImageProcessingStack(Stack):
             resources=[
                 f"arn:aws:s3:::{self.s3_base_bucket_name}",
                 f"arn:aws:s3:::{self.s3_base_bucket_name}/{self.s3_face_cropped_images_path}*",
-                f"arn:aws:s3:::{self.s3_base_bucket_name}/{self.s3_face_swapped_images_path}*"
+                f"arn:aws:s3:::{self.s3_base_bucket_name}/{self.s3_face_swapped_images_path}*",
+                f"arn:aws:s3:::{self.s3_base_bucket_name}/{self.facechain_async_input_path}*"
+            ]
+        ))
+
+        # A redelivered message checks which of its results were already written
+        lambda_func.add_to_role_policy(iam.PolicyStatement(
+            effect=iam.Effect.ALLOW,
+            actions=["s3:GetObject"],
+            resources=[
+                f"arn:aws:s3:::{self.s3_base_bucket_name}/{self.s3_result_images_path}*"
             ]
         ))
 
@@ -146,9 +314,11 @@ class LambdaImageProcessingStack(Stack):
             runtime=lambda_.Runtime.PYTHON_3_11,
             handler="index.lambda_handler",
             code=lambda_.Code.from_asset("lambda/image-processing/face-swap-completion"),
+            layers=[self.runtime_layer],
             environment={
                 "DDB_AMAZON_BEDROCK_GALLERY_PROCESS_TABLE_NAME": self.ddb_amazon_bedrock_gallery_process_table_name,
-                "DDB_AMAZON_BEDROCK_GALLERY_DISPLAY_TABLE_NAME": self.ddb_amazon_bedrock_gallery_display_table_name
+                "DDB_AMAZON_BEDROCK_GALLERY_DISPLAY_TABLE_NAME": self.ddb_amazon_bedrock_gallery_display_table_name,
+                "DDB_AMAZON_BEDROCK_GALLERY_DISPLAY_FEED_TABLE_NAME": self.ddb_amazon_bedrock_gallery_display_feed_table_name
             },
             timeout=Duration.seconds(60),
             memory_size=1024
@@ -167,7 +337,8 @@ class LambdaImageProcessingStack(Stack):
                 f"arn:aws:dynamodb:{self.region}:{self.account}:table/{self.ddb_amazon_bedrock_gallery_process_table_name}",
                 f"arn:aws:dynamodb:{self.region}:{self.account}:table/{self.ddb_amazon_bedrock_gallery_process_table_name}/index/*",
                 f"arn:aws:dynamodb:{self.region}:{self.account}:table/{self.ddb_amazon_bedrock_gallery_display_table_name}",
-                f"arn:aws:dynamodb:{self.region}:{self.account}:table/{self.ddb_amazon_bedrock_gallery_display_table_name}/index/*"
+                f"arn:aws:dynamodb:{self.region}:{self.account}:table/{self.ddb_amazon_bedrock_gallery_display_table_name}/index/*",
+                f"arn:aws:dynamodb:{self.region}:{self.account}:table/{self.ddb_amazon_bedrock_gallery_display_feed_table_name}"
             ]
         ))
 
@@ -187,29 +358,75 @@ class LambdaImageProcessingStack(Stack):
 
         return lambda_func
 
-    def configure_s3_notifications(self):
-        # Granting Permissions to Lambda Function (Using Unique ID to Avoid Name Collisions)
-        self.face_crop_lambda.add_permission(
-            "S3InvokeFaceCrop-" + self.node.addr,
-            principal=iam.ServicePrincipal("s3.amazonaws.com"),
-            action="lambda:InvokeFunction",
-            source_arn=f"arn:aws:s3:::{self.s3_base_bucket_name}"
-        )
-        
-        self.face_swap_lambda.add_permission(
-            "S3InvokeFaceSwap-" + self.node.addr,
-            principal=iam.ServicePrincipal("s3.amazonaws.com"),
-            action="lambda:InvokeFunction",
-            source_arn=f"arn:aws:s3:::{self.s3_base_bucket_name}"
-        )
-        
-        self.face_swap_completion_lambda.add_permission(
-            "S3InvokeFaceCompletion-" + self.node.addr,
-            principal=iam.ServicePrincipal("s3.amazonaws.com"),
-            action="lambda:InvokeFunction",
-            source_arn=f"arn:aws:s3:::{self.s3_base_bucket_name}"
+    def create_orchestrator_lambda(self):
+        # The stages run back to back, plus the restore call (SageMaker's 60 second invoke limit)
+        # and a margin for the job state updates
+        stage_lambdas = [self.face_crop_lambda, self.face_swap_lambda, self.face_swap_completion_lambda]
+        stage_timeout_seconds = sum(stage_lambda.timeout.to_seconds() for stage_lambda in stage_lambdas)
+        restore_timeout_seconds = 60 if self.restore_sagemaker_endpoint_name else 0
+        timeout_seconds = stage_timeout_seconds + restore_timeout_seconds + 30
+        if timeout_seconds > 900:
+            raise ValueError(f"The orchestrator needs {timeout_seconds}s, more than the 900s Lambda limit; lower the stage batch sizes")
+
+        lambda_func = lambda_.Function(
+            self, "AmazonBedrockGalleryOrchestratorLambda",
+            function_name="AmazonBedrockGalleryOrchestratorLambda",
+            runtime=lambda_.Runtime.PYTHON_3_11,
+            handler="index.lambda_handler",
+            code=lambda_.Code.from_asset("lambda/image-processing/orchestrator", exclude=["run_local.py"]),
+            layers=[self.runtime_layer],
+            environment={
+                "DDB_AMAZON_BEDROCK_GALLERY_PROCESS_TABLE_NAME": self.ddb_amazon_bedrock_gallery_process_table_name,
+                "FACE_CROPPED_OBJECT_PATH": self.s3_face_cropped_images_path,
+                "RESULT_OBJECT_PATH": self.s3_result_images_path,
+                "FACE_CROP_FUNCTION_NAME": self.face_crop_lambda.function_name,
+                "FACE_SWAP_FUNCTION_NAME": self.face_swap_lambda.function_name,
+                "FACE_SWAP_COMPLETION_FUNCTION_NAME": self.face_swap_completion_lambda.function_name,
+                "RESTORE_SAGEMAKER_ENDPOINT_NAME": self.restore_sagemaker_endpoint_name,
+                "RESTORE_WEIGHT": str(self.node.try_get_context("restore_weight") or 0.5),
+                "SKIP_STAGES": self.node.try_get_context("pipeline_skip_stages") or "",
+                # A synchronous stage invoke returns only when the stage finished
+                "AWS_READ_TIMEOUT": str(max(stage_lambda.timeout.to_seconds() for stage_lambda in stage_lambdas) + 10)
+            },
+            timeout=Duration.seconds(timeout_seconds),
+            memory_size=256
         )
-        
+
+        # Grant permissions to invoke the stage Lambda functions
+        for stage_lambda in stage_lambdas:
+            stage_lambda.grant_invoke(lambda_func)
+
+        # Grant permissions for the job state updates (and the sibling jobs of multi-theme uploads)
+        lambda_func.add_to_role_policy(iam.PolicyStatement(
+            effect=iam.Effect.ALLOW,
+            actions=["dynamodb:UpdateItem", "dynamodb:GetItem"],
+            resources=[
+                f"arn:aws:dynamodb:{self.region}:{self.account}:table/{self.ddb_amazon_bedrock_gallery_process_table_name}"
+            ]
+        ))
+
+        if self.restore_sagemaker_endpoint_name:
+            # Grant SageMaker endpoint invoke permission for the restore stage
+            lambda_func.add_to_role_policy(iam.PolicyStatement(
+                effect=iam.Effect.ALLOW,
+                actions=["sagemaker:InvokeEndpoint"],
+                resources=[
+                    f"arn:aws:sagemaker:{self.region}:{self.account}:endpoint/{self.restore_sagemaker_endpoint_name}"
+                ]
+            ))
+
+        return lambda_func
+
+    def configure_s3_notifications(self):
+        # Only uploads, and the results of an async endpoint, are delivered by the bucket; the other
+        # stages are queued by the stage before them
+        if self.pipeline_mode == "orchestrated":
+            queues = {"FaceCropQueueArn": self.orchestrator_queue}
+        else:
+            queues = {"FaceCropQueueArn": self.face_crop_queue}
+            if self.facechain_sagemaker_endpoint_async:
+                queues["FaceSwapCompletionQueueArn"] = self.face_swap_completion_queue
+
         # Create bucket reference
         bucket = s3.Bucket.from_bucket_name(
             self,
@@ -232,49 +449,28 @@ def handler(event, context):
     props = event['ResourceProperties']
     bucket_name = props['BucketName']
     notification_config = {
-        'LambdaFunctionConfigurations': [
+        'QueueConfigurations': [
             {
-                'Events': ['s3:ObjectCreated:Put'],
-                'LambdaFunctionArn': props['FaceCropLambdaArn'],
+                'Events': props['Events'],
+                'QueueArn': props[queue_arn],
                 'Filter': {
                     'Key': {
                         'FilterRules': [
                             {
                                 'Name': 'prefix',
-                                'Value': props['FaceImagesPath']
-                            }
-                        ]
-                    }
-                }
-            },
-            {
-                'Events': ['s3:ObjectCreated:Put'],
-                'LambdaFunctionArn': props['FaceSwapLambdaArn'],
-                'Filter': {
-                    'Key': {
-                        'FilterRules': [
-                            {
-                                'Name': 'prefix',
-                                'Value': props['FaceCroppedImagesPath'] 
-                            }
-                        ]
-                    }
-                }
-            },
-            {
-                'Events': ['s3:ObjectCreated:Put'],
-                'LambdaFunctionArn': props['FaceSwapCompletionLambdaArn'],
-                'Filter': {
-                    'Key': {
-                        'FilterRules': [
-                            {
-                                'Name': 'prefix',
-                                'Value': props['ResultImagesPath']
+                                'Value': props[prefix]
                             }
                         ]
                     }
                 }
             }
+            for queue_arn, prefix in [
+                ('FaceCropQueueArn', 'FaceImagesPath'),
+                ('FaceSwapQueueArn', 'FaceCroppedImagesPath'),
+                ('FaceSwapCompletionQueueArn', 'ResultImagesPath')
+            ]
+            # In orchestrated mode only uploads are delivered; the orchestrator drives the later stages
+            if props.get(queue_arn)
         ]
     }
     
@@ -318,17 +514,20 @@ def handler(event, context):
             on_event_handler=configure_notifications_lambda
         )
 
-        CustomResource(
+        notifications_config = CustomResource(
             self,
             "S3NotificationsConfig",
             service_token=provider.service_token,
             properties={
                 "BucketName": self.s3_base_bucket_name,
-                "FaceCropLambdaArn": self.face_crop_lambda.function_arn,
-                "FaceSwapLambdaArn": self.face_swap_lambda.function_arn,
-                "FaceSwapCompletionLambdaArn": self.face_swap_completion_lambda.function_arn,
+                "Events": NOTIFICATION_EVENTS,
+                **{key: queue.queue_arn for key, queue in queues.items()},
                 "FaceImagesPath": self.s3_face_images_path,
                 "FaceCroppedImagesPath": self.s3_face_cropped_images_path,
                 "ResultImagesPath": self.s3_result_images_path
             }
         )
+
+        # S3 validates the destinations, so the queue policies have to exist first
+        for queue in queues.values():
+            notifications_config.node.add_dependency(queue)
@@ -0,0 +1,155 @@
+import aws_cdk as core
+import aws_cdk.assertions as assertions
+import pytest
+
+from stacks.facechain.sagemaker_endpoint_stack import FaceChainSageMakerEndpointStack
+
+BASE_CONTEXT = {
+    "s3_base_bucket_name": "gallery-bucket",
+    "facechain_sagemaker_endpoint_name": "facechain-endpoint",
+    "facechain_sagemaker_endpoint_instance_count": 1,
+    "facechain_sagemaker_endpoint_instance_type": "ml.g5.xlarge"
+}
+
+RESOURCE_ID = "endpoint/facechain-endpoint/variant/FaceChainVariant"
+
+
+def synth_template(**context):
+    app = core.App(context={**BASE_CONTEXT, **context})
+    status_stack = core.Stack(app, "StatusStack")
+    status_resource = core.CustomResource(status_stack, "CodeBuildStatus",
+        service_token="arn:aws:lambda:us-west-2:123456789012:function:codebuild-status"
+    )
+    stack = FaceChainSageMakerEndpointStack(app, "FaceChainSageMakerEndpointStack",
+        facechain_image_uri="123456789012.dkr.ecr.us-west-2.amazonaws.com/facechain:latest",
+        codebuild_status_resource=status_resource
+    )
+    return assertions.Template.from_stack(stack)
+
+
+def test_realtime_endpoint_tracks_invocations_per_instance():
+    template = synth_template(facechain_sagemaker_endpoint_max_capacity=4, facechain_sagemaker_endpoint_target_invocations=30)
+
+    template.has_resource_properties("AWS::ApplicationAutoScaling::ScalableTarget", {
+        "ServiceNamespace": "sagemaker",
+        "ResourceId": RESOURCE_ID,
+        "ScalableDimension": "sagemaker:variant:DesiredInstanceCount",
+        "MinCapacity": 1,
+        "MaxCapacity": 4
+    })
+    template.has_resource_properties("AWS::ApplicationAutoScaling::ScalingPolicy", {
+        "PolicyType": "TargetTrackingScaling",
+        "TargetTrackingScalingPolicyConfiguration": {
+            "PredefinedMetricSpecification": {"PredefinedMetricType": "SageMakerVariantInvocationsPerInstance"},
+            "TargetValue": 30,
+            "ScaleInCooldown": 600,
+            "ScaleOutCooldown": 60
+        }
+    })
+    template.resource_count_is("AWS::ApplicationAutoScaling::ScalingPolicy", 1)
+    template.resource_count_is("AWS::CloudWatch::Alarm", 0)
+
+
+def test_realtime_endpoint_has_no_async_config():
+    template = synth_template()
+
+    template.has_resource_properties("AWS::SageMaker::EndpointConfig", {
+        "AsyncInferenceConfig": assertions.Match.absent()
+    })
+    template.has_resource_properties("AWS::ApplicationAutoScaling::ScalableTarget", {
+        "MinCapacity": 1,
+        "MaxCapacity": 2
+    })
+
+
+def test_scalable_target_depends_on_endpoint():
+    template = synth_template()
+
+    endpoint_ids = list(template.find_resources("AWS::SageMaker::Endpoint"))
+    targets = template.find_resources("AWS::ApplicationAutoScaling::ScalableTarget")
+    assert len(endpoint_ids) == 1 and len(targets) == 1
+    assert endpoint_ids[0] in list(targets.values())[0]["DependsOn"]
+
+
+def test_async_endpoint_scales_to_zero_on_backlog():
+    template = synth_template(facechain_sagemaker_endpoint_async="true", facechain_sagemaker_endpoint_max_capacity=3)
+
+    template.has_resource_properties("AWS::SageMaker::EndpointConfig", {
+        "AsyncInferenceConfig": {
+            "OutputConfig": {"S3OutputPath": "s3://gallery-bucket/async-output/"},
+            "ClientConfig": {"MaxConcurrentInvocationsPerInstance": 2}
+        }
+    })
+    template.has_resource_properties("AWS::ApplicationAutoScaling::ScalableTarget", {
+        "ResourceId": RESOURCE_ID,
+        "MinCapacity": 0,
+        "MaxCapacity": 3
+    })
+    template.has_resource_properties("AWS::ApplicationAutoScaling::ScalingPolicy", {
+        "PolicyType": "TargetTrackingScaling",
+        "TargetTrackingScalingPolicyConfiguration": {
+            "CustomizedMetricSpecification": {
+                "MetricName": "ApproximateBacklogSizePerInstance",
+                "Namespace": "AWS/SageMaker",
+                "Dimensions": [{"Name": "EndpointName", "Value": "facechain-endpoint"}]
+            },
+            "TargetValue": 4
+        }
+    })
+    template.has_resource_properties("AWS::ApplicationAutoScaling::ScalingPolicy", {
+        "PolicyType": "StepScaling",
+        "StepScalingPolicyConfiguration": {
+            "AdjustmentType": "ChangeInCapacity",
+            "StepAdjustments": [{"MetricIntervalLowerBound": 0, "ScalingAdjustment": 1}]
+        }
+    })
+    template.has_resource_properties("AWS::CloudWatch::Alarm", {
+        "MetricName": "HasBacklogWithoutCapacity",
+        "Namespace": "AWS/SageMaker",
+        "Threshold": 1,
+        "ComparisonOperator": "GreaterThanOrEqualToThreshold"
+    })
+
+
+def test_realtime_endpoint_rejects_zero_min_capacity():
+    with pytest.raises(ValueError):
+        synth_template(facechain_sagemaker_endpoint_min_capacity=0)
+
+
+def test_overflow_variant_only_receives_targeted_requests():
+    template = synth_template(facechain_sagemaker_endpoint_overflow_instance_type="ml.c6i.4xlarge",
+                              facechain_sagemaker_endpoint_overflow_backend="onnx",
+                              facechain_sagemaker_endpoint_overflow_max_capacity=3)
+
+    template.has_resource_properties("AWS::SageMaker::EndpointConfig", {
+        "ProductionVariants": [
+            assertions.Match.object_like({"VariantName": "FaceChainVariant", "InitialVariantWeight": 1}),
+            assertions.Match.object_like({
+                "VariantName": "FaceChainOverflowVariant",
+                "InstanceType": "ml.c6i.4xlarge",
+                "ModelName": "facechain-sagemaker-overflow-model",
+                "InitialVariantWeight": 0
+            })
+        ]
+    })
+    template.has_resource_properties("AWS::SageMaker::Model", {
+        "ModelName": "facechain-sagemaker-overflow-model",
+        "PrimaryContainer": {"Environment": {"FACECHAIN_BACKEND": "onnx"}}
+    })
+    template.has_resource_properties("AWS::ApplicationAutoScaling::ScalableTarget", {
+        "ResourceId": "endpoint/facechain-endpoint/variant/FaceChainOverflowVariant",
+        "MinCapacity": 1,
+        "MaxCapacity": 3
+    })
+    template.resource_count_is("AWS::ApplicationAutoScaling::ScalingPolicy", 2)
+
+
+def test_overflow_variant_rejected_for_async_endpoint():
+    with pytest.raises(ValueError):
+        synth_template(facechain_sagemaker_endpoint_async="true", facechain_sagemaker_endpoint_overflow_instance_type="ml.c6i.4xlarge")
+
+
+def test_overflow_variant_rejects_unknown_backend():
+    with pytest.raises(ValueError):
+        synth_template(facechain_sagemaker_endpoint_overflow_instance_type="ml.c6i.4xlarge",
+                       facechain_sagemaker_endpoint_overflow_backend="tensorrt")
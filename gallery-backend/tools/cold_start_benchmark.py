@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# Measure the init phase (module import and global setup) of the gallery Lambda handlers.
+#
+# Every run imports the handler in a fresh interpreter, the way a cold Lambda sandbox does,
+# with the handler directory and the GalleryRuntime layer on sys.path. Run it from gallery-backend/:
+#
+#   python tools/cold_start_benchmark.py --runs 20
+#   python tools/cold_start_benchmark.py --handler get-image --importtime
+#
+# Compare against a checkout before the runtime layer to see what lazy clients save. AWS calls
+# are never made; the handlers only need a region and dummy table/bucket names to import.
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RUNTIME_LAYER_DIR = os.path.join(BACKEND_DIR, 'lambda', 'layers', 'gallery-runtime', 'python')
+
+HANDLERS = {
+    'put-image': 'lambda/apis/put-image',
+    'get-image': 'lambda/apis/get-image',
+    'get-job-status': 'lambda/apis/get-job-status',
+    'get-feed': 'lambda/apis/get-feed',
+    'user-agreement': 'lambda/apis/user-agreement',
+    'face-crop': 'lambda/image-processing/face-crop',
+    'face-swap': 'lambda/image-processing/face-swap',
+    'face-swap-completion': 'lambda/image-processing/face-swap-completion',
+    'orchestrator': 'lambda/image-processing/orchestrator',
+}
+
+DUMMY_ENVIRONMENT = {
+    'AWS_DEFAULT_REGION': 'us-east-1',
+    'BUCKET_NAME': 'benchmark-bucket',
+    'OBJECT_PATH': 'images/',
+    'FACE_CROPPED_OBJECT_PATH': 'face-cropped/',
+    'RESULT_OBJECT_PATH': 'result/',
+    'FACECHAIN_SAGEMAKER_ENDPOINT_NAME': 'benchmark-endpoint',
+    'DDB_AMAZON_BEDROCK_GALLERY_PROCESS_TABLE_NAME': 'benchmark-process',
+    'DDB_AMAZON_BEDROCK_GALLERY_DISPLAY_TABLE_NAME': 'benchmark-display',
+    'DDB_AMAZON_BEDROCK_GALLERY_DISPLAY_FEED_TABLE_NAME': 'benchmark-display-feed',
+    'DDB_AMAZON_BEDROCK_GALLERY_BASE_RESOURCE_TABLE_NAME': 'benchmark-base-resource',
+    'DDB_AMAZON_BEDROCK_USER_AGREEMENT_TABLE_NAME': 'benchmark-user-agreement',
+}
+
+# Runs inside the child interpreter; prints the init time in milliseconds
+INIT_SCRIPT = '''
+import time
+start = time.perf_counter()
+import index
+print((time.perf_counter() - start) * 1000)
+'''
+
+
+def run_once(handler_dir, importtime=False):
+    environment = dict(os.environ, **DUMMY_ENVIRONMENT)
+    environment['PYTHONPATH'] = os.pathsep.join([handler_dir, RUNTIME_LAYER_DIR, environment.get('PYTHONPATH', '')])
+    # Bytecode is cached in a real deployment package too, so only the first run compiles
+    command = [sys.executable] + (['-X', 'importtime'] if importtime else []) + ['-c', INIT_SCRIPT]
+    result = subprocess.run(command, cwd=handler_dir, env=environment, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+    return float(result.stdout.strip().splitlines()[-1]), result.stderr
+
+
+def top_imports(importtime_output, count):
+    # -X importtime lines: "import time: self [us] | cumulative | imported package"
+    rows = []
+    for line in importtime_output.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        rows.append((int(cumulative), name.rstrip()))
+    return sorted(rows, reverse=True)[:count]
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--handler', action='append', choices=sorted(HANDLERS), help='handler to measure (default: all)')
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--importtime', action='store_true', help='also list the slowest imports of one run')
+    args = parser.parse_args()
+
+    print(f"{'handler':<22}{'median ms':>12}{'p90 ms':>10}{'max ms':>10}")
+    for name in args.handler or list(HANDLERS):
+        handler_dir = os.path.join(BACKEND_DIR, HANDLERS[name])
+        try:
+            run_once(handler_dir)  # warm the bytecode cache
+            timings = [run_once(handler_dir)[0] for _ in range(args.runs)]
+        except RuntimeError as e:
+            # e.g. PIL or numpy not installed locally for face-crop
+            print(f"{name:<22}{'skipped':>12}  {e}")
+            continue
+        print(f"{name:<22}{statistics.median(timings):>12.1f}{percentile(timings, 0.9):>10.1f}{max(timings):>10.1f}")
+
+        if args.importtime:
+            _, importtime_output = run_once(handler_dir, importtime=True)
+            for cumulative, module in top_imports(importtime_output, 10):
+                print(f"    {cumulative / 1000:>8.1f} ms  {module.strip()}")
+
+
+if __name__ == '__main__':
+    main()
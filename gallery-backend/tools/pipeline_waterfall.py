@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# Join the per-stage timing lines of the pipeline into per-job waterfalls.
+#
+# Every pipeline Lambda and both endpoints print one JSON (EMF) line per job and stage, with the job
+# id, the stage start and its phases. Feed it any log export that contains those lines, e.g.
+#
+#   aws logs tail /aws/lambda/AmazonBedrockGalleryFaceCropLambda --since 1h > crop.log
+#   python tools/pipeline_waterfall.py crop.log swap.log completion.log endpoint.log
+#   python tools/pipeline_waterfall.py --job 20250101-visitor0001-spring-male-light-1a2b3c4d *.log
+#   python emulator/run.py --log /tmp/emulator.log && python tools/pipeline_waterfall.py /tmp/emulator.log
+#
+# Prints the slowest jobs as waterfalls, and the p50/p90/p99 of every stage phase, so the share of a
+# slow job spent in each phase (including queue waits) can be read off directly.
+
+import argparse
+import json
+import sys
+from collections import defaultdict
+
+STAGE_ORDER = ['put_image', 'orchestrator', 'face_crop', 'face_swap', 'facechain', 'gfpgan', 'face_swap_completion']
+
+
+def read_records(paths):
+    # Lines may carry a prefix (timestamp, log stream), so parse from the first brace
+    for path in paths or ['-']:
+        lines = sys.stdin if path == '-' else open(path, encoding='utf-8', errors='replace')
+        for line in lines:
+            start = line.find('{"_aws"')
+            if start < 0:
+                continue
+            try:
+                record = json.loads(line[start:])
+            except ValueError:
+                continue
+            if not record.get('job_id') or 'started_at_ms' not in record:
+                continue
+            # A multi-template FaceChain request serves several jobs with one line
+            for job_id in record.get('jobs') or [record['job_id']]:
+                yield dict(record, job_id=job_id)
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def job_span(records):
+    started_at = min(record['started_at_ms'] for record in records)
+    finished_at = max(record['started_at_ms'] + record['total_ms'] for record in records)
+    return started_at, finished_at
+
+
+def print_waterfall(job_id, records, width):
+    started_at, finished_at = job_span(records)
+    span = max(finished_at - started_at, 1)
+    print(f"\n{job_id}  {span:.0f} ms")
+
+    def bar(offset, duration, char):
+        left = int(offset / span * width)
+        return ' ' * left + char * max(1, int(duration / span * width))
+
+    records = sorted(records, key=lambda record: (record['started_at_ms'], STAGE_ORDER.index(record['Stage']) if record['Stage'] in STAGE_ORDER else 99))
+    for record in records:
+        stage_offset = record['started_at_ms'] - started_at
+        status = '' if record.get('status') == 'ok' else f" [{record.get('status')}]"
+        print(f"  {record['Stage'] + status:<36}{record['total_ms']:>9.0f} ms |{bar(stage_offset, record['total_ms'], '=')}")
+        for name, offset, duration in record.get('phases', []):
+            char = '.' if name == 'queue_wait' else '#'
+            print(f"    {name:<34}{duration:>9.0f} ms |{bar(stage_offset + offset, duration, char)}")
+
+
+def print_summary(jobs):
+    durations = defaultdict(list)
+    for records in jobs.values():
+        started_at, finished_at = job_span(records)
+        durations[('job', 'end_to_end')].append(finished_at - started_at)
+        for record in records:
+            durations[(record['Stage'], 'total')].append(record['total_ms'])
+            phases = defaultdict(float)
+            for name, _, duration in record.get('phases', []):
+                phases[name] += duration
+            for name, duration in phases.items():
+                durations[(record['Stage'], name)].append(duration)
+
+    def order(key):
+        stage, name = key
+        return (STAGE_ORDER.index(stage) if stage in STAGE_ORDER else len(STAGE_ORDER), name != 'total', name)
+
+    print(f"\n{'stage / phase (ms)':<44}{'count':>7}{'p50':>9}{'p90':>9}{'p99':>9}{'max':>9}")
+    for key in sorted(durations, key=order):
+        values = durations[key]
+        label = key[0] if key[1] == 'total' else f"  {key[1]}" if key[0] != 'job' else 'end to end'
+        print(f"{label:<44}{len(values):>7}{percentile(values, 0.5):>9.0f}{percentile(values, 0.9):>9.0f}{percentile(values, 0.99):>9.0f}{max(values):>9.0f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Per-job waterfalls from the pipeline timing log lines.')
+    parser.add_argument('paths', nargs='*', help='log files (default: stdin)')
+    parser.add_argument('--job', action='append', help='only show this job id')
+    parser.add_argument('--slowest', type=int, default=5, help='waterfalls for the N slowest jobs')
+    parser.add_argument('--width', type=int, default=60)
+    args = parser.parse_args()
+
+    jobs = defaultdict(list)
+    for record in read_records(args.paths):
+        if not args.job or record['job_id'] in args.job:
+            jobs[record['job_id']].append(record)
+    if not jobs:
+        print("No timing lines found", file=sys.stderr)
+        return 1
+
+    def span_of(job_id):
+        started_at, finished_at = job_span(jobs[job_id])
+        return finished_at - started_at
+
+    by_span = sorted(jobs, key=span_of, reverse=True)
+    for job_id in (args.job or by_span[:args.slowest]):
+        if job_id in jobs:
+            print_waterfall(job_id, jobs[job_id], args.width)
+    print_summary(jobs)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -32,13 +32,14 @@ const DisplayComponent = () => {
   const [ imgState, setImgState ] = useState<number>(1);
   const audioRef = useRef<HTMLAudioElement | null>(null);
 
+  // Long-poll: the API holds the request until a result newer than `uuid` is written (up to 20s)
   const { data } = useQuery({
-    queryKey: [id],
+    queryKey: [id, uuid],
     queryFn: () =>
-      fetch(`${endpoint}/images/${id}`).then((res) =>
+      fetch(`${endpoint}/images/${id}?wait=20&since=${encodeURIComponent(uuid)}`).then((res) =>
         res.json()
       ),
-    refetchInterval: 5000,
+    refetchInterval: 1000,
   });
 
   useEffect(() => {
@@ -88,7 +88,7 @@ const UserPhoto = ({ signOut, user }) => {
         console.log('Fetched presigned data:', data);
         console.log('Fetched presigned url:', data.uploadUrl); 
         console.log('uploading Image To S3');
-        uploadImageToS3(data.uploadUrl, capturedImage).then(() => setUploadProgress2(50));
+        uploadImageToS3(data.uploadUrl, capturedImage, data.uploadHeaders).then(() => setUploadProgress2(50));
         console.log('call Agreement API');
         console.log(data)
         sendUserAgreementCommand(data.uploadUrl, user.username, agreementUserName);
@@ -98,7 +98,7 @@ const UserPhoto = ({ signOut, user }) => {
     .catch(error => console.error('Error while uploading the image:', error));
   }
 
-  const uploadImageToS3 = async (presignedUrl4Put: string, imageSrc: any) => {
+  const uploadImageToS3 = async (presignedUrl4Put: string, imageSrc: any, uploadHeaders?: Record<string, string>) => {
     if (presignedUrl4Put) {
       try {
         // Data URI 형식에서 Blob으로 변환
@@ -112,9 +112,10 @@ const UserPhoto = ({ signOut, user }) => {
           },
         };
 
-        // Content-Type 헤더 설정
+        // Content-Type 및 서명된 메타데이터 헤더 설정
         const header = {
           'Content-Type': 'image/jpeg',
+          ...uploadHeaders,
         };
 
         console.log("Uploading to:", presignedUrl4Put);